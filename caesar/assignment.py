@@ -2,6 +2,81 @@ import numpy as np
 
 from yt.funcs import mylog
 
+def majority_parents(child, parent, nchild):
+    """Parent holding the most particles of each child.
+
+    Crosstabulates (child, parent) index pairs, one per particle, by
+    sorting them and counting runs of equal pairs, then takes the most
+    common parent of each child; ties go to the lowest parent index, as
+    with ``np.bincount(...).argmax()``.  Pairs with a negative parent
+    (particles in no parent, or unbound) are ignored.
+
+    Parameters
+    ----------
+    child, parent : np.ndarray
+        Child and parent index of each particle.
+    nchild : int
+        Number of children.
+
+    Returns
+    -------
+    np.ndarray
+        Parent index of each child, -1 for those with no particles in
+        any parent.
+
+    """
+    child = np.asarray(child, dtype=np.int64)
+    parent = np.asarray(parent, dtype=np.int64)
+    valid = parent > -1
+    child = child[valid]
+    parent = parent[valid]
+    result = np.full(nchild, -1, dtype=np.int64)
+    if len(child) == 0:
+        return result
+
+    # runs of equal pairs, sorted by child then parent
+    npar = parent.max() + 1
+    pairs, counts = np.unique(child * npar + parent, return_counts=True)
+    child = pairs // npar
+    starts = np.flatnonzero(np.r_[True, child[1:] != child[:-1]])
+    # first (lowest) parent with the largest count within each child's runs
+    best = counts == np.repeat(np.maximum.reduceat(counts, starts), np.diff(np.r_[starts, len(child)]))
+    best = np.flatnonzero(best)
+    first = best[np.r_[True, child[best][1:] != child[best][:-1]]]
+    result[child[first]] = pairs[first] % npar
+    return result
+
+def index_lists(parents, nparent):
+    """Indexes of the children of each parent, as views into one array.
+
+    Parameters
+    ----------
+    parents : np.ndarray
+        Parent index of each child, or -1.
+    nparent : int
+        Number of parents.
+
+    Returns
+    -------
+    list
+        Sorted child indexes of each parent.
+
+    """
+    parents = np.asarray(parents, dtype=np.int64)
+    children = np.flatnonzero(parents > -1)
+    children = children[np.argsort(parents[children], kind='stable')]
+    bins = np.zeros(nparent+1, dtype=np.int64)
+    np.cumsum(np.bincount(parents[parents > -1], minlength=nparent), out=bins[1:])
+    return [children[bins[i]:bins[i+1]] for i in range(nparent)]
+
+def _member_pairs(children, name, global_list):
+    """(child, parent) index pairs of the particles in index list name
+    of children, with parents from the global particle list."""
+    from caesar.group import collate_group_lists
+    members, bins = collate_group_lists(children, name)
+    child = np.repeat(np.arange(len(children), dtype=np.int64), np.diff(bins))
+    return child, global_list[members.astype(np.int64)]
+
 def assign_galaxies_to_halos(obj):
     """Assign galaxies to halos.
 
@@ -21,30 +96,15 @@ def assign_galaxies_to_halos(obj):
 
     mylog.info('Assigning galaxies to halos')
     
-    h_glist = obj.global_particle_lists.halo_glist
-    h_slist = obj.global_particle_lists.halo_slist
-    for galaxy in obj.galaxies:
-        glist = h_glist[galaxy.glist]
-        slist = h_slist[galaxy.slist]
-
-        combined = np.hstack((glist,slist))
-        valid = np.where(combined > -1)[0]
-        combined = combined[valid]
-
-        galaxy.parent_halo_index = -1
-        if len(combined) > 0:
-            galaxy.parent_halo_index = np.bincount(combined).argmax()
-
-    for halo in obj.halos:
-        halo.galaxy_index_list = []
-
-    for i in range(0,obj.ngalaxies):
-        galaxy = obj.galaxies[i]
-        if galaxy.parent_halo_index > -1:
-            obj.halos[galaxy.parent_halo_index].galaxy_index_list.append(i)
-
+    gchild, gparent = _member_pairs(obj.galaxies, 'glist', obj.global_particle_lists.halo_glist)
+    schild, sparent = _member_pairs(obj.galaxies, 'slist', obj.global_particle_lists.halo_slist)
+    parents = majority_parents(np.concatenate((gchild, schild)), np.concatenate((gparent, sparent)), obj.ngalaxies)
 
+    from caesar.catalogue import set_group_column
+    set_group_column(obj.galaxies, 'parent_halo_index', parents)
 
+    for halo,galaxy_index_list in zip(obj.halos, index_lists(parents, obj.nhalos)):
+        halo.galaxy_index_list = galaxy_index_list
 
 
 def assign_clouds_to_galaxies(obj):
@@ -67,34 +127,21 @@ def assign_clouds_to_galaxies(obj):
 
     mylog.info('Assigning clouds to galaxies')
     
+    child, parent = _member_pairs(obj.clouds, 'glist', obj.global_particle_lists.galaxy_glist)
+    parents = majority_parents(child, parent, obj.nclouds)
 
-    g_glist = obj.global_particle_lists.galaxy_glist
-
-    for cloud in obj.clouds:
-        glist = g_glist[cloud.glist]
-
-        combined = glist
-        valid = np.where(combined > -1)[0]
-        combined = combined[valid]
-        
-        cloud.parent_galaxy_index = -1
-        if len(combined) > 0:
-            cloud.parent_galaxy_index = np.bincount(combined).argmax()
+    from caesar.catalogue import set_group_column
+    set_group_column(obj.clouds, 'parent_galaxy_index', parents)
 
-    for galaxy in obj.galaxies:
-        galaxy.cloud_index_list = []
-
-    for i in range(0,obj.nclouds):
-        cloud = obj.clouds[i]
-        if cloud.parent_galaxy_index > -1:
-            obj.galaxies[cloud.parent_galaxy_index].cloud_index_list.append(i)
+    for galaxy,cloud_index_list in zip(obj.galaxies, index_lists(parents, obj.ngalaxies)):
+        galaxy.cloud_index_list = cloud_index_list
 
             
 def assign_central_galaxies(obj,central_mass_definition='total'):
     """Assign central galaxies.
 
-    Iterate through halos and consider the most massive galaxy within
-    a central and all other satellites.
+    Consider the most massive galaxy within each halo a central and
+    all other satellites.
 
     Parameters
     ----------
@@ -111,12 +158,21 @@ def assign_central_galaxies(obj,central_mass_definition='total'):
     obj.central_galaxies   = []
     obj.satellite_galaxies = []
 
-    for halo in obj.halos:
-        if len(halo.galaxy_index_list) == 0:
-            continue
-
-        galaxy_masses = np.array([s.masses[central_mass_definition] for s in halo.galaxies])
-        central_index = np.argmax(galaxy_masses)
-        obj.galaxies[halo.galaxy_index_list[central_index]].central = True
+    # most massive galaxy in each halo's list, the first of them on ties
+    from caesar.group import collate_group_lists
+    from caesar.catalogue import group_catalogue
+    galaxy_index, bins = collate_group_lists(obj.halos, 'galaxy_index_list')
+    if len(galaxy_index) == 0:
+        return
+    galaxy_index = galaxy_index.astype(np.int64)
+    catalogue = group_catalogue(obj.galaxies)
+    galaxy_masses = catalogue.column('masses', central_mass_definition).d[galaxy_index]
+    halo_index = np.repeat(np.arange(len(bins)-1), np.diff(bins))
+    order = np.lexsort((np.arange(len(galaxy_index)), -galaxy_masses, halo_index))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = halo_index[order][1:] != halo_index[order][:-1]
+    central = np.array(catalogue.column('central'), dtype=bool)
+    central[galaxy_index[order[first]]] = True
+    catalogue.set_column('central', central)
 
 
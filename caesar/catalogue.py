@@ -0,0 +1,410 @@
+"""Columnar catalogue of group properties during member_search.
+
+Rather than each Halo/Galaxy/Cloud holding its properties as individual
+quantities and dicts of quantities, the properties of a whole group list
+are held here as one array per property: attributes such as ``pos`` or
+``sfr`` in :attr:`Catalogue.data`, and the entries of dicts such as
+``masses`` or ``radii`` in :attr:`Catalogue.dicts`, just as the loader
+reads them back from a caesar file.  Each group holds only its catalogue
+and row, and sees its properties through attribute access, with dicts
+as :class:`ColumnDict` views of its row.
+
+Properties computed for all groups at once are stored with
+:meth:`Catalogue.set_column`, which attaches units to the whole column
+once; setting a property on a single group writes into its row.
+"""
+
+import numpy as np
+from collections.abc import Mapping, MutableMapping
+from yt.units.yt_array import YTArray
+
+# dicts of properties every group has, even before any are computed
+group_dicts = ['masses', 'radii', 'temperatures', 'velocity_dispersions', 'rotation', 'virial_quantities']
+
+def _columnable(value):
+    """Whether value can be held in a column: a number, or a quantity
+    or length-3 vector with units."""
+    if isinstance(value, YTArray):
+        return value.shape == () or value.shape == (3,)
+    return isinstance(value, (bool, int, float, np.number, np.bool_))
+
+def _stack(values):
+    """Column from the values of several rows, or None if they do not
+    share a type, units and shape."""
+    first = values[0]
+    if isinstance(first, YTArray):
+        if not all(isinstance(v, YTArray) and v.units == first.units and v.shape == first.shape for v in values):
+            return None
+        return YTArray(np.array([v.d for v in values]), first.units)
+    for kind in [(bool, np.bool_), (int, np.integer), (float, np.floating)]:
+        if isinstance(first, kind):
+            if not all(isinstance(v, kind) and not isinstance(v, YTArray) for v in values):
+                return None
+            if kind[0] is int and any(isinstance(v, (bool, np.bool_)) for v in values):
+                return None
+            return np.array(values)
+    return None
+
+def _widen(column, dtype):
+    """column, or a copy of it that can also hold values of dtype."""
+    dtype = np.promote_types(column.dtype, dtype)
+    if dtype == column.dtype:
+        return column
+    return column.astype(dtype)
+
+class Catalogue(object):
+    """Properties of a list of groups, held as one array per property.
+
+    Row i holds the properties of the group with ``_row == i``, usually
+    the i-th of the list.  A column set for only some rows keeps a mask
+    of the rows that hold a value, so each group sees exactly the
+    attributes and dict keys it was given.  Values the groups already
+    hold when the catalogue is created are moved into it, where they
+    fit a column; writing a column also replaces any value of the same
+    name that a group holds itself.
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Main caesar object.
+    grp_list : list
+        Groups (Halo/Galaxy/Cloud) of the catalogue, in row order.
+
+    """
+    def __init__(self, obj, grp_list):
+        self.obj = obj
+        self.nrows = len(grp_list)
+        self.data = {}       # attribute -> column
+        self.dicts = {}      # dict name -> {key -> column}
+        self._present = {}   # (name, key) -> rows holding a value, for partial columns
+        self.groups = list(grp_list)  # group of each row
+        self.shadowed = set()  # names that some group holds itself, hiding any column
+        self._absorb(grp_list)
+
+    def _absorb(self, grp_list):
+        """Attaches the groups, moving the properties they hold into columns."""
+        values = {}  # (name, key) -> {row: value}
+        for row, group in enumerate(grp_list):
+            for name, value in list(group._attributes().items()):
+                if isinstance(value, Mapping):
+                    if not all(_columnable(v) for v in value.values()):
+                        self.shadowed.add(name)
+                        continue
+                    self.dicts.setdefault(name, {})
+                    for k, v in value.items():
+                        values.setdefault((name, k), {})[row] = v
+                elif _columnable(value):
+                    values.setdefault((name, None), {})[row] = value
+                else:
+                    self.shadowed.add(name)
+                    continue
+                group.__dict__.pop(name, None)
+            object.__setattr__(group, '__dict__', dict(group.__dict__))  # dicts do not shrink as items are popped
+            group._attach(self, row)
+
+        for (name, key), row_values in values.items():
+            rows = np.fromiter(row_values.keys(), dtype=np.int64, count=len(row_values))
+            column = _stack(list(row_values.values()))
+            if column is None:
+                if key is None:  # attributes that do not fit a column stay on their groups
+                    for row, value in row_values.items():
+                        object.__setattr__(grp_list[row], name, value)
+                    self.shadowed.add(name)
+                    continue
+                column = np.empty(len(rows), dtype=object)
+                column[:] = list(row_values.values())
+            self.set_column(name, column, key=key, rows=rows)
+
+    def _columns(self, name, key):
+        """The dict of columns holding (name, key)."""
+        if key is None:
+            return self.data
+        return self.dicts.setdefault(name, {})
+
+    def _new_column(self, value, nrows):
+        """An empty column for values like value, or None if it cannot hold it."""
+        if isinstance(value, YTArray):
+            if value.shape != () and value.shape != (3,):
+                return None
+            return YTArray(np.zeros((nrows,)+value.shape, dtype=value.dtype), value.units)
+        value = np.asarray(value)
+        if value.ndim > 1:
+            return None
+        return np.zeros((nrows,)+value.shape, dtype=value.dtype)
+
+    def set_column(self, name, values, units=None, key=None, rows=None):
+        """Sets attribute name, or key of dict name, of all rows at once.
+
+        Parameters
+        ----------
+        name : str
+            Attribute, or dict of properties (e.g. 'masses').
+        values : np.ndarray
+            One value (or length-3 vector) per row.  A YTArray keeps its
+            units.
+        units : str, optional
+            Units attached to the whole of values.
+        key : str, optional
+            Key within dict name; None for an attribute.
+        rows : np.ndarray, optional
+            Rows that values are for; other rows keep their values, or
+            have none if the column is new.
+
+        """
+        if units is not None:
+            values = self.obj.yt_dataset.arr(values, units)
+        elif not isinstance(values, YTArray):
+            values = np.asarray(values)
+        if name in self.shadowed:
+            self._unshadow(name, key, rows)
+        columns = self._columns(name, key)
+        if rows is None:
+            if len(values) != self.nrows:
+                raise ValueError('%d values for %s of %d groups' % (len(values), name if key is None else '%s.%s' % (name, key), self.nrows))
+            columns[key if key is not None else name] = values
+            self._present.pop((name, key), None)
+            return
+
+        column = columns.get(key if key is not None else name)
+        if column is None:
+            column = self._new_column(values[0], self.nrows) if len(values) > 0 and values.dtype != object else None
+            if column is None:
+                column = np.empty(self.nrows, dtype=object)
+            columns[key if key is not None else name] = column
+            self._present[(name, key)] = np.zeros(self.nrows, dtype=bool)
+        if isinstance(column, YTArray) and isinstance(values, YTArray):
+            values = values.to(column.units).d
+        if column.dtype != object:
+            column = columns[key if key is not None else name] = _widen(column, np.asarray(values).dtype)
+        column.view(np.ndarray)[rows] = values
+        present = self._present.get((name, key))
+        if present is not None:
+            present[rows] = True
+            if present.all():
+                del self._present[(name, key)]
+
+    def _unshadow(self, name, key, rows):
+        """Makes the groups of rows (all if None) that hold name themselves
+        see the column about to be written instead; a dict of theirs is
+        first moved into the catalogue, keeping its other keys."""
+        groups = self.groups if rows is None else [self.groups[row] for row in rows]
+        for group in groups:
+            if name not in group.__dict__:
+                continue
+            value = group.__dict__.pop(name)
+            if key is not None and isinstance(value, Mapping):
+                self.view(group._row, name).replace(value)
+        if rows is None or not any(name in g.__dict__ for g in self.groups):
+            self.shadowed.discard(name)
+
+    def column(self, name, key=None):
+        """Attribute name, or key of dict name, of all rows.  Rows
+        without a value are zero (see :meth:`present`)."""
+        if key is None:
+            return self.data[name]
+        return self.dicts[name][key]
+
+    def present(self, name, key=None):
+        """Which rows hold a value of attribute name, or of key of dict name."""
+        if (name, key) in self._present:
+            return self._present[(name, key)].copy()
+        return np.full(self.nrows, self._has_column(name, key))
+
+    def _has_column(self, name, key):
+        if key is None:
+            return name in self.data
+        return name in self.dicts and key in self.dicts[name]
+
+    def has(self, row, name, key=None):
+        """Whether row holds attribute name, or key of dict name."""
+        if not self._has_column(name, key):
+            return False
+        present = self._present.get((name, key))
+        return present is None or bool(present[row])
+
+    def get(self, row, name, key=None):
+        """Value of row; plain numbers come back as Python scalars, like
+        the per-object values they replace."""
+        column = self.data[name] if key is None else self.dicts[name][key]
+        value = column[row]
+        if not isinstance(column, YTArray) and column.ndim == 1 and column.dtype != object:
+            return value.item()
+        return value
+
+    def set(self, row, name, value, key=None):
+        """Sets the value of row.  Returns False, leaving the catalogue
+        unchanged, if value does not fit the attribute's column; dict
+        columns instead fall back to holding any object."""
+        columns = self._columns(name, key)
+        ckey = key if key is not None else name
+        column = columns.get(ckey)
+        if column is None:
+            column = self._new_column(value, self.nrows) if _columnable(value) else None
+            if column is None:
+                if key is None:
+                    return False
+                column = np.empty(self.nrows, dtype=object)
+            columns[ckey] = column
+            self._present[(name, key)] = np.zeros(self.nrows, dtype=bool)
+        written = self._set_row(column, row, value)
+        if written is None:
+            if key is None:
+                return False
+            written = self._as_objects(column)
+            written[row] = value
+        columns[ckey] = written
+        present = self._present.get((name, key))
+        if present is not None:
+            present[row] = True
+            if present.all():
+                del self._present[(name, key)]
+        return True
+
+    def _set_row(self, column, row, value):
+        """Writes value into column[row], widening the column's dtype if
+        value needs it; returns the column, or None if value does not fit
+        it (e.g. a number without units in a column with units, or a
+        float in a column of ints)."""
+        if column.dtype == object:
+            column[row] = value
+            return column
+        if isinstance(column, YTArray) != isinstance(value, YTArray):
+            return None
+        try:
+            data = value.to(column.units).d if isinstance(value, YTArray) else np.asarray(value)
+            if data.shape != column.shape[1:] or data.dtype.kind not in 'biuf':
+                return None
+            if data.dtype.kind != column.dtype.kind and not (isinstance(column, YTArray) and column.dtype.kind == 'f' and data.dtype.kind in 'iu'):
+                return None
+            column = _widen(column, data.dtype)
+            column.view(np.ndarray)[row] = data
+            return column
+        except Exception:
+            return None
+
+    def _as_objects(self, column):
+        """column as an object array of its rows' values."""
+        objects = np.empty(self.nrows, dtype=object)
+        for row in range(self.nrows):
+            objects[row] = column[row]
+        return objects
+
+    def discard(self, row, name, key=None):
+        """Removes attribute name, or key of dict name, from row."""
+        if not self.has(row, name, key):
+            return
+        present = self._present.get((name, key))
+        if present is None:
+            present = self._present[(name, key)] = np.ones(self.nrows, dtype=bool)
+        present[row] = False
+
+    def clear_dict(self, name):
+        """Removes all keys of dict name from every row, as when each
+        group is given a new dict."""
+        for key in self.dicts.pop(name, {}):
+            self._present.pop((name, key), None)
+        self.dicts[name] = {}
+
+    def keys(self, row, name):
+        """Keys of dict name held by row."""
+        return [k for k in self.dicts.get(name, {}) if self.has(row, name, k)]
+
+    def attributes(self, row):
+        """Attributes held by row."""
+        return [k for k in self.data if self.has(row, k)]
+
+    def view(self, row, name):
+        """Dict name of row, as a :class:`ColumnDict`."""
+        self.dicts.setdefault(name, {})
+        return ColumnDict(self, row, name)
+
+    def reorder(self, grp_list, order):
+        """Permutes the rows, e.g. after sorting the groups.
+
+        Parameters
+        ----------
+        grp_list : list
+            The groups, already in their new order.
+        order : np.ndarray
+            Old row of each new row.
+
+        """
+        for name in self.data:
+            self.data[name] = self.data[name][order]
+        for name in self.dicts:
+            for key in self.dicts[name]:
+                self.dicts[name][key] = self.dicts[name][key][order]
+        for k in self._present:
+            self._present[k] = self._present[k][order]
+        self.groups = list(grp_list)
+        for row, group in enumerate(grp_list):
+            group._attach(self, row)
+
+    def rows(self, grp_list):
+        """Rows of the groups in grp_list."""
+        return np.fromiter((g._row for g in grp_list), dtype=np.int64, count=len(grp_list))
+
+class ColumnDict(MutableMapping):
+    """One group's dict of properties (e.g. ``masses``), as a view of its
+    row of the catalogue columns; it behaves as the dict it replaces."""
+    __slots__ = ('_catalogue', '_row', '_name')
+
+    def __init__(self, catalogue, row, name):
+        self._catalogue = catalogue
+        self._row = row
+        self._name = name
+
+    def __getitem__(self, key):
+        if not self._catalogue.has(self._row, self._name, key):
+            raise KeyError(key)
+        return self._catalogue.get(self._row, self._name, key)
+
+    def __setitem__(self, key, value):
+        self._catalogue.set(self._row, self._name, value, key)
+
+    def __delitem__(self, key):
+        if not self._catalogue.has(self._row, self._name, key):
+            raise KeyError(key)
+        self._catalogue.discard(self._row, self._name, key)
+
+    def __contains__(self, key):
+        return self._catalogue.has(self._row, self._name, key)
+
+    def __iter__(self):
+        return iter(self._catalogue.keys(self._row, self._name))
+
+    def __len__(self):
+        return len(self._catalogue.keys(self._row, self._name))
+
+    def replace(self, values):
+        """Makes the row hold exactly the items of values."""
+        for key in self._catalogue.keys(self._row, self._name):
+            if key not in values:
+                self._catalogue.discard(self._row, self._name, key)
+        for key, value in values.items():
+            self._catalogue.set(self._row, self._name, value, key)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+def group_catalogue(grp_list):
+    """The :class:`Catalogue` of grp_list, whose row i is grp_list[i].
+
+    Groups that already share one in that order keep it; otherwise a new
+    one is created, taking over the properties the groups hold.
+
+    """
+    if len(grp_list) > 0:
+        catalogue = grp_list[0]._catalogue
+        if catalogue is not None and catalogue.nrows == len(grp_list) and \
+           all(g._catalogue is catalogue and g._row == i for i, g in enumerate(grp_list)):
+            return catalogue
+        return Catalogue(grp_list[0].obj, grp_list)
+    return Catalogue(None, grp_list)
+
+def set_group_column(grp_list, name, values, units=None, key=None):
+    """Sets attribute name (or key of dict name) of each of grp_list, as
+    one column of their :class:`Catalogue`; see :meth:`Catalogue.set_column`."""
+    if len(grp_list) == 0:
+        return
+    group_catalogue(grp_list).set_column(name, values, units=units, key=key)
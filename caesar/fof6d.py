@@ -10,6 +10,7 @@
 
 import numpy as np
 from sklearn.neighbors import NearestNeighbors
+from caesar.spatial_index import periodic_tree, ball_neighbors
 import time
 import sys
 import os
@@ -163,13 +164,27 @@ class fof6d:
             len_gi += len(g_inds[ih])
         memlog('%d halo particles, %g%% eligible for galaxies'%(len_hi, np.round(100*len_gi/len_hi,2)))
 
-        # get tags using fof6d
+        # get tags using fof6d.  With nproc>1, halos with more than big_npart eligible particles
+        # (half of an even per-process share, and at least 10000) are done first, one at a time
+        # with all threads for the neighbour search and velocity criterion; the rest are spread
+        # over joblib workers with one thread each.
+        grp_tags = [None]*len(self.obj.halo_list)  # particle IDs for fof6d objects
+        big_npart = max(len_gi//(2*self.nproc), 10000) if self.nproc > 1 else len_gi
+        small = []
+        for ih in range(len(self.obj.halo_list)):
+            if len(g_inds[ih]) > big_npart:
+                grp_tags[ih] = fof6d_halo(len(self.obj.halo_list[ih].global_indexes),len(g_inds[ih]),self.obj.data_manager.pos[g_inds[ih]],self.obj.data_manager.vel[g_inds[ih]],self.minstars,self.obj.simulation.boxsize.d,self.fof_LL,self.vel_LL,self.kerneltab,self.nproc)
+            else:
+                small.append(ih)
         if self.nproc == 1:
-            grp_tags = [None]*len(self.obj.halo_list)  # particle IDs for fof6d objects
-            for ih in range(len(self.obj.halo_list)):
+            for ih in small:
                 grp_tags[ih] = fof6d_halo(len(self.obj.halo_list[ih].global_indexes),len(g_inds[ih]),self.obj.data_manager.pos[g_inds[ih]],self.obj.data_manager.vel[g_inds[ih]],self.minstars,self.obj.simulation.boxsize.d,self.fof_LL,self.vel_LL,self.kerneltab)
+        elif 'fof6d_shared' in self.obj._kwargs and not self.obj._kwargs['fof6d_shared']:
+            results = Parallel(n_jobs=self.nproc)(delayed(fof6d_halo)(len(self.obj.halo_list[ih].global_indexes),len(g_inds[ih]),self.obj.data_manager.pos[g_inds[ih]],self.obj.data_manager.vel[g_inds[ih]],self.minstars,self.obj.simulation.boxsize.d,self.fof_LL,self.vel_LL,self.kerneltab) for ih in small)
+            for ih,tags in zip(small,results):
+                grp_tags[ih] = tags
         else:
-            grp_tags = Parallel(n_jobs=self.nproc)(delayed(fof6d_halo)(len(self.obj.halo_list[ih].global_indexes),len(g_inds[ih]),self.obj.data_manager.pos[g_inds[ih]],self.obj.data_manager.vel[g_inds[ih]],self.minstars,self.obj.simulation.boxsize.d,self.fof_LL,self.vel_LL,self.kerneltab) for ih in range(len(self.obj.halo_list)))
+            self.run_fof6d_shared(g_inds, small, grp_tags)
 
         # adjust tags to be sequential in galaxy number overall (rather than within each halo)
         ngrp = 0
@@ -188,14 +203,55 @@ class fof6d:
 
         memlog('Done fof6d, found %d %s'%(ngrp,group_types[target_type]))
 
+    def run_fof6d_shared(self, g_inds, halos, grp_tags):
+        ''' Runs fof6d_halo on the given halos in parallel without shipping particle data to the
+        workers, filling in their grp_tags.  The positions and velocities of eligible particles are
+        written once, grouped by halo, to memory-mapped files that every worker maps; each task only
+        carries its halo's index range.  Halos are dispatched largest first, so the biggest ones do
+        not hold up the end of the run. '''
+        import shutil
+        import tempfile
+        from joblib import Parallel, delayed
+
+        nhalo = len(halos)
+        nelig = np.array([len(g_inds[ih]) for ih in halos], dtype=np.int64)
+        offsets = np.zeros(nhalo+1, dtype=np.int64)
+        np.cumsum(nelig, out=offsets[1:])
+        all_inds = np.concatenate([g_inds[ih] for ih in halos]) if nhalo > 0 else np.zeros(0, dtype=np.int64)
+
+        # /dev/shm keeps the mapped files in memory where available
+        tmpdir = tempfile.mkdtemp(prefix='caesar_fof6d_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        try:
+            shared = []
+            for name in ['pos','vel']:
+                data = getattr(self.obj.data_manager, name)
+                mm = np.memmap(os.path.join(tmpdir, '%s.mmap'%name), dtype=data.dtype, mode='w+', shape=(max(len(all_inds),1),)+data.shape[1:])
+                np.take(data, all_inds, axis=0, out=mm[:len(all_inds)])
+                mm.flush()
+                shared.append(mm)
+            order = np.argsort(-nelig, kind='stable')
+            memlog('fof6d: %d eligible particles shared via %s, largest halo has %d'%(len(all_inds), tmpdir, nelig[order[0]] if nhalo > 0 else 0))
+            results = Parallel(n_jobs=self.nproc)(delayed(fof6d_halo_range)(len(self.obj.halo_list[halos[i]].global_indexes),offsets[i],offsets[i+1],shared[0],shared[1],self.minstars,self.obj.simulation.boxsize.d,self.fof_LL,self.vel_LL,self.kerneltab) for i in order)
+            del shared, mm
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        for i,tags in zip(order,results):
+            grp_tags[halos[i]] = tags
+
     def load_lists(self,parent=None):
         # create valid caesar groups, populate index lists
-        from caesar.group import create_new_group, group_types
-        from caesar.property_manager import ptype_ints, has_ptype
+        from caesar.group import create_new_group, group_types, GroupMembership, plist_dict
         grp_list = []
         if parent is not None:
             for ihalo in range(len(parent.obj.halo_list)):
                 parent.obj.halo_list[ihalo].galaxy_index_list = []
+        # index lists of all groups, globally and for each particle type; groups hold views into these
+        self.membership = GroupMembership(self.obj, self.pid_sorted, self.hid_bins, self.nparttype)
+        counts = {}
+        for p in ['gas', 'star', 'bh', 'dust', 'dm', 'dm2']:
+            if plist_dict[p] in self.membership.offsets:
+                counts[p] = self.membership.counts(plist_dict[p])
         ngrp = 0
         zero_marker = 0
         for igrp in range(len(self.grouplist)):
@@ -203,33 +259,10 @@ class fof6d:
                 zero_marker = 1  # if there are particles with tag=-1, these will be in igrp=0 within hid_bins. In this case, group_parents should start their numbering at 1, since igrp=0 is not a valid object.  This should only happen for galaxies/clouds, not halos
                 continue
             mygrp = create_new_group(self.obj, self.obj_type)
-            my_indexes = self.pid_sorted[self.hid_bins[igrp]:self.hid_bins[igrp+1]]  # indexes for parts in this group
-            # load indexes into lists for a given group, globally and for each particle type
-            my_ptype = self.obj.data_manager.ptype[my_indexes]
-            my_pos = self.obj.data_manager.pos[my_indexes]
-            mygrp.global_indexes = my_indexes
-            offset = 0
-            for ip,p in enumerate(self.obj.data_manager.ptypes):
-                if not has_ptype(self.obj, p): continue
-                if p == 'gas': 
-                    mygrp.glist = my_indexes[my_ptype==ptype_ints[p]]-offset
-                    mygrp.ngas = len(mygrp.glist)
-                elif p == 'star': 
-                    mygrp.slist = my_indexes[my_ptype==ptype_ints[p]]-offset
-                    mygrp.nstar = len(mygrp.slist)
-                elif p == 'bh': 
-                    mygrp.bhlist = my_indexes[my_ptype==ptype_ints[p]]-offset
-                    mygrp.nbh = len(mygrp.bhlist)
-                elif p == 'dust': 
-                    mygrp.dlist = my_indexes[my_ptype==ptype_ints[p]]-offset
-                    mygrp.ndust = len(mygrp.dlist)
-                elif p == 'dm': 
-                    mygrp.dmlist = my_indexes[my_ptype==ptype_ints[p]]-offset
-                    mygrp.ndm = len(mygrp.dmlist)
-                elif p == 'dm2': 
-                    mygrp.dm2list = my_indexes[my_ptype==ptype_ints[p]]-offset
-                    mygrp.ndm2 = len(mygrp.dm2list)
-                offset += self.nparttype[p]
+            mygrp._membership = self.membership
+            mygrp._membership_row = igrp
+            for p in counts:
+                setattr(mygrp, 'n%s' % p, int(counts[p][igrp]))  # ngas, nstar, ...
             if mygrp._valid:
                 mygrp.obj_type = self.obj_type
                 if parent is not None: 
@@ -238,6 +271,9 @@ class fof6d:
                     parent.obj.halo_list[ihalo].galaxy_index_list.append(ngrp)
                     ngrp += 1
                 grp_list.append(mygrp)
+        # hold the groups' properties as columns from here on
+        from caesar.catalogue import group_catalogue
+        group_catalogue(grp_list)
 
         if self.obj_type == 'halo': 
             self.obj.halo_list = grp_list
@@ -344,8 +380,8 @@ def setup_indexes(self,halo_indexes):
     # concatenate everything in the proper order and return
     return all_indexes
 
-def fof6d_halo(nparthalo,npart,pos,vel,minstars,Lbox,fof_LL,vel_LL,kerneltab):
-    ''' Routine to find galaxies within a given halo using fof6d '''
+def fof6d_halo(nparthalo,npart,pos,vel,minstars,Lbox,fof_LL,vel_LL,kerneltab,nproc=1):
+    ''' Routine to find galaxies within a given halo using fof6d, with nproc threads '''
 
     #initialize fof6d
     fof6d_tags = np.zeros(npart,dtype=np.int64)-1  # default is that no particles are in galaxies
@@ -367,7 +403,7 @@ def fof6d_halo(nparthalo,npart,pos,vel,minstars,Lbox,fof_LL,vel_LL,kerneltab):
     fof6d_results = [None]*len(groups)
     for igrp in range(len(groups)):
         if groups[igrp][1]-groups[igrp][0] < minstars: continue
-        fof6d_results[igrp] = fof6d_main(igrp,groups,mypos.T[groups[igrp][0]:groups[igrp][1]],myvel.T[groups[igrp][0]:groups[igrp][1]],kerneltab,0.,Lbox,minstars,fof_LL,vel_LL)
+        fof6d_results[igrp] = fof6d_main(igrp,groups,mypos.T[groups[igrp][0]:groups[igrp][1]],myvel.T[groups[igrp][0]:groups[igrp][1]],kerneltab,0.,Lbox,minstars,fof_LL,vel_LL,nproc=nproc)
 
     # insert galaxy IDs into particle lists
     nfof = 0
@@ -386,85 +422,32 @@ def fof6d_halo(nparthalo,npart,pos,vel,minstars,Lbox,fof_LL,vel_LL,kerneltab):
     # returns the group to which each particle belongs (-1 if not in group)
     return fof6d_tags  
 
-def fof6d_main(igrp,groups,poslist,vellist,kerneltab,t0,Lbox,mingrp,fof_LL,vel_LL=None,nfof=0):
+def fof6d_halo_range(nparthalo,istart,iend,pos,vel,minstars,Lbox,fof_LL,vel_LL,kerneltab):
+    ''' fof6d_halo on particles istart:iend of (memory-mapped) arrays shared by all halos '''
+    return fof6d_halo(nparthalo,iend-istart,pos[istart:iend],vel[istart:iend],minstars,Lbox,fof_LL,vel_LL,kerneltab)
+
+def fof6d_main(igrp,groups,poslist,vellist,kerneltab,t0,Lbox,mingrp,fof_LL,vel_LL=None,nfof=0,nproc=1):
+    from caesar.fof_funcs import fof6d_link
     # find neighbors of all particles within fof_LL
     istart = groups[igrp][0]  # starting particle index for group igrp
     iend = groups[igrp][1]
     nactive = iend-istart
     if nactive < mingrp: return [0,[]]
-    neigh = NearestNeighbors(radius=fof_LL)  # set up neighbor finder
-    neigh.fit(poslist)  # do neighbor finding
-    nlist = neigh.radius_neighbors(poslist)  # get neighbor properties (radii, indices)
-
-    # compute velocity criterion for neighbors, based on local velocity dispersion 
-    if vel_LL is not None:
-        LLinv = 1./fof_LL
-        sigma = np.zeros(nactive)
-        siglist = []  # list of boolean arrays storing whether crit is satisfied for each neighbor pair
-        # compute local velocity dispersion from neighbors
-        for i in range(nactive):
-            ngblist = nlist[1][i]  # list of indices of neighbors
-            rlist = nlist[0][i]  # list of radii of neighbors
-            # compute kernel-weighted velocity dispersion
-            wt = kernel(rlist*LLinv,kerneltab)
-            dv = np.linalg.norm(vellist[ngblist]-vellist[i],axis=1)
-            sigma[i] = np.sqrt(np.sum(wt*dv*dv)/np.sum(wt))
-            siglist.append((dv <= vel_LL*sigma[i]))
-    else:
-        # if velocity criterion not used, then all particles satisfy it by default
-        siglist = []  # list of boolean arrays storing whether vel disp crit is satisfied
-        for i in range(nactive):
-            ngbnum = len(nlist[1][i])
-            sigs = np.ones(ngbnum,dtype=bool)  # array of True's
-            siglist.append(sigs)
-
-    # determine counts within fof_LL, set up ordering of most dense to least
-    ncount = np.zeros(nactive,dtype=int)
-    for i in range(len(ncount)):
-        ncount[i] = len(nlist[1][i])  # count number of neighbors for each particle
-    dense_order = np.argsort(-ncount)  # find ordering of most dense to least
-
-    # main loop to do FOF
-    galind = np.zeros(nactive,dtype=int)-1
-    linked = []
-    galcount = 0
-    for ipart in range(nactive):
-        densest = dense_order[ipart]  # get next densest particle
-        galind_ngb = galind[nlist[1][densest]]  # indices of neighbors' galaxies
-        galind_ngb = np.where(siglist[densest],galind_ngb,-1)  # apply velocity criterion here
-        if len(galind_ngb[galind_ngb>=0]) > 0:  # if it already has neighbors (incl itself) in a galaxy...
-            galmin = np.unique(galind_ngb[galind_ngb>=0])  # find sorted, unique indices of neighbors' gals
-            galind[nlist[1][densest]] = min(galmin)  # put all neighbors in lowest-# galaxy
-            for i in range(1,len(galmin)):  # link all other galaxies to lowest
-                if linked[galmin[i]]==-1: 
-                    linked[galmin[i]] = min(galmin)  # link all other galaxies to lowest index one
-                else:
-                    linked[galmin[i]] = min(linked[galmin[i]],min(galmin))  # connect all other galaxies to lowest index
-        else:  # it has no neighbors in a galaxy, so create a new one
-            galind[nlist[1][densest]] = galcount  # put all neighbors in a new galaxy
-            linked.append(galcount) # new galaxy is linked to itself
-            galcount += 1
-
-    # handle linked galaxies by resetting indices of their particles to its linked galaxy
-    for i in range(galcount-1,-1,-1):
-        if linked[i] != i:
-            assert linked[i]<i,'Trouble: mis-ordered linking %d > %d'%(i,linked[i])
-            for j in range(iend-istart):
-                if galind[j] == i: galind[j] = linked[i]
+    # neighbor lists as CSR arrays from a kd-tree, then do the velocity criterion, the
+    # density-ordered linking and the resolution of linked galaxies in compiled code.
+    # As with the NearestNeighbors search this replaced, the tree is not periodic, so
+    # particles are not linked across the box edges.
+    tree = periodic_tree(poslist)
+    ngb_start,ngb_ind,ngb_r = ball_neighbors(tree, poslist, fof_LL, nproc)
+    galind,galcount = fof6d_link(ngb_start,ngb_ind,ngb_r,vellist,kerneltab,fof_LL,vel_LL,nproc)
 
     # assign indices of particles to FOF groups having more than mingrp particles
     pcount,bin_edges = np.histogram(galind,bins=galcount)  # count particles in each galaxy
-    for i in range(iend-istart):  # set indices of particles in groups with <mingrp members to -1
-        if pcount[galind[i]] < mingrp: galind[i] = -1  
-    if len(galind[galind>=0])==0: return 0,galind  # if there are no valid groups left, return
-    galind_unique = np.unique(galind[galind>=0])  # find unique groups
-    galind_inv = np.zeros(max(galind_unique)+1,dtype=int)
-    for i in range(len(galind_unique)):
-        galind_inv[galind_unique[i]] = i  # create mapping from original groups to unique set
-    for i in range(iend-istart): 
-        if galind[i]>=0: galind[i] = galind_inv[galind[i]] # re-assign group indices sequentially
-    galcount = max(galind)+1
-    #raw_input('press ENTER to continue')
+    galind[pcount[galind] < mingrp] = -1  # set indices of particles in groups with <mingrp members to -1
+    ingal = galind >= 0
+    if not np.any(ingal): return 0,galind  # if there are no valid groups left, return
+    galind_unique,galind[ingal] = np.unique(galind[ingal], return_inverse=True)  # re-assign group indices sequentially
+    galcount = len(galind_unique)
 
     '''
     # check: are there groups that are too large?
@@ -490,31 +473,30 @@ def fof6d_main(igrp,groups,poslist,vellist,kerneltab,t0,Lbox,mingrp,fof_LL,vel_L
 def fof_sorting(groups,pos,vel,haloID,pindex,fof_LL,Lbox,mingrp,idir):
     oldgroups = groups[:]  # stores the groups found from the previous sorting direction
     npart = len(pindex)
-    groups = [[0,npart]]  # (re-)initialize the group as containing all particles
-    grpcount = 0
-    for igrp in range(len(oldgroups)):  # loop over old groups, sort within each, find new groups
-        # sort particles within group in given direction
-        istart = oldgroups[igrp][0]  # starting particle index for group igrp
-        iend = oldgroups[igrp][1]
-        sort_parts(pos,vel,haloID,pindex,istart,iend,idir,'pos')  # sort group igrp in given direction
-        # create new groups by looking for breaks of dx[idir]>fof_LL between particle positions
-        oldpos = pos[idir][istart]
-        groups[grpcount][0] = istart  # set start of new group to be same as for old group
-        for i in range(istart,iend):
-            if periodic(pos[idir][i],oldpos,Lbox) > fof_LL or i == iend-1:  
-                groups[grpcount][1] = i  # set end of old group to be i
-                groups.append([i,i])  # add new group, starting at i; second index is a dummy that will be overwritten when the end of the group is found
-                grpcount += 1
-            oldpos = pos[idir][i]
-    assert grpcount>0,'fof6d : Found no groups or unable to separate groups via sorting; exiting. %d %d %d %d'%(idir,len(groups),len(oldgroups),npart)
+    for igrp in range(len(oldgroups)):  # loop over old groups, sort within each
+        sort_parts(pos,vel,haloID,pindex,oldgroups[igrp][0],oldgroups[igrp][1],idir,'pos')  # sort group igrp in given direction
+    # create new groups by looking for breaks of dx[idir]>fof_LL between particle positions
+    starts,ends = split_sorted_groups(oldgroups,pos[idir],fof_LL,Lbox)
+    assert len(starts)>0,'fof6d : Found no groups or unable to separate groups via sorting; exiting. %d %d %d %d'%(idir,len(starts),len(oldgroups),npart)
     # Remove groups that have less than mingrp particles (gas+star)
-    oldgroups = groups[:]
-    groups = []
-    for igrp in range(len(oldgroups)):
-        istart = oldgroups[igrp][0]  
-        iend = oldgroups[igrp][1]
-        if iend-istart >= mingrp: groups.append(oldgroups[igrp])
-    return groups
+    keep = ends-starts >= mingrp
+    return np.column_stack((starts[keep],ends[keep])).tolist()
+
+def split_sorted_groups(groups,x,fof_LL,Lbox):
+    ''' Split groups of particles, each already sorted along x, wherever neighbouring particles are
+    more than fof_LL apart (periodically), returning the start and end index of each piece.
+    As in the original particle-by-particle scan, the last particle of each group ends up in no piece. '''
+    starts = []
+    ends = []
+    for istart,iend in groups:
+        dx = np.diff(x[istart:iend-1])  # gaps before particles istart+1 ... iend-2
+        dx = np.where(dx > 0.5*Lbox, Lbox-dx, dx)  # periodic correction
+        breaks = istart + 1 + np.flatnonzero(dx > fof_LL)
+        starts.append(np.concatenate(([istart],breaks)))
+        ends.append(np.concatenate((breaks,[iend-1])))
+    if len(groups) == 0:
+        return np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64)
+    return np.concatenate(starts).astype(np.int64),np.concatenate(ends).astype(np.int64)
 
 # progress bar, from https://stackoverflow.com/questions/3160699/python-progress-bar
 def progress_bar(progress,barLength=10,t=None):
@@ -845,32 +827,13 @@ def sort_parts(pos,vel,haloID,pindex,istart,iend,idir0,key='pos'):
 
 def fof_sorting_old(groups,pos,vel,haloID,pindex,fof_LL,Lbox,idir,mingrp=16):
     oldgroups = groups[:]  # stores the groups found from the previous sorting direction
-    npart = len(pindex)
-    groups = [[0,npart]]  # (re-)initialize the group as containing all particles
-    grpcount = 0
-    for igrp in range(len(oldgroups)):  # loop over old groups, sort within each, find new groups
-        # sort particles within group in given direction
-        istart = oldgroups[igrp][0]  # starting particle index for group igrp
-        iend = oldgroups[igrp][1]
-        sort_parts(pos,vel,haloID,pindex,istart,iend,idir,'pos')  # sort group igrp in given direction
-        # create new groups by looking for breaks of dx[idir]>fof_LL between particle positions
-        oldpos = pos[idir][istart]
-        groups[grpcount][0] = istart  # set start of new group to be same as for old group
-        for i in range(istart,iend):
-            if periodic(pos[idir][i],oldpos,Lbox) > fof_LL or i == iend-1:  
-                groups[grpcount][1] = i  # set end of old group to be i
-                groups.append([i,i])  # add new group, starting at i; second index is a dummy that will be overwritten when the end of the group is found
-                grpcount += 1
-            oldpos = pos[idir][i]
-    #assert grpcount>0,'fof6d : Unable to separate groups via sorting; exiting.'
+    for igrp in range(len(oldgroups)):  # loop over old groups, sort within each
+        sort_parts(pos,vel,haloID,pindex,oldgroups[igrp][0],oldgroups[igrp][1],idir,'pos')  # sort group igrp in given direction
+    # create new groups by looking for breaks of dx[idir]>fof_LL between particle positions
+    starts,ends = split_sorted_groups(oldgroups,pos[idir],fof_LL,Lbox)
     # Remove groups that have less than mingrp particles (gas+star)
-    oldgroups = groups[:]
-    groups = []
-    for igrp in range(len(oldgroups)):
-        istart = oldgroups[igrp][0]  
-        iend = oldgroups[igrp][1]
-        if iend-istart >= mingrp: groups.append(oldgroups[igrp])
-    return groups
+    keep = ends-starts >= mingrp
+    return np.column_stack((starts[keep],ends[keep])).tolist()
 
 def fofrad_old(snap,nproc,mingrp,LL_factor,vel_LL):
     import pygadgetreader as pygr
@@ -0,0 +1,130 @@
+## SHELL FILES FOR DOCUMENTATION PURPOSES           ##
+## if you want to see the source please examine     ##
+## caesar/fof_funcs/fof_funcs.pyx                   ##
+
+
+def fof3d(
+        pos,
+        Lbox,
+        LL,
+        nproc=1,
+        minimum_count=8,
+        max_cells=512
+):
+    """Periodic 3D friends of friends.
+
+    Particles are binned onto a periodic cell-linked list with cells at
+    least one linking length wide, and every pair closer than LL is joined
+    in a lock-free union-find which is shared by all OpenMP threads.
+
+    Parameters
+    ----------
+    pos : np.ndarray
+        Nx3 array of particle positions.
+    Lbox : float
+        Periodic box size, in the same units as pos.
+    LL : float
+        Linking length, in the same units as pos.
+    nproc : int
+        Number of OpenMP threads to link with.
+    minimum_count : int
+        Groups with fewer members are returned as ungrouped.
+    max_cells : int
+        Maximum number of cells per dimension.
+
+    Returns
+    -------
+    group_tags : np.ndarray
+        Index of a member particle of the group each particle belongs to,
+        or -1 if the particle is *not* grouped.
+
+    """
+    pass
+
+
+def cell_ids(
+        pos,
+        ncell,
+        cellsize,
+        nproc=1
+):
+    """Cell of each particle on the periodic cell-linked list of :func:`fof3d`.
+
+    Parameters
+    ----------
+    pos : np.ndarray
+        Nx3 array of particle positions.
+    ncell : int
+        Number of cells per dimension.
+    cellsize : float
+        Width of a cell, in the same units as pos.
+    nproc : int
+        Number of OpenMP threads.
+
+    Returns
+    -------
+    cellid : np.ndarray
+        Index (ix*ncell + iy)*ncell + iz of each particle's cell, with
+        positions wrapped periodically.
+
+    """
+    pass
+
+
+def fof6d_link(
+        ngb_start,
+        ngb_ind,
+        ngb_r,
+        vel,
+        kerneltab,
+        fof_LL,
+        vel_LL=None,
+        nproc=1
+):
+    """Density-ordered 6D friends of friends within one coarse group.
+
+    Compiled core of :func:`fof6d.fof6d_main`.  Particles are visited from
+    most to least dense; each pulls all of its neighbours into the
+    lowest-numbered galaxy among its neighbours that pass the velocity
+    criterion, or starts a new galaxy.  Galaxies that meet are linked, and
+    links are followed to the lowest-numbered galaxy at the end.
+
+    Parameters
+    ----------
+    ngb_start : np.ndarray
+        CSR offsets of each particle's neighbour list into ngb_ind/ngb_r.
+    ngb_ind : np.ndarray
+        Indices of the neighbours (within fof_LL, including the particle
+        itself) of each particle.
+    ngb_r : np.ndarray
+        Distances to those neighbours.
+    vel : np.ndarray
+        Nx3 array of particle velocities; velocity differences are taken
+        in single precision, as np.linalg.norm did on the float32
+        velocities in the pure-Python fof6d_main.
+    kerneltab : np.ndarray
+        Kernel table from :func:`fof6d.kernel_table`.
+    fof_LL : float
+        Spatial linking length.
+    vel_LL : float or None
+        Velocity linking length in units of the kernel-weighted local
+        velocity dispersion; None disables the velocity criterion.
+    nproc : int
+        Number of OpenMP threads for the velocity criterion.
+
+    Returns
+    -------
+    galind : np.ndarray
+        Galaxy of each particle.
+    galcount : int
+        Number of galaxies created during the walk (before linking).
+
+    Notes
+    -----
+    The local velocity dispersions are summed in a different order from
+    np.sum, so they may differ from the pure-Python ones in the last bit;
+    only a neighbour pair whose velocity difference lies within that
+    rounding of the vel_LL threshold can be linked differently.
+
+    """
+    pass
@@ -0,0 +1,347 @@
+import numpy as np
+cimport numpy as np
+cimport cython
+from cython.parallel import prange
+from caesar.utils import memlog
+from caesar.property_manager import MY_DTYPE
+
+""" ================================================ """
+""" IMPORT C LIBRARY ROUTINES NEEDED FOR COMPUTATION """
+""" ================================================ """
+from libc.math cimport floor as c_floor, fabs as c_fabs, cbrt as c_cbrt
+cdef extern from "math.h":
+    float sqrtf(float x) nogil
+cdef extern from *:
+    """
+    static inline int fof_cas(long long *ptr, long long oldval, long long newval) {
+        return __sync_bool_compare_and_swap(ptr, oldval, newval);
+    }
+    """
+    int fof_cas(long long *ptr, long long oldval, long long newval) nogil
+
+""" ======================================================= """
+""" LOCK-FREE UNION-FIND, SAFE TO CALL FROM WITHIN A PRANGE """
+""" ======================================================= """
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline long long uf_find(long long *parent, long long i) noexcept nogil:
+    """ Returns the root of i, halving the path along the way.
+
+    Roots are only ever re-pointed to smaller roots (see uf_union), so a
+    stale read can only delay, never corrupt, the walk up the tree.
+    """
+    cdef long long p, gp
+    while True:
+        p = parent[i]
+        if p == i:
+            return i
+        gp = parent[p]
+        if gp != p:
+            fof_cas(&parent[i], p, gp)
+        i = gp
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline void uf_union(long long *parent, long long a, long long b) noexcept nogil:
+    """ Joins the sets containing a and b; the larger root is linked under the
+    smaller one, so every set ends up rooted at its smallest member.
+    """
+    cdef long long tmp
+    while True:
+        a = uf_find(parent, a)
+        b = uf_find(parent, b)
+        if a == b:
+            return
+        if a < b:
+            tmp = a
+            a = b
+            b = tmp
+        if fof_cas(&parent[a], a, b):
+            return
+
+""" ============================================================ """
+""" 3D FRIENDS-OF-FRIENDS ON A PERIODIC CELL-LINKED LIST         """
+""" ============================================================ """
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_cell_ids(float[:,:] pos, long long[:] cellid, int ncell, float cellsize, int nproc) noexcept nogil:
+    """ Assigns each particle the (periodically wrapped) index of its cell. """
+    cdef long long i, ix, iy, iz  # assigned in the loop body, so private to each thread
+    for i in prange(pos.shape[0], num_threads=nproc, schedule='static'):
+        ix = <long long>c_floor(pos[i,0] / cellsize) % ncell
+        iy = <long long>c_floor(pos[i,1] / cellsize) % ncell
+        iz = <long long>c_floor(pos[i,2] / cellsize) % ncell
+        if ix < 0:
+            ix = ix + ncell
+        if iy < 0:
+            iy = iy + ncell
+        if iz < 0:
+            iz = iz + ncell
+        cellid[i] = (ix * ncell + iy) * ncell + iz
+
+def cell_ids(pos, int ncell, float cellsize, int nproc=1):
+    """ Periodically wrapped cell index of each particle, as used by fof3d. """
+    cdef float[:,:] pos_view = np.ascontiguousarray(pos, dtype=MY_DTYPE)
+    cdef long long[:] cellid = np.empty(len(pos_view), dtype=np.int64)
+    nogil_cell_ids(pos_view, cellid, ncell, cellsize, nproc)
+    return np.asarray(cellid)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_link_cells(float[:,:] spos, long long[:] scell, long long[:] cell_start, long long[:] parent, int ncell, float Lbox, float LL, int nproc) noexcept nogil:
+    """ Links all pairs closer than LL.
+
+    spos: positions sorted by cell
+    scell: cell index of each sorted particle
+    cell_start: CSR offsets of each cell into spos
+    parent: union-find forest over sorted particles, initially parent[i]=i
+    ncell: number of cells per dimension (1 means brute force over the box)
+    """
+    cdef long long i, j, ic, jc, c0, c1, c2
+    cdef int d0, d1, d2, noff, ioff0
+    cdef float dx, dy, dz
+    cdef float halfbox = 0.5 * Lbox
+    cdef float LL2 = LL * LL
+    cdef long long *pparent = &parent[0]
+
+    if ncell >= 3:
+        noff = 3
+        ioff0 = -1
+    else:
+        noff = 1
+        ioff0 = 0
+
+    for i in prange(spos.shape[0], num_threads=nproc, schedule='dynamic', chunksize=1024):
+        ic = scell[i]
+        c0 = ic // (ncell * ncell)
+        c1 = (ic // ncell) % ncell
+        c2 = ic % ncell
+        for d0 in range(ioff0, ioff0 + noff):
+            for d1 in range(ioff0, ioff0 + noff):
+                for d2 in range(ioff0, ioff0 + noff):
+                    jc = ((((c0 + d0 + ncell) % ncell) * ncell + (c1 + d1 + ncell) % ncell) * ncell + (c2 + d2 + ncell) % ncell)
+                    # pairs are only examined from their lower sorted index
+                    if cell_start[jc+1] <= i + 1:
+                        continue
+                    for j in range(cell_start[jc], cell_start[jc+1]):
+                        if j <= i:
+                            continue
+                        dx = c_fabs(spos[i,0] - spos[j,0])
+                        if dx > halfbox:
+                            dx = Lbox - dx
+                        if dx > LL:
+                            continue
+                        dy = c_fabs(spos[i,1] - spos[j,1])
+                        if dy > halfbox:
+                            dy = Lbox - dy
+                        if dy > LL:
+                            continue
+                        dz = c_fabs(spos[i,2] - spos[j,2])
+                        if dz > halfbox:
+                            dz = Lbox - dz
+                        if dx*dx + dy*dy + dz*dz <= LL2:
+                            uf_union(pparent, i, j)
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_find_roots(long long[:] parent, long long[:] root, int nproc) noexcept nogil:
+    cdef long long i
+    cdef long long *pparent = &parent[0]
+    for i in prange(parent.shape[0], num_threads=nproc, schedule='static'):
+        root[i] = uf_find(pparent, i)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def fof3d(pos, double Lbox, double LL, int nproc=1, int minimum_count=8, int max_cells=512):
+    """ Periodic 3D friends-of-friends.
+
+    pos: Nx3 particle positions, in the same units as Lbox and LL
+    Lbox: periodic box size
+    LL: linking length
+    nproc: number of OpenMP threads
+    minimum_count: groups with fewer members are returned as ungrouped
+    max_cells: cap on the number of cells per dimension, to bound memory
+
+    Returns group_tags, the index of a member particle (the lowest-indexed
+    one after sorting by cell) for each particle, or -1 if it is ungrouped.
+    """
+    cdef long long npart = len(pos)
+    cdef int ncell
+    cdef float cellsize
+
+    group_tags = np.full(npart, -1, dtype=np.int64)
+    if npart == 0:
+        return group_tags
+    if nproc < 1:
+        nproc = 1
+
+    # cells are at least LL wide so only adjacent cells need to be searched;
+    # use no more cells than particles, since mostly-empty cells only cost memory
+    ncell = int(min(Lbox / LL, max_cells, max(c_cbrt(<double>npart), 1.)))
+    if ncell < 3:
+        ncell = 1
+    cellsize = Lbox / ncell
+
+    cdef float[:,:] pos_view = np.ascontiguousarray(pos, dtype=MY_DTYPE)
+    cdef long long[:] cellid = np.empty(npart, dtype=np.int64)
+    nogil_cell_ids(pos_view, cellid, ncell, cellsize, nproc)
+
+    sort_ind = np.argsort(cellid)
+    cdef long long[:] scell = np.asarray(cellid)[sort_ind]
+    cdef float[:,:] spos = np.asarray(pos_view)[sort_ind]
+    cdef long long[:] cell_start = np.append(0, np.cumsum(np.bincount(scell, minlength=ncell**3))).astype(np.int64)
+    del cellid
+
+    cdef long long[:] parent = np.arange(npart, dtype=np.int64)
+    cdef long long[:] root = np.empty(npart, dtype=np.int64)
+    memlog('fof3d: linking %d particles on %d^3 cells (nproc=%d)'%(npart,ncell,nproc))
+    with nogil:
+        nogil_link_cells(spos, scell, cell_start, parent, ncell, <float>Lbox, <float>LL, nproc)
+        nogil_find_roots(parent, root, nproc)
+
+    root_arr = np.asarray(root)
+    grouped = np.bincount(root_arr, minlength=npart)[root_arr] >= minimum_count
+    group_tags[sort_ind[grouped]] = sort_ind[root_arr[grouped]]
+
+    return group_tags
+
+""" ============================================================ """
+""" 6D FOF LINKING WITHIN A COARSE GROUP (CORE OF fof6d_main)     """
+""" ============================================================ """
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline float velocity_difference(float[:,:] vel, long long i, long long j) noexcept nogil:
+    """ |vel[j]-vel[i]| in single precision, rounding after each operation. """
+    cdef float d, dv2 = 0.
+    cdef int idim
+    for idim in range(3):
+        d = vel[j,idim] - vel[i,idim]
+        d = d * d
+        dv2 = dv2 + d
+    return sqrtf(dv2)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_velocity_criterion(long long[:] ngb_start, long long[:] ngb_ind, double[:] ngb_r, float[:,:] vel, double[:] kerneltab, double LLinv, double vel_LL, unsigned char[:] ngb_ok, int nproc) noexcept nogil:
+    """ Flags the neighbours of each particle whose velocity difference is
+    within vel_LL times the particle's kernel-weighted local velocity
+    dispersion.  Velocity differences are computed in single precision, as
+    np.linalg.norm did on the float32 velocities, and the dispersion sums
+    in double.
+    """
+    cdef long long i, k, j, itab
+    cdef int ntab = kerneltab.shape[0] - 1
+    cdef double wt, swt, swtdv2, sigma
+    cdef float dv
+    for i in prange(ngb_start.shape[0]-1, num_threads=nproc, schedule='dynamic', chunksize=64):
+        swt = 0.
+        swtdv2 = 0.
+        for k in range(ngb_start[i], ngb_start[i+1]):
+            j = ngb_ind[k]
+            itab = <long long>(ntab * ngb_r[k] * LLinv + 0.5)
+            wt = kerneltab[itab]
+            dv = velocity_difference(vel, i, j)
+            swt = swt + wt
+            swtdv2 = swtdv2 + wt * dv * dv
+        sigma = (swtdv2 / swt) ** 0.5
+        for k in range(ngb_start[i], ngb_start[i+1]):
+            ngb_ok[k] = velocity_difference(vel, i, ngb_ind[k]) <= vel_LL * sigma
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef long long nogil_density_walk(long long[:] ngb_start, long long[:] ngb_ind, unsigned char[:] ngb_ok, long long[:] dense_order, long long[:] galind, long long[:] linked) noexcept nogil:
+    """ Visits particles from most to least dense.  Each one pulls all its
+    neighbours into the lowest-numbered galaxy among its (velocity-allowed)
+    neighbours, recording that the other galaxies seen are linked to it, or
+    starts a new galaxy if none of them is in one yet.
+
+    Returns the number of galaxies created.
+    """
+    cdef long long ipart, densest, k, g, gmin
+    cdef long long galcount = 0
+    for ipart in range(dense_order.shape[0]):
+        densest = dense_order[ipart]
+        gmin = -1
+        for k in range(ngb_start[densest], ngb_start[densest+1]):
+            g = galind[ngb_ind[k]]
+            if ngb_ok[k] and g >= 0 and (gmin < 0 or g < gmin):
+                gmin = g
+        if gmin < 0:
+            gmin = galcount
+            linked[galcount] = galcount
+            galcount += 1
+        else:
+            for k in range(ngb_start[densest], ngb_start[densest+1]):
+                g = galind[ngb_ind[k]]
+                if ngb_ok[k] and g > gmin and linked[g] > gmin:
+                    linked[g] = gmin
+        for k in range(ngb_start[densest], ngb_start[densest+1]):
+            galind[ngb_ind[k]] = gmin
+    return galcount
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def fof6d_link(ngb_start, ngb_ind, ngb_r, vel, kerneltab, double fof_LL, vel_LL=None, int nproc=1):
+    """ Density-ordered 6D FOF linking of the particles of one coarse group.
+
+    ngb_start: CSR offsets of each particle's neighbours (within fof_LL,
+               including itself) into ngb_ind/ngb_r
+    ngb_ind: neighbour indices
+    ngb_r: neighbour distances
+    vel: Nx3 particle velocities
+    kerneltab: kernel table from fof6d.kernel_table
+    fof_LL: spatial linking length
+    vel_LL: velocity linking length in units of the local velocity
+            dispersion; None disables the velocity criterion
+    nproc: number of OpenMP threads for the velocity criterion
+
+    Returns galind, the galaxy of each particle after following links to
+    the lowest-numbered galaxy, and galcount, the number of galaxies that
+    were created during the walk.  Reproduces the linking of the original
+    pure-Python fof6d_main, up to last-bit differences in the summed local
+    velocity dispersions, which matter only for pairs at the threshold.
+    """
+    cdef long long[:] start_view = np.ascontiguousarray(ngb_start, dtype=np.int64)
+    cdef long long[:] ind_view = np.ascontiguousarray(ngb_ind, dtype=np.int64)
+    cdef long long nactive = start_view.shape[0] - 1
+    cdef long long i, galcount
+
+    ngb_ok = np.ones(ind_view.shape[0], dtype=np.uint8)
+    cdef unsigned char[:] ok_view = ngb_ok
+    cdef double[:] r_view
+    cdef float[:,:] vel_view
+    cdef double[:] ktab_view
+    cdef double vLL
+    if nproc < 1:
+        nproc = 1
+    if vel_LL is not None and ind_view.shape[0] > 0:
+        r_view = np.ascontiguousarray(ngb_r, dtype=np.float64)
+        vel_view = np.ascontiguousarray(vel, dtype=MY_DTYPE)
+        ktab_view = np.ascontiguousarray(kerneltab, dtype=np.float64)
+        vLL = vel_LL
+        with nogil:
+            nogil_velocity_criterion(start_view, ind_view, r_view, vel_view, ktab_view, 1./fof_LL, vLL, ok_view, nproc)
+
+    # densest first; same ordering as np.argsort(-ncount) in fof6d_main
+    ncount = np.diff(np.asarray(start_view))
+    cdef long long[:] dense_order = np.argsort(-ncount).astype(np.int64)
+    galind = np.full(nactive, -1, dtype=np.int64)
+    linked = np.empty(max(nactive, 1), dtype=np.int64)
+    cdef long long[:] galind_view = galind
+    cdef long long[:] linked_view = linked
+    with nogil:
+        galcount = nogil_density_walk(start_view, ind_view, ok_view, dense_order, galind_view, linked_view)
+
+    # each galaxy ends up in the galaxy its chain of links leads to; links
+    # always point to lower numbers, so resolve them in increasing order
+    with nogil:
+        for i in range(galcount):
+            if linked_view[i] != i:
+                linked_view[i] = linked_view[linked_view[i]]
+    galind = np.where(galind >= 0, linked[np.maximum(galind, 0)], -1)
+
+    return galind, galcount
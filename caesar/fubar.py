@@ -1,17 +1,14 @@
 import numpy as np
 import h5py
-from caesar.group import create_new_group, group_types
+from caesar.group import create_new_group, group_types, unbind_groups
 from caesar.property_manager import get_property, get_high_density_gas_indexes
 from caesar.property_manager import ptype_ints
 from caesar.utils import calculate_local_densities
-from caesar.fof6d import run_fof_6d
+from caesar.fof6d import run_fof_6d, find_bins
 
 import six
 from yt.funcs import mylog
 from yt.extern.tqdm import tqdm
-from yt.data_objects.octree_subset import YTPositionArray
-from yt.utilities.lib.contour_finding import ParticleContourTree
-from yt.geometry.selection_routines import AlwaysSelector
 
 
 """
@@ -35,7 +32,10 @@ class RSHalo(object):
 def fof(obj, positions, LL, group_type=None):
     """Friends of friends.
 
-    Perform 3D friends of friends via yt's ParticleContourTree method.
+    Perform 3D friends of friends, either with caesar's own parallel
+    cell-linked-list FOF (default) or via yt's ParticleContourTree
+    method.  The engine is chosen with the ``fof_engine`` kwarg
+    ('caesar' or 'yt'), and the number of threads with ``nproc``.
     
     Parameters
     ----------
@@ -54,26 +54,49 @@ def fof(obj, positions, LL, group_type=None):
         *not* grouped.
 
     """
-    ## TEMP RS WORK ##
-    # only use DM for now
-    #positions = positions[obj.data_manager.dmlist]
-    ##################
-    
-    #if group_type is not None:
-    #    mylog.info('Performing 3D FOF on %d positions for %s identification' %
-    #               (len(positions), group_type))
-                                                                             
+    fof_engine = 'caesar'
+    if 'fof_engine' in obj._kwargs and obj._kwargs['fof_engine'] is not None:
+        fof_engine = obj._kwargs['fof_engine']
+
+    if fof_engine == 'yt':
+        return fof_yt(obj, positions, LL)
+    elif fof_engine != 'caesar':
+        raise ValueError('fof_engine must be \'caesar\' or \'yt\', not %s' % fof_engine)
+
+    from caesar.fof_funcs import fof3d
+    Lbox = obj.simulation.boxsize.to(obj.units['length']).d
+    group_tags = fof3d(positions, Lbox, LL, nproc=get_nproc(obj))
+
+    return group_tags
+
+
+def fof_yt(obj, positions, LL):
+    """3D friends of friends via yt's (serial) ParticleContourTree method.
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Object containing the yt_dataset parameter.
+    positions : np.ndarray
+        Nx3 position array of the particles to perform the FOF on.
+    LL : float
+        Linking length for the FOF procedure.
+
+    Returns
+    -------
+    group_tags : np.ndarray
+        GroupID of each particle, -1 if it is *not* grouped.
+
+    """
+    from yt.data_objects.octree_subset import YTPositionArray
+    from yt.utilities.lib.contour_finding import ParticleContourTree
+    from yt.geometry.selection_routines import AlwaysSelector
+
     pct = ParticleContourTree(LL)
 
     pos = YTPositionArray(obj.yt_dataset.arr(positions, obj.units['length']))
-    #pos = YTPositionArray(pdata['pos'])
     ot  = pos.to_octree()
 
-    #ot  = [c._current_chunk.objs[0] for c in obj._dd.chunks([], 'all')][0]
-    #group_tags = pct.identify_contours(ot.oct_handler, ot.domain_ind, pdata['pos'],
-    #                                   np.arange(0,len(pdata['pos']),dtype=np.int64),
-    #                                   0,0)
-
     group_tags = pct.identify_contours(
         ot,
         ot.domain_ind(AlwaysSelector(None)),
@@ -247,6 +270,26 @@ def fof(obj, positions, LL, group_type=None):
 
 
 
+def get_nproc(obj):
+    """Number of processors requested via the ``nproc`` kwarg.
+
+    Follows the joblib convention: 0 means all cores, and negative
+    values mean all but (-nproc-1) cores.
+    """
+    if hasattr(obj, 'nproc'):
+        return obj.nproc
+    nproc = 1
+    if 'nproc' in obj._kwargs and obj._kwargs['nproc'] is not None:
+        nproc = int(obj._kwargs['nproc'])
+    if nproc <= 0:
+        import joblib
+        if nproc < 0:
+            nproc += joblib.cpu_count()+1
+        else:
+            nproc = joblib.cpu_count()
+    return nproc
+
+
 def get_ptypes(obj, group_type):
     """Unused function."""
     ptypes = ['dm','gas','star']
@@ -530,28 +573,28 @@ def fubar(obj, group_type, **kwargs):
         mylog.warning('group-type %s not recognized'%group_type)
 
 
-    tag_sort = np.argsort(fof_tags)
+    # sort particles by tag; each group's members are then a contiguous
+    # (CSR-style) slice of tag_sort, delimited by tag_bins
+    tag_sort = np.argsort(fof_tags, kind='stable')
+    tags_sorted = fof_tags[tag_sort]
+    nparts = len(fof_tags)
 
-    unique_groupIDs = np.unique(fof_tags)
     groupings = {}
-    for GroupID in unique_groupIDs:
-        if GroupID < 0: continue
-        groupings[GroupID] = create_new_group(obj, group_type)
+    if nparts > 0:
+        tag_bins = find_bins(tags_sorted, nparts)
+        for ibin in range(len(tag_bins)-1):
+            GroupID = tags_sorted[tag_bins[ibin]]
+            if GroupID < 0: continue
+            groupings[GroupID] = create_new_group(obj, group_type)
+            groupings[GroupID].global_indexes = tag_sort[tag_bins[ibin]:tag_bins[ibin+1]]
 
     if len(groupings) == 0:
         mylog.warning('No %s found!' % group_types[group_type])
         return
-    
-    tags = fof_tags
-        
-    nparts = len(tags)
-    for i in range(0,nparts):
-        index = tag_sort[i]
-        tag   = tags[index]
-        if tag < 0: continue
-        groupings[tag]._append_global_index(index)
-
-    if unbind: mylog.info('Unbinding %s' % group_types[group_type])
+
+    if unbind:
+        mylog.info('Unbinding %s' % group_types[group_type])
+        unbind_groups(obj, list(groupings.values()), nproc=get_nproc(obj))
 
     for v in tqdm(groupings.values(),
                   total=len(groupings),
@@ -1,6 +1,6 @@
 import numpy as np
 import h5py
-from caesar.group import create_new_group, group_types
+from caesar.group import create_new_group, group_types, plist_dict, collate_group_lists
 from caesar.property_manager import get_property, get_particles_for_FOF, get_high_density_gas_indexes
 from caesar.property_manager import ptype_ints
 from caesar.utils import calculate_local_densities
@@ -72,6 +72,9 @@ def fubar_halo(obj):
         mylog.warning('No valid halos found! Aborting member search')
         return  
     get_group_properties(halos,halos.obj.halo_list)  # compute halo properties
+    if 'so_masses' in obj._kwargs and obj._kwargs['so_masses']:
+        from caesar.spherical_overdensity import get_so_quantities
+        get_so_quantities(obj, halos.obj.halo_list, obj.nproc)  # SO masses from all particles, not just FOF members
 
     # Find galaxies, or load galaxy membership info
     if not obj.simulation.baryons_present:  # if no baryons, we're done
@@ -119,8 +122,6 @@ def fubar_halo(obj):
     return
 
 
-plist_dict = dict( gas='glist', star='slist', bh='bhlist', dust='dlist', dm='dmlist', dm2='dm2list')
-
 def reset_global_particle_IDs(obj):
     ''' Maps particle lists from currently loaded ID's to the ID's corresponding to the full snapshot '''
 
@@ -150,22 +151,21 @@ def reset_global_particle_IDs(obj):
             offset[ip+1] = offset[ip] + obj.simulation.ndm2
             obj.simulation.ndm2 = count
 
-    # reset lists
+    # reset lists: those held in a group membership are mapped all at once, any others group by group
     for group_type in obj.group_types:
-        group_list = 'obj.%s_list'%group_type
+        group_list = getattr(obj, '%s_list'%group_type)
         for ip,p in enumerate(obj.data_manager.ptypes):
             if not has_ptype(obj, p):
                 continue
-            for group in eval(group_list):
-                part_list = 'group.%s'%plist_dict[p]
-                mylist = eval(part_list)
-                mylist = obj.data_manager.indexes[mylist+offset[ip]]
-                if p == 'gas': group.glist = mylist
-                if p == 'star': group.slist = mylist
-                if p == 'bh': group.bhlist = mylist
-                if p == 'dust': group.dlist = mylist
-                if p == 'dm': group.dmlist = mylist
-                if p == 'dm2': group.dm2list = mylist
+            name = plist_dict[p]
+            memberships = {}
+            for group in group_list:
+                if '_%s'%name in group.__dict__ or getattr(group, '_membership', None) is None:
+                    setattr(group, name, obj.data_manager.indexes[getattr(group, name)+offset[ip]])
+                else:
+                    memberships[id(group._membership)] = group._membership
+            for membership in memberships.values():
+                membership.indexes[name] = obj.data_manager.indexes[membership.indexes[name]+offset[ip]]
 
     return
 
@@ -181,18 +181,14 @@ def load_global_lists(obj):
         dmlist = np.full(obj.simulation.ndm, -1, dtype=np.int32)
         dm2list = np.full(obj.simulation.ndm2, -1, dtype=np.int32)
 
-        group_list = 'obj.%s_list'%group_type
-        for group in eval(group_list):
-            for ip,p in enumerate(obj.data_manager.ptypes):
-                if not has_ptype(obj, p):
-                    continue
-                part_list = 'group.%s'%plist_dict[p]
-                if p == 'gas': glist[eval(part_list)] = group.GroupID
-                if p == 'star': slist[eval(part_list)] = group.GroupID
-                if p == 'bh': bhlist[eval(part_list)] = group.GroupID
-                if p == 'dust': dlist[eval(part_list)] = group.GroupID
-                if p == 'dm': dmlist[eval(part_list)] = group.GroupID
-                if p == 'dm2': dm2list[eval(part_list)] = group.GroupID
+        group_list = getattr(obj, '%s_list'%group_type)
+        group_ids = np.array([group.GroupID for group in group_list], dtype=np.int32)
+        global_lists = dict(gas=glist, star=slist, bh=bhlist, dust=dlist, dm=dmlist, dm2=dm2list)
+        for ip,p in enumerate(obj.data_manager.ptypes):
+            if not has_ptype(obj, p) or len(group_list) == 0:
+                continue
+            mylist, bins = collate_group_lists(group_list, plist_dict[p])
+            global_lists[p][mylist.astype(np.int64)] = np.repeat(group_ids, np.diff(bins))
 
         setattr(obj.global_particle_lists, '%s_glist'  % group_type, glist)
         setattr(obj.global_particle_lists, '%s_slist'  % group_type, slist)
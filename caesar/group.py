@@ -1,5 +1,6 @@
 import six
 import numpy as np
+from collections.abc import Mapping
 
 from caesar.property_manager import ptype_ints
 from caesar.group_funcs import get_periodic_r,get_virial_mr
@@ -14,6 +15,8 @@ group_types = dict(
     cloud='clouds'
 )
 
+plist_dict = dict( gas='glist', star='slist', bh='bhlist', dust='dlist', dm='dmlist', dm2='dm2list')
+
 list_types = dict(
     gas='gas',
     star='stellar',
@@ -28,7 +31,7 @@ info_blacklist = [
     '_slist','slist_end','slist_start',
     '_dmlist','dmlist_end','dmlist_start',
     '_dlist','dlist_end','dlist_start',
-    'obj', 'halo', 'galaxies','clouds', 'satellites',
+    'obj', 'halo', 'galaxies','clouds', 'satellites', '_membership', '_membership_row',
     'galaxy_index_list_end', 'galaxy_index_list_start','cloud_index_list_end','cloud_index_list_start']
 
 category_mapper = dict(
@@ -51,24 +54,70 @@ class GroupProperty(object):
     def __set__(self, instance, value):
         pass
 
-class GroupList(object):
-    """Class to hold particle/field index lists."""
+class MembershipList(object):
+    """Class to hold particle index lists.  A list assigned to the group
+    is kept on it; otherwise it is a view into the group's
+    :class:`GroupMembership`, if it has one."""
     def __init__(self, name):
         self.name = name
+    def _from_membership(self, instance):
+        membership = getattr(instance, '_membership', None)
+        if membership is None or self.name not in membership.offsets:
+            return None
+        return membership.get(self.name, instance._membership_row)
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if '_%s' % self.name in instance.__dict__:
+            return instance.__dict__['_%s' % self.name]
+        mylist = self._from_membership(instance)
+        if mylist is None:
+            raise AttributeError(self.name)
+        return mylist
+    def __set__(self, instance, value):
+        setattr(instance, '_%s' % self.name, value)
+    def __delete__(self, instance):
+        instance.__dict__.pop('_%s' % self.name, None)
+
+class GroupList(MembershipList):
+    """Class to hold particle/field index lists, restored from the
+    caesar file when neither assigned nor in a membership."""
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if '_%s' % self.name not in instance.__dict__:
+            mylist = self._from_membership(instance)
+            if mylist is not None:
+                return mylist
         if not hasattr(instance, '_%s' % self.name) or \
            isinstance(getattr(instance, '_%s' % self.name), int):
             from caesar.loader import restore_single_list
             restore_single_list(instance.obj, instance, self.name)
         return getattr(instance, '_%s' % self.name)
-    def __set__(self, instance, value):
-        setattr(instance, '_%s' % self.name, value)
 
 
 class Group(object):
-    """Parent class for halo and galaxy and halo objects."""
+    """Parent class for halo and galaxy and halo objects.
+
+    Once attached to a :class:`catalogue.Catalogue`, a group holds only
+    its catalogue and row: its properties (``pos``, ``sfr``, ...) and
+    dicts of properties (``masses``, ``radii``, ...) are read from and
+    written to the catalogue columns.  Anything that does not fit a
+    column, such as index lists and links to other groups, is kept on
+    the group itself, in its ``__dict__``: after member_search that is
+    about 0.3 kB of the 1.7 kB a galaxy takes with its catalogue row,
+    against 59 kB with per-group quantities.  Copying or pickling a
+    group gives a detached one holding its own values, as before it
+    was attached."""
+    __slots__ = ('obj', '_catalogue', '_row', '_membership', '_membership_row', '__dict__')
+
     glist = GroupList('glist')
     slist = GroupList('slist')    
+    dmlist = MembershipList('dmlist')
+    dm2list = MembershipList('dm2list')
+    bhlist = MembershipList('bhlist')
+    dlist = MembershipList('dlist')
+    global_indexes = MembershipList('global_indexes')
 
     mass        = GroupProperty(category_mapper['mass'],   'mass')
     radius      = GroupProperty(category_mapper['radius'], 'radius')
@@ -77,14 +126,98 @@ class Group(object):
     metallicity = GroupProperty(category_mapper['metallicity'], 'metallicity')
     
     def __init__(self,obj):
+        object.__setattr__(self, '_catalogue', None)
         self.obj = obj
 
-        self.masses = {}
-        self.radii = {} 
-        self.temperatures = {}
-        self.velocity_dispersions = {}
-        self.rotation = {}
-        self.virial_quantities = {}
+    def _attach(self, catalogue, row):
+        """Makes row of catalogue hold this group's properties."""
+        object.__setattr__(self, '_catalogue', catalogue)
+        object.__setattr__(self, '_row', row)
+
+    def _get_catalogue(self):
+        """The catalogue, or None if detached or not initialised yet
+        (e.g. while being copied or unpickled)."""
+        try:
+            return object.__getattribute__(self, '_catalogue')
+        except AttributeError:
+            return None
+
+    def __getstate__(self):
+        # the catalogue is not copied: the values of this row are
+        # materialised, with dicts of properties as plain dicts
+        from caesar.catalogue import ColumnDict
+        state = {}
+        for name, value in self._attributes().items():
+            state[name] = dict(value) if isinstance(value, ColumnDict) else value
+        slots = {}
+        for name in ('obj', '_membership', '_membership_row'):
+            try:
+                slots[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return state, slots
+
+    def __setstate__(self, state):
+        state, slots = state
+        object.__setattr__(self, '_catalogue', None)
+        for name, value in slots.items():
+            object.__setattr__(self, name, value)
+        self.__dict__.update(state)
+
+    def __getattr__(self, name):
+        # only reached when normal lookup fails: properties held in the
+        # catalogue, and dicts of properties not set yet
+        from caesar.catalogue import group_dicts
+        if name.startswith('__') or name in Group.__slots__:
+            raise AttributeError(name)
+        catalogue = self._get_catalogue()
+        if catalogue is not None:
+            if catalogue.has(self._row, name):
+                return catalogue.get(self._row, name)
+            if name in catalogue.dicts or name in group_dicts:
+                return catalogue.view(self._row, name)
+        elif name in group_dicts:
+            return self.__dict__.setdefault(name, {})
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def __setattr__(self, name, value):
+        catalogue = self._get_catalogue()
+        if catalogue is not None and name not in self.__dict__ and name not in Group.__slots__:
+            from caesar.catalogue import group_dicts
+            if name in catalogue.dicts or name in group_dicts:
+                if isinstance(value, Mapping):
+                    catalogue.view(self._row, name).replace(value)
+                    return
+                catalogue.view(self._row, name).clear()
+            elif name in catalogue.data:
+                if catalogue.set(self._row, name, value):
+                    return
+                catalogue.discard(self._row, name)
+            catalogue.shadowed.add(name)
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        catalogue = self._get_catalogue()
+        if catalogue is not None and name not in self.__dict__ and name not in Group.__slots__:
+            if catalogue.has(self._row, name):
+                catalogue.discard(self._row, name)
+                return
+            if name in catalogue.dicts:
+                catalogue.view(self._row, name).clear()
+                return
+        object.__delattr__(self, name)
+
+    def _attributes(self):
+        """Attributes of this group, including those held in its catalogue."""
+        attributes = dict(self.__dict__)
+        catalogue = self._get_catalogue()
+        if catalogue is not None:
+            for name in catalogue.attributes(self._row):
+                attributes.setdefault(name, catalogue.get(self._row, name))
+            for name in catalogue.dicts:
+                attributes.setdefault(name, catalogue.view(self._row, name))
+        return attributes
+
     def _append_global_index(self, i):
         if not hasattr(self, 'global_indexes'):
             self.global_indexes = []
@@ -286,56 +419,19 @@ class Group(object):
     """
 
     def _unbind(self):
-        """Iterative procedure to unbind objects."""
+        """Iterative procedure to unbind objects; see :func:`unbind_groups`.
+        Does nothing if the group was already unbound with the others."""
         if not getattr(self.obj.simulation, 'unbind_%s' %
                        group_types[self.obj_type]):
             return
+        if hasattr(self, 'unbound_indexes'):
+            return
 
-        if not hasattr(self, 'unbound_indexes'):
-            self.unbound_indexes = {
-                ptype_ints['gas']:[],
-                ptype_ints['star']:[],
-                ptype_ints['dm']:[],
-                ptype_ints['bh']:[],
-                ptype_ints['dust']:[],
-            }
-        if not hasattr(self, 'unbind_iterations'):
-            self.unbind_iterations = 0        
-        self.unbind_iterations += 1
-        
-        cmpos = (self.pos.to('kpc')).d
-        ppos  = self.obj.yt_dataset.arr(self.obj.data_manager.pos[self.global_indexes], self.obj.units['length'])
-        ppos  = (ppos.to('kpc')).d
-        cmvel = (self.vel.to('kpc/s')).d
-        pvels = self.obj.yt_dataset.arr(self.obj.data_manager.vel[self.global_indexes], self.obj.units['velocity'])
-        pvels = (pvels.to('kpc/s')).d
-        mass  = self.obj.yt_dataset.arr(self.obj.data_manager.mass[self.global_indexes], self.obj.units['mass'])
-        mass  = (mass.to('Msun')).d
-
-        init_mass = (self.masses['total'].to('Msun')).d
-
-        r = np.empty(len(ppos), dtype=np.float64)
-        get_periodic_r(self.obj.simulation.boxsize.d, cmpos, ppos, r)
-
-        v2 = ( (pvels[:,0] - cmvel[0])**2 +
-               (pvels[:,1] - cmvel[1])**2 +
-               (pvels[:,2] - cmvel[2])**2 )
-        
-        energy = -(mass * self.obj.simulation.G.d * (init_mass - mass) / r) + (0.5 * mass * v2)
-
-        positive = np.where(energy > 0)[0]
-        if len(positive) > 0:
-            positive = positive[::-1]
-            for i in positive:
-                global_index = self.global_indexes[i]
-                self.unbound_indexes[self.obj.data_manager.ptype[global_index]].append(self.obj.data_manager.index[global_index])
-                del self.global_indexes[i]
-
-            self._assign_local_data()                        
-            if not self._valid: return            
-            self._calculate_total_mass()
-            self._calculate_center_of_mass_quantities()
-            self._unbind()
+        unbind_groups(self.obj, [self])
+        self._assign_local_data()
+        if not self._valid: return
+        self._calculate_total_mass()
+        self._calculate_center_of_mass_quantities()
 
     def _calculate_gas_quantities(self):
         """Calculate gas quantities: SFR/Metallicity/Temperature."""
@@ -647,9 +743,9 @@ class Group(object):
     def info(self):
         """Method to quickly print out object attributes."""
         pdict = {}
-        for k,v in six.iteritems(self.__dict__):
+        for k,v in six.iteritems(self._attributes()):
             if k in info_blacklist: continue
-            pdict[k] = v
+            pdict[k] = dict(v) if isinstance(v, Mapping) else v
         from pprint import pprint
         pprint(pdict)
         pdict = None
@@ -683,7 +779,7 @@ class Group(object):
         from yt.funcs import mylog
         from caesar.zoom_funcs import construct_lowres_tree
 
-        construct_lowres_tree(self, lowres)
+        key, builder = construct_lowres_tree(self, lowres)
 
         if self.obj_type == 'halo':
             halo = self
@@ -696,9 +792,8 @@ class Group(object):
         
         r = halo.radii['virial'].d * search_factor
 
-        result  = self.obj._lowres['TREE'].query_ball_point(halo.pos.d, r)
-        ncontam = len(result)
-        lrmass  = np.sum(self.obj._lowres['MASS'][result])
+        ncontam = self.obj.spatial_index.count(key, builder, halo.pos.d, r)
+        lrmass  = self.obj.spatial_index.sum_within(key, builder, halo.pos.d, r)[0]
 
         self.contamination = lrmass / halo.masses['total'].d
         
@@ -715,6 +810,7 @@ class Group(object):
             
 class Galaxy(Group):
     """Galaxy class which has the central boolean."""
+    __slots__ = ()
     obj_type = 'galaxy'    
     def __init__(self,obj):
         super(Galaxy, self).__init__(obj)
@@ -725,6 +821,7 @@ class Galaxy(Group):
         
 class Halo(Group):
     """Halo class which has the dmlist attribute, and child boolean."""
+    __slots__ = ()
     obj_type = 'halo'
     dmlist   = GroupList('dmlist')
     def __init__(self,obj):
@@ -737,6 +834,7 @@ class Halo(Group):
 
 class Cloud(Group):
     """Cloud class which has the central boolean."""
+    __slots__ = ()
     obj_type = 'cloud'    
     def __init__(self,obj):
         super(Cloud, self).__init__(obj)
@@ -807,29 +905,231 @@ def get_group_properties(self,grp_list):
     return
 
 def sort_groups(grp_list,sort_key):
-    grp_list.sort(key = lambda x: x.masses[sort_key], reverse=True)
-    for i in range(0,len(grp_list)):
-        grp_list[i].GroupID = i
+    # sort by descending masses[sort_key], keeping the order of equal masses, and renumber;
+    # the catalogue rows follow the groups
+    from caesar.catalogue import group_catalogue
+    if len(grp_list) == 0:
+        return
+    catalogue = group_catalogue(grp_list)
+    if catalogue.present('masses', sort_key).all():
+        order = np.argsort(-catalogue.column('masses', sort_key).d, kind='stable')
+    else:
+        order = sorted(range(len(grp_list)), key=lambda i: grp_list[i].masses[sort_key], reverse=True)
+    grp_list[:] = [grp_list[i] for i in order]
+    catalogue.reorder(grp_list, np.asarray(order, dtype=np.int64))
+    catalogue.set_column('GroupID', np.arange(len(grp_list)))
     return
 
+class GroupMembership(object):
+    """Particle membership of a set of groups, in compressed sparse row form.
+
+    For 'global_indexes' and the index list of each particle type present
+    ('glist', 'slist', ...), indexes[name] holds the lists of all groups
+    concatenated, and row i's list is
+    indexes[name][offsets[name][i]:offsets[name][i+1]].  Groups keep a
+    reference to this and their row, and see their lists as views into it.
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Main caesar object.
+    pid_sorted : np.ndarray
+        Indexes into the data_manager particle arrays, ordered by group.
+    bins : np.ndarray
+        Starting index of each row within pid_sorted, plus its length.
+    nparttype : dict
+        Number of particles of each type in the data_manager arrays.
+
+    """
+    def __init__(self, obj, pid_sorted, bins, nparttype):
+        from caesar.property_manager import has_ptype
+        self.offsets = dict(global_indexes=np.asarray(bins, dtype=np.int64))
+        self.indexes = dict(global_indexes=pid_sorted)
+        ptype = obj.data_manager.ptype[pid_sorted]
+        offset = 0
+        for p in obj.data_manager.ptypes:
+            if not has_ptype(obj, p): continue
+            select = ptype == ptype_ints[p]
+            # per-type lists index the type's own particles, which follow those of earlier types
+            self.indexes[plist_dict[p]] = pid_sorted[select] - offset
+            self.offsets[plist_dict[p]] = np.append(0, np.cumsum(select))[self.offsets['global_indexes']]
+            offset += nparttype[p]
+
+    def get(self, name, row):
+        """Index list name of row, as a view."""
+        return self.indexes[name][self.offsets[name][row]:self.offsets[name][row+1]]
+
+    def counts(self, name):
+        """Length of index list name of every row."""
+        return np.diff(self.offsets[name])
+
+    def gather(self, name, rows):
+        """Index lists name of rows concatenated, and their bins."""
+        return gather_ranges(self.indexes[name], self.offsets[name][rows], self.offsets[name][np.asarray(rows)+1])
+
+
+def gather_ranges(data, starts, ends):
+    """Concatenates data[starts[i]:ends[i]] over i, without a Python loop.
+    Returns the result and the starting index of each range within it,
+    with the total length appended."""
+    lengths = np.asarray(ends, dtype=np.int64) - np.asarray(starts, dtype=np.int64)
+    bins = np.zeros(len(lengths)+1, dtype=np.int64)
+    np.cumsum(lengths, out=bins[1:])
+    if len(lengths) > 0 and np.all(starts[1:] == ends[:-1]):  # contiguous, e.g. rows in order
+        return data[starts[0]:ends[-1]], bins
+    index = np.repeat(np.asarray(starts, dtype=np.int64) - bins[:-1], lengths) + np.arange(bins[-1])
+    return data[index], bins
+
+def collate_group_lists(grp_list, name):
+    """Concatenates index list name (e.g. 'glist', 'global_indexes') of the
+    groups in grp_list.  Returns the concatenated lists and the starting
+    index of each group's list within it, with the total length appended.
+
+    Groups that all view the same :class:`GroupMembership` are gathered
+    from it directly; otherwise each group's list is fetched in turn."""
+    membership = getattr(grp_list[0], '_membership', None) if len(grp_list) > 0 else None
+    if membership is not None and name in membership.offsets and \
+       all(getattr(g, '_membership', None) is membership and '_%s' % name not in g.__dict__ for g in grp_list):
+        rows = np.array([g._membership_row for g in grp_list], dtype=np.int64)
+        return membership.gather(name, rows)
+    lists = [getattr(g, name) for g in grp_list]
+    bins = np.zeros(len(lists)+1, dtype=np.int64)
+    np.cumsum([len(l) for l in lists], out=bins[1:])
+    pieces = [np.asarray(l) for l in lists if len(l) > 0]
+    if len(pieces) == 0:
+        return np.zeros(0, dtype=np.int64), bins
+    return np.concatenate(pieces), bins
+
 def collate_group_ids(grp_list,part_type,ntot):
     # Auxiliary function to collate individual group lists for given particle type into a single
     # list grpids for cython processing.  Records each group's range within grpids in gid_bins.
-    from caesar.fof6d import find_bins
     if part_type == 'all': suffix = 'global_indexes'
-    elif part_type == 'gas': suffix = 'glist'
-    elif part_type == 'star': suffix = 'slist'
-    elif part_type == 'bh': suffix = 'bhlist'
-    elif part_type == 'dm': suffix = 'dmlist'
+    else: suffix = plist_dict[part_type]
     ngroup = len(grp_list)
+    mylist, gid_bins = collate_group_lists(grp_list, suffix)
     grpids = np.zeros(ntot,dtype=np.int64)
-    gid_bins = np.zeros(ngroup+1,dtype=np.int64)
-    i0 = 0
-    for igrp in range(ngroup):
-        mylist = 'grp_list[igrp].'+suffix
-        i1 = i0 + len(eval(mylist))
-        gid_bins[igrp+1] = i1
-        grpids[i0:i1] = eval(mylist)
-        i0 = i1
+    grpids[:len(mylist)] = mylist
 
     return ngroup, grpids, gid_bins
+
+def _gravity_units(obj):
+    """Factors converting code length, velocity and mass units to kpc, km/s
+    and Msun, and G in those units, in which energies are computed."""
+    lfac = obj.yt_dataset.quan(1., obj.units['length']).to('kpc').d
+    vfac = obj.yt_dataset.quan(1., obj.units['velocity']).to('km/s').d
+    mfac = obj.yt_dataset.quan(1., obj.units['mass']).to('Msun').d
+    G = float(obj.simulation.G.to('kpc*km**2/(Msun*s**2)').d)
+    return lfac, vfac, mfac, G
+
+def group_potential(obj, ids, bins, nproc=1):
+    """Gravitational potential of grouped particles, for snapshots without one.
+
+    The potential of each particle is summed over the other members of its
+    group (directly for small groups, with a Barnes-Hut octree for large
+    ones), in km**2/s**2 like the snapshot Potential field.  Only the
+    minimum-potential centre is taken from it, so particles outside the
+    group are ignored.  A Plummer softening (in obj.units['length']) can be
+    set with the ``potential_softening`` kwarg (default 0).
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Main caesar object.
+    ids : np.ndarray
+        Indexes into obj.data_manager of the particles, ordered by group.
+    bins : np.ndarray
+        Starting index of each group within ids, plus the total count.
+    nproc : int
+        Number of OpenMP threads.
+
+    Returns
+    -------
+    np.ndarray
+        Potential of each particle in ids.
+
+    """
+    from caesar.group_funcs import potential_kernel
+    from caesar.property_manager import MY_DTYPE
+    eps = 0.
+    if 'potential_softening' in obj._kwargs:
+        eps = float(obj._kwargs['potential_softening'])
+
+    lfac, vfac, mfac, G = _gravity_units(obj)
+    return potential_kernel(
+        np.asarray(bins, dtype=np.int64),
+        np.asarray(obj.data_manager.pos[ids]*lfac, dtype=MY_DTYPE),
+        np.asarray(obj.data_manager.mass[ids]*mfac, dtype=MY_DTYPE),
+        float(obj.simulation.boxsize.to('kpc').d),
+        G,
+        eps*lfac,
+        nproc)
+
+def unbind_groups(obj, grp_list, nproc=1):
+    """Gravitationally unbinds all groups in grp_list in one compiled pass.
+
+    Each group's particles are iteratively removed while they have positive
+    energy: the potential is summed over the group's other bound particles
+    (directly for small groups, with a Barnes-Hut octree for large ones), and
+    the kinetic energy is taken relative to their centre-of-mass velocity.
+    The number of iterations and a Plummer softening (in obj.units['length'])
+    can be set with the ``unbind_iterations`` (default 10) and
+    ``unbind_softening`` (default 0) kwargs.
+
+    Sets global_indexes of each group to its bound particles, unbound_indexes
+    to a dict of the indexes of its unbound particles for each ptype, and
+    unbind_iterations.  The per-type lists are left for _assign_local_data.
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Main caesar object.
+    grp_list : list
+        Groups (Halo/Galaxy/Cloud) to unbind.
+    nproc : int
+        Number of OpenMP threads.
+
+    """
+    from caesar.group_funcs import unbind_kernel
+    from caesar.property_manager import MY_DTYPE
+    from caesar.utils import memlog
+    if len(grp_list) == 0:
+        return
+
+    n_iter = 10
+    if 'unbind_iterations' in obj._kwargs:
+        n_iter = int(obj._kwargs['unbind_iterations'])
+    eps = 0.
+    if 'unbind_softening' in obj._kwargs:
+        eps = float(obj._kwargs['unbind_softening'])
+
+    lfac, vfac, mfac, G = _gravity_units(obj)
+    ids, bins = collate_group_lists(grp_list, 'global_indexes')
+    ids = np.asarray(ids, dtype=np.int64)
+    bound, niter = unbind_kernel(
+        bins,
+        np.asarray(obj.data_manager.pos[ids]*lfac, dtype=MY_DTYPE),
+        np.asarray(obj.data_manager.vel[ids]*vfac, dtype=MY_DTYPE),
+        np.asarray(obj.data_manager.mass[ids]*mfac, dtype=MY_DTYPE),
+        float(obj.simulation.boxsize.to('kpc').d),
+        G,
+        eps*lfac,
+        n_iter,
+        nproc)
+    bound = bound.astype(bool)
+
+    # bound and unbound particles of group ig are slices of these
+    kept = ids[bound]
+    kept_bins = np.append(0, np.cumsum(bound))[bins]
+    lost = ids[~bound]
+    lost_bins = np.append(0, np.cumsum(~bound))[bins]
+    lost_ptype = obj.data_manager.ptype[lost]
+    lost_indexes = obj.data_manager.indexes[lost]
+    for ig, group in enumerate(grp_list):
+        group.global_indexes = kept[kept_bins[ig]:kept_bins[ig+1]]
+        ptype = lost_ptype[lost_bins[ig]:lost_bins[ig+1]]
+        indexes = lost_indexes[lost_bins[ig]:lost_bins[ig+1]]
+        group.unbound_indexes = {}
+        for p in ['gas', 'star', 'dm', 'bh', 'dust']:
+            group.unbound_indexes[ptype_ints[p]] = indexes[ptype == ptype_ints[p]]
+        group.unbind_iterations = int(niter[ig])
+    memlog('Unbound %d of %d particles in %d %s' % (len(lost), len(ids), len(grp_list), group_types[grp_list[0].obj_type]))
@@ -136,3 +136,180 @@ def get_full_mass_radius(
 
     """
     pass
+
+
+def group_overall_kernel(
+        hid_bins,
+        pos,
+        vel,
+        mass,
+        pot,
+        ptype,
+        group_ptypes,
+        Densities,
+        Lbox,
+        gtflag,
+        use_pot,
+        my_nproc,
+        big_npart=0,
+        radial_method='sort'
+):
+    """Compute the overall properties of a set of groups.
+
+    Compiled core of get_group_overall_properties.  Groups are spread
+    over OpenMP threads, each of which sorts particles by radius in its
+    own scratch buffer.
+
+    Parameters
+    ----------
+    hid_bins : np.ndarray
+        Starting index of each group's particles, plus the total count.
+    pos, vel, mass, pot, ptype : np.ndarray
+        Particle data, ordered by group.
+    group_ptypes : np.ndarray
+        Particle type integers present in the dataset.
+    Densities : np.ndarray
+        Overdensities for virial quantities, in ascending order.
+    Lbox : float
+        Periodic box size, in units of pos.
+    gtflag : int
+        1 for halos, 2 for galaxies, 3 for clouds.
+    use_pot : bool
+        Take halo radial quantities around the minimum potential.
+    my_nproc : int
+        Number of OpenMP threads.
+    big_npart : int
+        Groups with more particles than this are done first, each by all
+        threads together; 0 picks a size from the particle total.
+    radial_method : str
+        ``'sort'`` sorts every group's particles by radius.  ``'select'``
+        bins them into radius buckets and sorts only the buckets holding
+        the mass and virial radii, in expected linear time; the radii are
+        the same, other quantities differ only by rounding.
+
+    Returns
+    -------
+    tuple of np.ndarray
+        grp_mtot, grp_mass, grp_count, grp_pos, grp_vel, grp_minpotpos,
+        grp_minpotvel, grp_R20, grp_Rhalf, grp_R80, grp_vdisp, grp_L,
+        grp_mvir, grp_rvir
+
+    """
+    pass
+
+
+def unbind_kernel(
+        hid_bins,
+        pos,
+        vel,
+        mass,
+        Lbox,
+        G,
+        eps,
+        n_iter,
+        my_nproc,
+        direct_npart=1000,
+        big_npart=0,
+        theta=0.5
+):
+    """Iterative gravitational unbinding of every group.
+
+    Compiled core of :func:`caesar.group.unbind_groups`.  Each pass finds
+    the potential of every remaining member (direct sum for small groups,
+    a Barnes-Hut octree walk for larger ones) and drops particles whose
+    energy relative to the group's centre of mass velocity is positive.
+    Groups stop after n_iter passes, or earlier once nothing is removed.
+
+    Parameters
+    ----------
+    hid_bins : np.ndarray
+        Starting index of each group's particles, plus the total count.
+    pos, vel, mass : np.ndarray
+        Particle data, ordered by group, in kpc, km/s and Msun.
+    Lbox : float
+        Periodic box size, in units of pos.
+    G : float
+        Gravitational constant in kpc (km/s)**2 / Msun.
+    eps : float
+        Plummer softening length, in units of pos.
+    n_iter : int
+        Maximum number of unbinding passes per group.
+    my_nproc : int
+        Number of OpenMP threads.
+    direct_npart : int
+        Groups with at most this many members use the direct sum.
+    big_npart : int
+        Groups with more particles than this are done first, each by all
+        threads together; 0 picks a size from the particle total.
+    theta : float
+        Barnes-Hut opening angle.
+
+    Returns
+    -------
+    bound : np.ndarray
+        1 for particles still bound at the end, 0 otherwise.
+    niter : np.ndarray
+        Number of passes taken by each group.
+
+    Raises
+    ------
+    MemoryError
+        If the buffers or octree of a group could not be allocated.
+
+    """
+    pass
+
+
+def potential_kernel(
+        hid_bins,
+        pos,
+        mass,
+        Lbox,
+        G,
+        eps,
+        my_nproc,
+        direct_npart=1000,
+        big_npart=0,
+        theta=0.5
+):
+    """Gravitational potential of each group's particles from its members.
+
+    Compiled core of :func:`caesar.group.group_potential`, used when the
+    snapshot has no potential.  Small groups are summed directly, larger
+    ones with a Barnes-Hut octree walk; groups are spread over OpenMP
+    threads as in :func:`unbind_kernel`.
+
+    Parameters
+    ----------
+    hid_bins : np.ndarray
+        Starting index of each group's particles, plus the total count.
+    pos, mass : np.ndarray
+        Particle data, ordered by group, in kpc and Msun.
+    Lbox : float
+        Periodic box size, in units of pos.
+    G : float
+        Gravitational constant in kpc (km/s)**2 / Msun.
+    eps : float
+        Plummer softening length, in units of pos.
+    my_nproc : int
+        Number of OpenMP threads.
+    direct_npart : int
+        Groups with at most this many members use the direct sum.
+    big_npart : int
+        Groups with more particles than this are done first, each by all
+        threads together; 0 picks a size from the particle total.
+    theta : float
+        Barnes-Hut opening angle.
+
+    Returns
+    -------
+    np.ndarray
+        Potential of every particle, in (km/s)**2, ordered like pos.
+
+    Raises
+    ------
+    MemoryError
+        If the buffers or octree of a group could not be allocated.
+
+    """
+    pass
@@ -12,8 +12,9 @@ from caesar.property_manager import MY_DTYPE
 """ IMPORT C LIBRARY ROUTINES NEEDED FOR COMPUTATION """
 """ ================================================ """
 from libc.stdio cimport printf, fflush, stderr, stdout
-from libc.stdlib cimport malloc, free
-from libc.math cimport sqrt as c_sqrt, fabs as c_fabs, sin as c_sin, cos as c_cos, atan2 as c_atan2, acos as c_acos, log10 as c_log10
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy
+from libc.math cimport sqrt as c_sqrt, fabs as c_fabs, sin as c_sin, cos as c_cos, atan2 as c_atan2, acos as c_acos, log10 as c_log10, log as c_log
 cdef extern from "math.h":
     double sqrt(double x)
     double M_PI
@@ -94,40 +95,47 @@ cdef void nogil_CoM_quants(int ig, float[:,:] pos, float[:,:] vel, float[:] mass
     return 
 
 
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline void nogil_load_one(float[:] mass, float[:,:] pos, float[:,:] vel, int[:] ptype, float[:] cent_pos, float[:] cent_vel, part_struct *pinfo, float Lbox, int i, int j, int ndim) nogil:
+    """ Fills pinfo[j] with particle i's mass, type, and position, radius and velocity
+    relative to cent_pos, cent_vel. """
+    cdef int ip
+    cdef float dx[3]
+
+    pinfo[j].r = 0.
+    for ip in range(ndim):
+        # handle periodicity by keeping all particles close to the central position
+        dx[ip] = pos[i,ip] - cent_pos[ip]
+        if dx[ip] < -0.5*Lbox:
+            dx[ip] = Lbox + dx[ip]
+        if dx[ip] > 0.5*Lbox:
+            dx[ip] = Lbox - dx[ip]
+        pinfo[j].r += dx[ip]*dx[ip]
+        pinfo[j].v[ip] = vel[i,ip] - cent_vel[ip]  # velocity wrt cent_vel
+        pinfo[j].x[ip] = dx[ip]   # position relative to cent_pos
+    pinfo[j].r = c_sqrt(pinfo[j].r)
+    pinfo[j].m = mass[i]
+    pinfo[j].t = ptype[i]
+    pinfo[j].i = i
+
 @cython.cdivision(True)
 @cython.wraparound(False)
 @cython.boundscheck(False)
 cdef void nogil_load_partinfo(float[:] mass, float[:,:] pos, float[:,:] vel, int[:] ptype, float[:] cent_pos, float[:] cent_vel, part_struct *pinfo, float Lbox, int istart, int iend, int ndim) nogil:
-    """ Computes center-of-mass position and velocity, as well as minimum potential position.
+    """ Loads the particle info structure for the particles of one group.
 
-    ig: group index
-    pos, vel, mass, pot: positions, velocities, masses, potentials of particles in group
-    grp_mtot: total mass of group
+    mass, pos, vel, ptype: masses, positions, velocities, types of particles
+    cent_pos, cent_vel: group center position and velocity
+    pinfo: particle info structure to be filled
     Lbox: periodic box size in units of pos
     istart,iend: starting, ending indexes for group particles
     ndim: number of dimensions, usually 3
-    pinfo: particle info structure to be filled
     """
-    cdef int i,j,ip
-    cdef float dx[3]
-    
+    cdef int i
     for i in range(istart,iend):
-        j = i - istart
-        pinfo[j].r = 0.
-        for ip in range(ndim):
-            # handle periodicity by keeping all particles close to the central position
-            dx[ip] = pos[i,ip] - cent_pos[ip]
-            if dx[ip] < -0.5*Lbox:
-                dx[ip] = Lbox + dx[ip]
-            if dx[ip] > 0.5*Lbox:
-                dx[ip] = Lbox - dx[ip]
-            pinfo[j].r += dx[ip]*dx[ip]
-            pinfo[j].v[ip] = vel[i,ip] - cent_vel[ip]  # velocity wrt cent_vel
-            pinfo[j].x[ip] = dx[ip]   # position relative to cent_pos
-        pinfo[j].r = c_sqrt(pinfo[j].r)
-        pinfo[j].m = mass[i]
-        pinfo[j].t = ptype[i]
-        pinfo[j].i = i
+        nogil_load_one(mass, pos, vel, ptype, cent_pos, cent_vel, pinfo, Lbox, i, i-istart, ndim)
 
 @cython.cdivision(True)
 @cython.wraparound(False)
@@ -200,6 +208,25 @@ cdef float nogil_velocity_dispersions(part_struct *pinfo, int ip, int[:] group_p
     vdisp = c_sqrt(vdisp/npt)
     return vdisp
 
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_rotation_angles(float[:] L) nogil:
+    """ Sets L[3], L[4] to the angles ALPHA, BETA that rotate the z-axis onto the angular
+    momentum vector L[0:3]. """
+    cdef float e[3]
+    cdef double Lmag,phi,theta
+
+    Lmag = c_sqrt(L[0]*L[0]+L[1]*L[1]+L[2]*L[2])
+    phi = c_atan2(L[1],L[0])
+    theta = c_acos(L[2]/Lmag) 
+    e[0] = c_sin(theta) * c_cos(phi)
+    e[1] = c_sin(theta) * c_sin(phi)
+    e[2] = c_cos(theta)
+    L[3] = c_atan2(L[1],L[2])  # this is ALPHA
+    nogil_rotator(e, L[3], 0.0)
+    L[4] = c_atan2(e[0],e[2])  # this is BETA
+
 @cython.cdivision(True)
 @cython.wraparound(False)
 @cython.boundscheck(False)
@@ -220,8 +247,7 @@ cdef void nogil_angular_quants(part_struct *pinfo, int npart, int ip, int[:] gro
     cdef float p[3]
     cdef float x[3]
     cdef float v[3]
-    cdef float e[3]
-    cdef double Lmag,phi,theta,jz,rz,v2
+    cdef double jz,rz,v2
     cdef double krot=0., ktot=0.
     cdef double m_tot=0., m_counterrot=0.
 
@@ -254,15 +280,7 @@ cdef void nogil_angular_quants(part_struct *pinfo, int npart, int ip, int[:] gro
             L[2] += x[0]*p[1] - x[1]*p[0]
 
     # compute rotation angles, which rotates the galaxy to line up the z-dir with L
-    Lmag = c_sqrt(L[0]*L[0]+L[1]*L[1]+L[2]*L[2])
-    phi = c_atan2(L[1],L[0])
-    theta = c_acos(L[2]/Lmag) 
-    e[0] = c_sin(theta) * c_cos(phi)
-    e[1] = c_sin(theta) * c_sin(phi)
-    e[2] = c_cos(theta)
-    L[3] = c_atan2(L[1],L[2])  # this is ALPHA
-    nogil_rotator(e, L[3], 0.0)
-    L[4] = c_atan2(e[0],e[2])  # this is BETA
+    nogil_rotation_angles(L)
 
     # compute bulge-to-total ratio based on kinematic decomposition
     for i in range(npart):
@@ -321,6 +339,7 @@ cdef void nogil_virial_quants(part_struct *pinfo, double[:] Densities, int npart
             if density > Densities[j]:
                 collectRadii[j] = pinfo[i].r
                 collectMasses[j] = mcum[i]
+    free(mcum)
     #if npart > 5000: printf("%g %g %g %g %g %g %g\n",pinfo[npart-1].r,mcum[npart-1]/(PiFac*pinfo[npart-1].r*pinfo[npart-1].r*pinfo[npart-1].r),collectRadii[0],collectRadii[1],collectRadii[2],c_log10(collectMasses[0]),c_log10(collectMasses[1]),c_log10(collectMasses[2]))
     return
 
@@ -366,6 +385,1031 @@ cdef void nogil_rotator(float *vector, float ALPHA, float BETA) nogil:
 
 
 
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef float nogil_mass_target(int ig, int ip, float[:,:] grp_mass, int[:] group_ptypes) nogil:
+    """ Total mass of type selection ip of group ig: ip<len(group_ptypes) is that ptype,
+    ip=len(group_ptypes) is baryons (all but types 1 and 2), ip=len(group_ptypes)+1 is all. """
+    cdef int i
+    cdef int nptypes = group_ptypes.shape[0]
+    cdef float mtarget = 0.
+    if ip == nptypes+1:  # last value stores radii for all particles together
+        for i in range(nptypes):
+            mtarget += grp_mass[ig,i]
+    elif ip == nptypes:  # second-to-last value stores baryonic radii 
+        for i in range(nptypes):
+            if group_ptypes[i] == 1 or group_ptypes[i] == 2: continue  # skip DM particles
+            mtarget += grp_mass[ig,i]
+    else:
+        mtarget = grp_mass[ig,ip]
+    return mtarget
+
+""" ======================================================= """
+""" FUSED PASSES COMPUTING ALL TYPE SELECTIONS OF A GROUP   """
+""" ======================================================= """
+cdef enum:
+    MAXSEL = 8  # maximum number of type selections: 6 ptypes, baryons, all
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline int nogil_selections(int t, int[:] group_ptypes, int *sel) nogil:
+    """ Fills sel with the type selections a particle of type t belongs to: its own
+    ptype (index into group_ptypes, if present), baryons (len(group_ptypes), all types
+    other than 1 and 2) and all particles (len(group_ptypes)+1).  Returns how many. """
+    cdef int ip, n = 0
+    cdef int ngp = group_ptypes.shape[0]
+    for ip in range(ngp):
+        if t == group_ptypes[ip]:
+            sel[n] = ip
+            n += 1
+            break
+    if t != 1 and t != 2:
+        sel[n] = ngp
+        n += 1
+    sel[n] = ngp + 1
+    return n + 1
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_masses_CoM(int ig, float[:,:] pos, float[:,:] vel, float[:] mass, float[:] pot, int[:] ptype, int[:] group_ptypes, int istart, int iend, int ndim, float Lbox, float[:] grp_mtot, float[:,:] grp_mass, int[:,:] grp_count, float[:,:] grp_pos, float[:,:] grp_vel, float[:,:] grp_minpotpos, float[:,:] grp_minpotvel) nogil:
+    """ Masses and counts of each type, center-of-mass position and velocity, and the
+    minimum potential particle of group ig, in a single pass over its particles.
+
+    Accumulates in the same order as the per-type mass loops plus nogil_CoM_quants,
+    so the results are identical to those.
+    """
+    cdef int i, ip, jp
+    cdef int ngp = group_ptypes.shape[0]
+    cdef int minpotpart = -1
+    cdef float minpot = 1.e30
+    cdef float[3] mypos
+
+    for i in range(istart,iend):
+        for jp in range(ngp):
+            if ptype[i] == group_ptypes[jp]:
+                grp_mass[ig,jp] += mass[i]
+                grp_count[ig,jp] += 1
+        for ip in range(ndim):
+            # handle periodicity by keeping all particles close to the first particle
+            mypos[ip] = pos[i,ip]
+            if mypos[ip] - pos[istart,ip] > 0.5*Lbox:
+                mypos[ip] -= Lbox
+            if mypos[ip] - pos[istart,ip] < -0.5*Lbox:
+                mypos[ip] += Lbox
+            grp_pos[ig,ip] += mass[i] * mypos[ip]
+            grp_vel[ig,ip] += mass[i] * vel[i,ip]
+        if pot[i] < minpot:
+            minpotpart = i
+            minpot = pot[i]
+    for jp in range(ngp):
+        grp_mtot[ig] += grp_mass[ig,jp]
+    for ip in range(ndim):
+        grp_pos[ig,ip] /= grp_mtot[ig]
+        grp_vel[ig,ip] /= grp_mtot[ig]
+        # if the CoM pos ends up outside the box, periodically wrap it back in
+        if grp_pos[ig,ip] > Lbox: 
+            grp_pos[ig,ip] -= Lbox
+        if grp_pos[ig,ip] < -Lbox: 
+            grp_pos[ig,ip] += Lbox
+    for ip in range(ndim):
+        grp_minpotpos[ig,ip] = pos[minpotpart,ip]  # position of minimum potential particle, of any type
+        grp_minpotvel[ig,ip] = vel[minpotpart,ip]  # velocity of minimum potential particle, of any type
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_radial_quants(int ig, part_struct *pinfo, int npart, int[:] group_ptypes, int ndim, float[:,:] grp_mass, float[:,:] grp_R20, float[:,:] grp_Rhalf, float[:,:] grp_R80, float[:,:] grp_vdisp, float[:,:,:] grp_L, bint find_radii) nogil:
+    """ 20%, 50% and 80% mass radii, velocity dispersions and angular quantities of every
+    type selection (each ptype, baryons, all) of group ig, from its radius-sorted pinfo.
+
+    Equivalent to calling nogil_half_mass_radius (x3), nogil_velocity_dispersions and
+    nogil_angular_quants for each selection, with the same accumulation order, but
+    with two passes over the particles instead of 8 per selection.
+
+    With find_radii False the mass radii are left alone and pinfo need not be sorted;
+    the other quantities then only differ by rounding (see nogil_radial_quants_select).
+    """
+    cdef int nsel = group_ptypes.shape[0] + 2
+    cdef int i, idim, isel, k, nin
+    cdef int sel[3]
+    cdef float rtarget[MAXSEL*3]
+    cdef int nfound[MAXSEL]
+    cdef int npt[MAXSEL]
+    cdef double cumulative_mass[MAXSEL]
+    cdef double mtot[MAXSEL]
+    cdef double vcom[MAXSEL*3]
+    cdef double vdisp[MAXSEL]
+    cdef double krot[MAXSEL]
+    cdef double ktot[MAXSEL]
+    cdef double m_tot[MAXSEL]
+    cdef double m_counterrot[MAXSEL]
+    cdef float mtarget
+    cdef float p[3]
+    cdef float x[3]
+    cdef float v[3]
+    cdef double jz, rz, v2
+
+    for isel in range(nsel):
+        mtarget = nogil_mass_target(ig, isel, grp_mass, group_ptypes)
+        rtarget[isel*3] = 0.2*mtarget
+        rtarget[isel*3+1] = 0.5*mtarget
+        rtarget[isel*3+2] = 0.8*mtarget
+        nfound[isel] = 0
+        npt[isel] = 0
+        cumulative_mass[isel] = 0.
+        mtot[isel] = 0.
+        vdisp[isel] = 0.
+        krot[isel] = 0.
+        ktot[isel] = 0.
+        m_tot[isel] = 0.
+        m_counterrot[isel] = 0.
+        for idim in range(3):
+            vcom[isel*3+idim] = 0.
+        for k in range(7):
+            grp_L[ig,isel,k] = 0.
+
+    # first pass: mass radii, CoM velocity and angular momentum
+    for i in range(npart):
+        nin = nogil_selections(pinfo[i].t, group_ptypes, sel)
+        for idim in range(3):
+            p[idim] = pinfo[i].m * pinfo[i].v[idim]  # Note: pinfo.x and .v are w.r.t. group center
+            x[idim] = pinfo[i].x[idim]
+        for k in range(nin):
+            isel = sel[k]
+            cumulative_mass[isel] += pinfo[i].m
+            # radii enclosing 20%, 50%, 80% of the mass are reached in that order
+            while find_radii and nfound[isel] < 3 and cumulative_mass[isel] >= rtarget[isel*3+nfound[isel]]:
+                if nfound[isel] == 0:
+                    grp_R20[ig,isel] = pinfo[i].r
+                elif nfound[isel] == 1:
+                    grp_Rhalf[ig,isel] = pinfo[i].r
+                else:
+                    grp_R80[ig,isel] = pinfo[i].r
+                nfound[isel] += 1
+            mtot[isel] += pinfo[i].m
+            for idim in range(ndim):
+                vcom[isel*3+idim] += pinfo[i].m * pinfo[i].v[idim]
+            npt[isel] += 1
+            grp_L[ig,isel,0] += x[1]*p[2] - x[2]*p[1]
+            grp_L[ig,isel,1] += x[2]*p[0] - x[0]*p[2]
+            grp_L[ig,isel,2] += x[0]*p[1] - x[1]*p[0]
+
+    for isel in range(nsel):
+        if npt[isel] < 3:  # not enough particles for a dispersion or angular quants
+            grp_vdisp[ig,isel] = 0.
+            for k in range(3):
+                grp_L[ig,isel,k] = 0.
+            continue
+        for idim in range(ndim):
+            vcom[isel*3+idim] /= mtot[isel]
+        # compute rotation angles, which rotates the galaxy to line up the z-dir with L
+        nogil_rotation_angles(grp_L[ig,isel])
+
+    # second pass: dispersion around CoM velocity, and kinematic decomposition
+    for i in range(npart):
+        nin = nogil_selections(pinfo[i].t, group_ptypes, sel)
+        for k in range(nin):
+            isel = sel[k]
+            if npt[isel] < 3:
+                continue
+            for idim in range(ndim):
+                vdisp[isel] += (pinfo[i].v[idim] - vcom[isel*3+idim])**2
+            v2 = 0.
+            for idim in range(3):
+                x[idim] = pinfo[i].x[idim]
+                v[idim] = pinfo[i].v[idim]
+                v2 += v[idim]*v[idim]
+            nogil_rotator(x,grp_L[ig,isel,3],grp_L[ig,isel,4])  # rotate positions and velocities to align with L
+            nogil_rotator(v,grp_L[ig,isel,3],grp_L[ig,isel,4])
+            rz = c_sqrt(x[0]*x[0] + x[1]*x[1])  # distance to axis of rotation
+            jz = x[0]*v[1] - x[1]*v[0]  # specific angular momentum of this particle
+            # for bulge-to-total, add up mass of particle rotating against L
+            if jz < 0:
+                m_counterrot[isel] += pinfo[i].m
+            m_tot[isel] += pinfo[i].m
+            # compute kappa_rot, which is fraction of KE in ordered rotation (Sales+11 eq 1)
+            if rz > 0: krot[isel] += 0.5*pinfo[i].m*(jz/rz)**2   # this is 0.5*m*vphi^2
+            ktot[isel] += 0.5*pinfo[i].m*v2
+
+    for isel in range(nsel):
+        if npt[isel] < 3:
+            continue
+        grp_vdisp[ig,isel] = c_sqrt(vdisp[isel]/npt[isel])
+        # bulge_to_total is defined as twice the fraction of counter-rotating mass
+        grp_L[ig,isel,5] = <float>(2.*m_counterrot[isel] / m_tot[isel])
+        if grp_L[ig,isel,5] > 1.: grp_L[ig,isel,5] = 1.
+        grp_L[ig,isel,6] = <float>(krot[isel] / ktot[isel])  # kappa_rot
+
+""" ========================================================= """
+""" RADIAL QUANTILES FROM RADIUS BUCKETS, WITHOUT A FULL SORT """
+""" ========================================================= """
+cdef enum:
+    BUCKET_NPART = 8  # mean number of particles per radius bucket
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_bucket_by_radius(part_struct *pinfo, part_struct *tmp, int npart, int nb, int *bstart, float *rlo) nogil:
+    """ Counting sort of pinfo into nb buckets of increasing radius: r=0 goes in bucket 0,
+    the rest in nb-1 logarithmic bins between the smallest nonzero and the largest radius.
+
+    On return bucket b is pinfo[bstart[b]:bstart[b+1]], in no particular order within it,
+    and rlo[b] is its smallest radius.  tmp is scratch space for npart particles.
+    """
+    cdef int i, b
+    cdef float rmin = 0., rmax = 0.
+    cdef double lrmin = 0., dlog = 0.
+    cdef int *ib = <int *> malloc(npart*sizeof(int))
+
+    for i in range(npart):
+        if pinfo[i].r > 0.:
+            if rmin == 0. or pinfo[i].r < rmin:
+                rmin = pinfo[i].r
+            if pinfo[i].r > rmax:
+                rmax = pinfo[i].r
+    if rmax > rmin:
+        lrmin = c_log(rmin)
+        dlog = (c_log(rmax) - lrmin) / (nb-1)
+    for b in range(nb):
+        bstart[b] = 0
+        rlo[b] = rmax
+    bstart[nb] = 0
+    # the bucket index never decreases with radius, so buckets are ordered in radius
+    for i in range(npart):
+        if pinfo[i].r <= 0.:
+            b = 0
+        elif dlog == 0.:
+            b = 1
+        else:
+            b = 1 + <int>((c_log(pinfo[i].r) - lrmin) / dlog)
+            if b > nb-1:
+                b = nb-1
+        ib[i] = b
+        bstart[b+1] += 1
+        if pinfo[i].r < rlo[b]:
+            rlo[b] = pinfo[i].r
+    for b in range(nb):
+        bstart[b+1] += bstart[b]
+    # scatter, using bstart as the fill pointers, then shift them back to bucket starts
+    for i in range(npart):
+        tmp[bstart[ib[i]]] = pinfo[i]
+        bstart[ib[i]] += 1
+    for b in range(nb, 0, -1):
+        bstart[b] = bstart[b-1]
+    bstart[0] = 0
+    memcpy(pinfo, tmp, npart*sizeof(part_struct))
+    free(ib)
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline void nogil_sort_bucket(part_struct *pinfo, int *bstart, char *bsorted, int b) nogil:
+    """ Sorts bucket b by radius, unless that has been done already. """
+    if not bsorted[b]:
+        qsort(<void*>(pinfo + bstart[b]), <size_t>(bstart[b+1]-bstart[b]), sizeof(part_struct), mycmp)
+        bsorted[b] = 1
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef float nogil_bucket_quantile(part_struct *pinfo, int *bstart, char *bsorted, double *bmass, int nb, float mtarget, int isel, int[:] group_ptypes) nogil:
+    """ As nogil_half_mass_radius, for type selection isel of radius-bucketed pinfo.
+
+    bmass holds the mass of the selection in each bucket.  Buckets are skipped on their
+    total until the one in which the cumulative mass reaches mtarget, and only that one
+    is sorted and walked particle by particle.
+    """
+    cdef int b, i, k, nin
+    cdef int sel[3]
+    cdef double cumulative_mass = 0.
+
+    for b in range(nb):
+        if bmass[b] == 0. or cumulative_mass + bmass[b] < mtarget:
+            cumulative_mass += bmass[b]
+            continue
+        nogil_sort_bucket(pinfo, bstart, bsorted, b)
+        # if rounding keeps the walk just short of mtarget, carry on into the next bucket
+        for i in range(bstart[b], bstart[b+1]):
+            nin = nogil_selections(pinfo[i].t, group_ptypes, sel)
+            for k in range(nin):
+                if sel[k] == isel:
+                    cumulative_mass += pinfo[i].m
+                    if cumulative_mass >= mtarget:
+                        return pinfo[i].r
+    return 0.
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_virial_quants_buckets(part_struct *pinfo, int *bstart, char *bsorted, float *rlo, double *bmass, int nb, double[:] Densities, int nDens, float[:] collectRadii, float[:] collectMasses) nogil:
+    """ As nogil_virial_quants, for radius-bucketed pinfo; bmass holds the total mass in
+    each bucket.
+
+    The outermost radius at which the enclosed density exceeds Densities[j] is looked for
+    from the outermost bucket inwards.  No particle in bucket b can be denser than the mass
+    out to the end of b over the volume at the smallest radius in b, so buckets where that
+    bound is below Densities[j] are skipped unsorted; the first one found to hold a crossing
+    ends the search.
+    """
+    cdef int i, j, b
+    cdef bint found
+    cdef float volume, density
+    cdef float PiFac = 4./3.*M_PI
+    cdef double mcum
+    cdef double *menc = <double *> malloc((nb+1)*sizeof(double))  # mass in buckets below b
+
+    menc[0] = 0.
+    for b in range(nb):
+        menc[b+1] = menc[b] + bmass[b]
+    for j in range(nDens):
+        for b in range(nb-1, -1, -1):
+            if bstart[b+1] == bstart[b] or rlo[b] == 0.:
+                continue  # empty, or the r=0 bucket which never counts
+            # small margin so rounding in the bucket sums can never prune a real crossing
+            if menc[b+1] < 0.999*Densities[j]*PiFac*rlo[b]*rlo[b]*rlo[b]:
+                continue
+            nogil_sort_bucket(pinfo, bstart, bsorted, b)
+            found = 0
+            mcum = menc[b]
+            for i in range(bstart[b], bstart[b+1]):
+                mcum += pinfo[i].m
+                if i == 0:
+                    continue  # innermost particle is skipped, as in nogil_virial_quants
+                volume = PiFac*pinfo[i].r*pinfo[i].r*pinfo[i].r
+                density = mcum/volume
+                if density > Densities[j]:
+                    collectRadii[j] = pinfo[i].r
+                    collectMasses[j] = mcum
+                    found = 1
+            if found:
+                break
+    free(menc)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_radial_quants_select(int ig, part_struct *pinfo, part_struct *tmp, int npart, int[:] group_ptypes, int ndim, float[:,:] grp_mass, float[:,:] grp_R20, float[:,:] grp_Rhalf, float[:,:] grp_R80, float[:,:] grp_vdisp, float[:,:,:] grp_L, bint do_virial, double[:] Densities, int nDens, float[:] collectRadii, float[:] collectMasses) nogil:
+    """ nogil_radial_quants plus (if do_virial) nogil_virial_quants for group ig, on its
+    unsorted pinfo, in expected linear time.
+
+    The particles are counting-sorted into radius buckets of ~BUCKET_NPART particles each.
+    Mass radii and virial radii are then found by walking the cumulative bucket masses, and
+    only the few buckets that hold one of them get sorted.  Radii are the same particle radii
+    as from a full sort (up to ties decided by rounding of the cumulative masses); dispersions
+    and angular quantities are summed in a different order, so differ by rounding only.
+    tmp is scratch space for npart particles.
+    """
+    cdef int nsel = group_ptypes.shape[0] + 2
+    cdef int nb = npart/BUCKET_NPART + 2
+    cdef int i, b, k, nin, isel
+    cdef int sel[3]
+    cdef float mtarget
+    cdef int *bstart = <int *> malloc((nb+1)*sizeof(int))
+    cdef float *rlo = <float *> malloc(nb*sizeof(float))
+    cdef char *bsorted = <char *> malloc(nb*sizeof(char))
+    cdef double *bmass = <double *> malloc(nsel*nb*sizeof(double))  # mass of each selection in each bucket
+
+    # dispersions and angular quantities don't need the particles in order
+    nogil_radial_quants(ig, pinfo, npart, group_ptypes, ndim, grp_mass, grp_R20, grp_Rhalf, grp_R80, grp_vdisp, grp_L, 0)
+
+    nogil_bucket_by_radius(pinfo, tmp, npart, nb, bstart, rlo)
+    for b in range(nb):
+        bsorted[b] = 0
+    for k in range(nsel*nb):
+        bmass[k] = 0.
+    for b in range(nb):
+        for i in range(bstart[b], bstart[b+1]):
+            nin = nogil_selections(pinfo[i].t, group_ptypes, sel)
+            for k in range(nin):
+                bmass[sel[k]*nb+b] += pinfo[i].m
+
+    for isel in range(nsel):
+        mtarget = nogil_mass_target(ig, isel, grp_mass, group_ptypes)
+        grp_R20[ig,isel] = nogil_bucket_quantile(pinfo, bstart, bsorted, bmass+isel*nb, nb, 0.2*mtarget, isel, group_ptypes)
+        grp_Rhalf[ig,isel] = nogil_bucket_quantile(pinfo, bstart, bsorted, bmass+isel*nb, nb, 0.5*mtarget, isel, group_ptypes)
+        grp_R80[ig,isel] = nogil_bucket_quantile(pinfo, bstart, bsorted, bmass+isel*nb, nb, 0.8*mtarget, isel, group_ptypes)
+
+    if do_virial:  # the last selection is all particles
+        nogil_virial_quants_buckets(pinfo, bstart, bsorted, rlo, bmass+(nsel-1)*nb, nb, Densities, nDens, collectRadii, collectMasses)
+
+    free(bstart)
+    free(rlo)
+    free(bsorted)
+    free(bmass)
+
+""" ========================================================= """
+""" PARALLEL VERSIONS FOR SINGLE GROUPS TOO LARGE FOR ONE THREAD """
+""" ========================================================= """
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_masses_par(int ig, float[:] mass, int[:] ptype, int[:] group_ptypes, int istart, int iend, float[:] grp_mtot, float[:,:] grp_mass, int[:,:] grp_count, int nthreads) nogil:
+    """ Masses and particle counts of each type in group ig, as parallel reductions. """
+    cdef int i, ip, npt
+    cdef double msum
+    for ip in range(group_ptypes.shape[0]):
+        msum = 0.
+        npt = 0
+        for i in prange(istart, iend, num_threads=nthreads, schedule='static'):
+            if ptype[i] == group_ptypes[ip]:
+                msum += mass[i]
+                npt += 1
+        grp_mass[ig,ip] = msum
+        grp_count[ig,ip] = npt
+        grp_mtot[ig] += grp_mass[ig,ip]
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_CoM_quants_par(int ig, float[:,:] pos, float[:,:] vel, float[:] mass, float[:] pot, float[:] grp_mtot, int istart, int iend, int ndim, float Lbox, float[:,:] grp_pos, float[:,:] grp_vel, float[:,:] grp_minpotpos, float[:,:] grp_minpotvel, int nthreads) nogil:
+    """ As nogil_CoM_quants, with the sums as parallel reductions and the minimum-potential
+    search split into one chunk per thread. """
+    cdef int i, ip, ic, i0, i1, minpotpart
+    cdef float x, minpot
+    cdef double xsum, vsum
+    cdef int *chunk_min = <int *> malloc(nthreads*sizeof(int))
+
+    for ip in range(ndim):
+        xsum = 0.
+        vsum = 0.
+        for i in prange(istart, iend, num_threads=nthreads, schedule='static'):
+            # handle periodicity by keeping all particles close to the first particle
+            x = pos[i,ip]
+            if x - pos[istart,ip] > 0.5*Lbox:
+                x = x - Lbox
+            if x - pos[istart,ip] < -0.5*Lbox:
+                x = x + Lbox
+            xsum += mass[i] * x
+            vsum += mass[i] * vel[i,ip]
+        grp_pos[ig,ip] = xsum / grp_mtot[ig]
+        grp_vel[ig,ip] = vsum / grp_mtot[ig]
+        # if the CoM pos ends up outside the box, periodically wrap it back in
+        if grp_pos[ig,ip] > Lbox: 
+            grp_pos[ig,ip] -= Lbox
+        if grp_pos[ig,ip] < -Lbox: 
+            grp_pos[ig,ip] += Lbox
+
+    # lowest potential in each chunk, then over chunks in order, so ties go to the first particle as in serial
+    for ic in prange(nthreads, num_threads=nthreads, schedule='static'):
+        i0 = istart + <int>((<long>(iend-istart) * ic) / nthreads)
+        i1 = istart + <int>((<long>(iend-istart) * (ic+1)) / nthreads)
+        chunk_min[ic] = -1
+        minpot = 1.e30
+        for i in range(i0, i1):
+            if pot[i] < minpot:
+                chunk_min[ic] = i
+                minpot = pot[i]
+    minpotpart = -1
+    minpot = 1.e30
+    for ic in range(nthreads):
+        if chunk_min[ic] >= 0 and pot[chunk_min[ic]] < minpot:
+            minpotpart = chunk_min[ic]
+            minpot = pot[minpotpart]
+    free(chunk_min)
+    for ip in range(ndim):
+        grp_minpotpos[ig,ip] = pos[minpotpart,ip]  # position of minimum potential particle, of any type
+        grp_minpotvel[ig,ip] = vel[minpotpart,ip]  # velocity of minimum potential particle, of any type
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_load_partinfo_par(float[:] mass, float[:,:] pos, float[:,:] vel, int[:] ptype, float[:] cent_pos, float[:] cent_vel, part_struct *pinfo, float Lbox, int istart, int iend, int ndim, int nthreads) nogil:
+    """ As nogil_load_partinfo, split over threads. """
+    cdef int i
+    for i in prange(istart, iend, num_threads=nthreads, schedule='static'):
+        nogil_load_one(mass, pos, vel, ptype, cent_pos, cent_vel, pinfo, Lbox, i, i-istart, ndim)
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_merge(part_struct *src, long lo, long mid, long hi, part_struct *dst) nogil:
+    """ Merges the radius-sorted runs src[lo:mid] and src[mid:hi] into dst[lo:hi]. """
+    cdef long i = lo, j = mid, k = lo
+    while i < mid and j < hi:
+        if src[j].r < src[i].r:
+            dst[k] = src[j]
+            j += 1
+        else:
+            dst[k] = src[i]
+            i += 1
+        k += 1
+    while i < mid:
+        dst[k] = src[i]
+        i += 1
+        k += 1
+    while j < hi:
+        dst[k] = src[j]
+        j += 1
+        k += 1
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_sort_par(part_struct *pinfo, part_struct *tmp, long npart, int nthreads) nogil:
+    """ Sorts pinfo by radius: each thread qsorts one chunk, then pairs of sorted runs are
+    merged in parallel rounds, alternating between pinfo and tmp (which must hold npart). """
+    cdef long ic, k, npairs, width, lo, mid, hi
+    cdef part_struct *src = pinfo
+    cdef part_struct *dst = tmp
+    cdef part_struct *swap
+    cdef long *bounds = <long *> malloc((nthreads+1)*sizeof(long))
+
+    for ic in range(nthreads+1):
+        bounds[ic] = (npart * ic) / nthreads
+    for ic in prange(nthreads, num_threads=nthreads, schedule='static'):
+        qsort(<void*>(pinfo + bounds[ic]), <size_t>(bounds[ic+1]-bounds[ic]), sizeof(part_struct), mycmp)
+    width = 1
+    while width < nthreads:
+        npairs = (nthreads + 2*width - 1) / (2*width)
+        for k in prange(npairs, num_threads=nthreads, schedule='static'):
+            lo = bounds[2*k*width]
+            mid = bounds[min(2*k*width + width, nthreads)]
+            hi = bounds[min(2*k*width + 2*width, nthreads)]
+            nogil_merge(src, lo, mid, hi, dst)
+        swap = src
+        src = dst
+        dst = swap
+        width = 2*width
+    if src != pinfo:
+        memcpy(<void*>pinfo, <void*>src, npart*sizeof(part_struct))
+    free(bounds)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_dispersion_moments(part_struct *pinfo, long i0, long i1, int[:] group_ptypes, int ndim, double *mom, double *vcom, double *dev) nogil:
+    """ Accumulates, for particles i0:i1, the moments used by nogil_velocity_dispersions_par
+    for each type selection (each ptype, then baryons, then all).  If vcom is NULL, adds up
+    mass, momentum and count into mom (5 per selection); otherwise adds up the squared
+    velocity deviation from each selection's CoM velocity in vcom into dev. """
+    cdef int isel, idim, ksel, nin
+    cdef long i
+    cdef int sel[3]
+    cdef double dv2
+
+    for i in range(i0, i1):
+        nin = nogil_selections(pinfo[i].t, group_ptypes, sel)
+        for ksel in range(nin):
+            isel = sel[ksel]
+            if vcom == NULL:
+                mom[isel*5] += pinfo[i].m
+                for idim in range(ndim):
+                    mom[isel*5 + 1 + idim] += pinfo[i].m * pinfo[i].v[idim]
+                mom[isel*5 + 4] += 1
+            else:
+                dv2 = 0.
+                for idim in range(ndim):
+                    dv2 += (pinfo[i].v[idim] - vcom[isel*5 + 1 + idim])**2
+                dev[isel] += dv2
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_velocity_dispersions_par(part_struct *pinfo, int[:] group_ptypes, long npart, int ndim, float[:] vdisp, int nthreads) nogil:
+    """ As nogil_velocity_dispersions, for every type selection at once (each ptype, then
+    baryons, then all), with one chunk of particles per thread. """
+    cdef int nsel = group_ptypes.shape[0] + 2
+    cdef int ic, isel, k
+    cdef long i
+    cdef double *mom = <double *> malloc(nthreads*nsel*5*sizeof(double))
+    cdef double *dev = <double *> malloc(nthreads*nsel*sizeof(double))
+    cdef double *vcom = <double *> malloc(nsel*5*sizeof(double))
+    cdef double dv2
+
+    for i in range(nthreads*nsel*5):
+        mom[i] = 0.
+    for i in range(nthreads*nsel):
+        dev[i] = 0.
+    # first pass: mass, momentum and count for each selection
+    for ic in prange(nthreads, num_threads=nthreads, schedule='static'):
+        nogil_dispersion_moments(pinfo, (npart*ic)/nthreads, (npart*(ic+1))/nthreads, group_ptypes, ndim, mom + ic*nsel*5, NULL, NULL)
+    for isel in range(nsel):
+        for k in range(5):
+            vcom[isel*5 + k] = 0.
+            for ic in range(nthreads):
+                vcom[isel*5 + k] += mom[(ic*nsel + isel)*5 + k]
+        if vcom[isel*5] > 0:
+            for k in range(1, 4):
+                vcom[isel*5 + k] /= vcom[isel*5]
+    # second pass: dispersion around each selection's CoM velocity
+    for ic in prange(nthreads, num_threads=nthreads, schedule='static'):
+        nogil_dispersion_moments(pinfo, (npart*ic)/nthreads, (npart*(ic+1))/nthreads, group_ptypes, ndim, NULL, vcom, dev + ic*nsel)
+    for isel in range(nsel):
+        vdisp[isel] = 0.
+        if vcom[isel*5 + 4] < 3:  # not enough particle to get a dispersion
+            continue
+        dv2 = 0.
+        for ic in range(nthreads):
+            dv2 += dev[ic*nsel + isel]
+        vdisp[isel] = c_sqrt(dv2 / vcom[isel*5 + 4])
+    free(mom)
+    free(dev)
+    free(vcom)
+
+""" ============================================================ """
+""" GRAVITATIONAL UNBINDING: DIRECT SUM AND BARNES-HUT POTENTIAL """
+""" ============================================================ """
+cdef enum:
+    TREE_LEAF_NPART = 8  # particles per octree leaf
+    TREE_STACK = 512  # node stack held on the C stack in a tree walk; deeper trees allocate one
+
+ctypedef struct tree_node:  # octree cell
+    double c[3]  # cell centre
+    double h  # cell half-width
+    double m  # mass in cell
+    double com[3]  # centre of mass of cell
+    int first  # first particle of cell in tree order
+    int count  # number of particles in cell
+    int leaf  # 1 if particles are summed directly
+    int child[8]  # child cells, -1 if empty
+
+ctypedef struct octree:
+    tree_node *nodes
+    int nnodes  # nodes in use
+    int cap  # nodes allocated
+    int *order  # particle indexes, in tree order
+    double hmin  # cells are not split below this half-width
+    int depth  # level of the deepest node, the root being level 0
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef inline int nogil_octant(double *x, double *c) nogil:
+    return (x[0] > c[0]) + 2*(x[1] > c[1]) + 4*(x[2] > c[2])
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef int nogil_tree_add_node(octree *t) nogil:
+    """ Index of a new node of t, growing the node array as needed; -1 if it cannot be
+    grown, in which case t is left as it was. """
+    cdef tree_node *nodes
+    if t.nnodes == t.cap:
+        nodes = <tree_node *> realloc(t.nodes, 2*t.cap*sizeof(tree_node))
+        if nodes == NULL:
+            return -1
+        t.nodes = nodes
+        t.cap *= 2
+    t.nnodes += 1
+    return t.nnodes - 1
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef int nogil_tree_build(octree *t, int inode, int level, double *x, double *m, int *tmp) nogil:
+    """ Fills in mass and centre of mass of node inode at depth level, whose centre,
+    half-width and particle range are set, and recursively splits it into octants.
+    Returns 0, or -1 if nodes could not be allocated.
+
+    x, m: positions (3 per particle) and masses, indexed by t.order
+    tmp: scratch space for as many particles as the tree
+    """
+    cdef int i, k, ip, ichild, first, count
+    cdef int cnt[8]
+    cdef int start[8]
+    cdef double msum = 0.
+    cdef double com[3]
+    cdef double c[3]
+    cdef double h
+
+    first = t.nodes[inode].first
+    count = t.nodes[inode].count
+    for k in range(3):
+        com[k] = 0.
+        c[k] = t.nodes[inode].c[k]
+    h = t.nodes[inode].h
+    for i in range(first, first+count):
+        ip = t.order[i]
+        msum += m[ip]
+        for k in range(3):
+            com[k] += m[ip]*x[3*ip+k]
+    t.nodes[inode].m = msum
+    for k in range(3):
+        t.nodes[inode].com[k] = com[k]/msum if msum > 0 else c[k]
+    for k in range(8):
+        t.nodes[inode].child[k] = -1
+    if level > t.depth:
+        t.depth = level
+    t.nodes[inode].leaf = count <= TREE_LEAF_NPART or h < t.hmin
+    if t.nodes[inode].leaf:
+        return 0
+
+    # sort this cell's particles by octant
+    for k in range(8):
+        cnt[k] = 0
+    for i in range(first, first+count):
+        cnt[nogil_octant(&x[3*t.order[i]], c)] += 1
+    start[0] = first
+    for k in range(1,8):
+        start[k] = start[k-1] + cnt[k-1]
+    for i in range(first, first+count):
+        k = nogil_octant(&x[3*t.order[i]], c)
+        tmp[start[k]] = t.order[i]
+        start[k] += 1
+    memcpy(&t.order[first], &tmp[first], count*sizeof(int))
+
+    start[0] = first
+    for k in range(8):
+        if k > 0:
+            start[k] = start[k-1] + cnt[k-1]
+        if cnt[k] == 0:
+            continue
+        ichild = nogil_tree_add_node(t)  # may move t.nodes
+        if ichild < 0:
+            return -1
+        t.nodes[inode].child[k] = ichild
+        t.nodes[ichild].h = 0.5*h
+        t.nodes[ichild].c[0] = c[0] + (0.5*h if k & 1 else -0.5*h)
+        t.nodes[ichild].c[1] = c[1] + (0.5*h if k & 2 else -0.5*h)
+        t.nodes[ichild].c[2] = c[2] + (0.5*h if k & 4 else -0.5*h)
+        t.nodes[ichild].first = start[k]
+        t.nodes[ichild].count = cnt[k]
+        if nogil_tree_build(t, ichild, level+1, x, m, tmp) < 0:
+            return -1
+    return 0
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef int nogil_tree_init(octree *t, int *active, int nb, double *x, double *m) nogil:
+    """ Builds an octree of particles active[0:nb].  Returns 0, or -1 if memory could not
+    be allocated; t must be freed with nogil_tree_free either way. """
+    cdef int i, k, ip, status
+    cdef double lo[3]
+    cdef double hi[3]
+    cdef int *tmp = <int *> malloc(nb*sizeof(int))
+
+    t.cap = 2*(nb/TREE_LEAF_NPART) + 16
+    t.nodes = <tree_node *> malloc(t.cap*sizeof(tree_node))
+    t.nnodes = 1
+    t.order = <int *> malloc(nb*sizeof(int))
+    if tmp == NULL or t.nodes == NULL or t.order == NULL:
+        free(tmp)
+        return -1
+    for k in range(3):
+        lo[k] = 1.e300
+        hi[k] = -1.e300
+    for i in range(nb):
+        ip = active[i]
+        t.order[i] = ip
+        for k in range(3):
+            if x[3*ip+k] < lo[k]: lo[k] = x[3*ip+k]
+            if x[3*ip+k] > hi[k]: hi[k] = x[3*ip+k]
+    t.nodes[0].h = 0.
+    for k in range(3):
+        t.nodes[0].c[k] = 0.5*(lo[k]+hi[k])
+        if 0.5*(hi[k]-lo[k]) > t.nodes[0].h:
+            t.nodes[0].h = 0.5*(hi[k]-lo[k])
+    t.nodes[0].h *= 1.0001  # so that no particle sits on the outer boundary
+    t.hmin = 1.e-8*t.nodes[0].h
+    t.nodes[0].first = 0
+    t.nodes[0].count = nb
+    t.depth = 0
+    status = nogil_tree_build(t, 0, 0, x, m, tmp)
+    free(tmp)
+    return status
+
+cdef void nogil_tree_free(octree *t) nogil:
+    free(t.nodes)
+    free(t.order)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef double nogil_tree_phi(octree *t, int ip, double *x, double *m, double eps2, double theta2) nogil:
+    """ Potential (without G) at particle ip from all other particles in t, opening cells
+    that ip is inside of or that are seen at an angle larger than sqrt(theta2).
+
+    Each opened cell leaves at most 7 siblings of the next one on the stack, so the walk
+    needs at most 7*depth+1 entries; these are allocated if they do not fit in TREE_STACK.
+    """
+    cdef int sp = 0, inode, i, jp, k
+    cdef int nstack = 7*t.depth + 1
+    cdef int local_stack[TREE_STACK]
+    cdef int *stack = local_stack
+    cdef double phi = 0., d2, dx
+    cdef bint outside
+    cdef tree_node *node
+
+    if nstack > TREE_STACK:
+        stack = <int *> malloc(nstack*sizeof(int))
+    stack[0] = 0
+    sp = 1
+    while sp > 0:
+        sp -= 1
+        node = &t.nodes[stack[sp]]
+        if node.leaf:
+            for i in range(node.first, node.first+node.count):
+                jp = t.order[i]
+                if jp == ip:
+                    continue
+                d2 = eps2
+                for k in range(3):
+                    dx = x[3*jp+k] - x[3*ip+k]
+                    d2 += dx*dx
+                if d2 > 0.:
+                    phi -= m[jp] / c_sqrt(d2)
+            continue
+        d2 = 0.
+        outside = 0
+        for k in range(3):
+            dx = node.com[k] - x[3*ip+k]
+            d2 += dx*dx
+            if c_fabs(x[3*ip+k] - node.c[k]) > node.h:
+                outside = 1
+        if outside and 4.*node.h*node.h < theta2*d2:
+            phi -= node.m / c_sqrt(d2 + eps2)
+        else:
+            for k in range(8):
+                if node.child[k] >= 0:
+                    stack[sp] = node.child[k]
+                    sp += 1
+    if stack != local_stack:
+        free(stack)
+    return phi
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef double nogil_direct_phi(int ip, int *active, int nb, double *x, double *m, double eps2) nogil:
+    """ Potential (without G) at particle ip from particles active[0:nb], by direct summation. """
+    cdef int i, jp, k
+    cdef double phi = 0., d2, dx
+    for i in range(nb):
+        jp = active[i]
+        if jp == ip:
+            continue
+        d2 = eps2
+        for k in range(3):
+            dx = x[3*jp+k] - x[3*ip+k]
+            d2 += dx*dx
+        if d2 > 0.:
+            phi -= m[jp] / c_sqrt(d2)
+    return phi
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef int nogil_group_phi(int *active, int nb, double *x, double *m, double eps2, long direct_npart, double theta, double *phi, int nthreads) nogil:
+    """ Potential (without G) at each of particles active[0:nb] from all the others, into
+    phi[0:nb]: direct sum for up to direct_npart particles, else a Barnes-Hut octree with
+    opening angle theta.  nthreads > 1 splits the particles over threads, for large groups.
+    Returns 0, or -1 if the octree could not be allocated.
+    """
+    cdef int i
+    cdef bint use_tree = nb > direct_npart
+    cdef octree t
+
+    if use_tree:
+        if nogil_tree_init(&t, active, nb, x, m) < 0:
+            nogil_tree_free(&t)
+            return -1
+    if nthreads > 1:
+        for i in prange(nb, num_threads=nthreads, schedule='dynamic', chunksize=64):
+            if use_tree:
+                phi[i] = nogil_tree_phi(&t, active[i], x, m, eps2, theta*theta)
+            else:
+                phi[i] = nogil_direct_phi(active[i], active, nb, x, m, eps2)
+    else:
+        for i in range(nb):
+            if use_tree:
+                phi[i] = nogil_tree_phi(&t, active[i], x, m, eps2, theta*theta)
+            else:
+                phi[i] = nogil_direct_phi(active[i], active, nb, x, m, eps2)
+    if use_tree:
+        nogil_tree_free(&t)
+    return 0
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void nogil_load_group_phys(int istart, int iend, float[:,:] pos, float[:] mass, double Lbox, double *x, double *m) nogil:
+    """ Copies positions and masses of group istart:iend into x (3 per particle) and m,
+    handling periodicity by keeping all particles close to the first one. """
+    cdef int i, k
+    cdef double dx
+    for i in range(iend-istart):
+        m[i] = mass[istart+i]
+        for k in range(3):
+            dx = pos[istart+i,k] - pos[istart,k]
+            if dx > 0.5*Lbox: dx -= Lbox
+            if dx < -0.5*Lbox: dx += Lbox
+            x[3*i+k] = dx
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef int nogil_unbind_group(int istart, int iend, float[:,:] pos, float[:,:] vel, float[:] mass, double Lbox, double G, double eps2, int n_iter, long direct_npart, double theta, unsigned char[:] bound, int nthreads) nogil:
+    """ Iteratively removes particles with positive energy from group istart:iend.
+
+    Each iteration computes the potential of every still-bound particle from all the others
+    (direct sum for up to direct_npart particles, else a Barnes-Hut octree with opening angle
+    theta) and its kinetic energy relative to their centre-of-mass velocity, and unbinds
+    those with positive total energy.  Stops after n_iter iterations or when none is removed.
+    Clears bound[i] for removed particles; returns the number of iterations done, or -1 if
+    memory could not be allocated.
+
+    pos, vel, mass, Lbox, G, eps2 (softening squared) must be in consistent units.
+    nthreads > 1 splits the potential over particles, for large groups.
+    """
+    cdef int n = iend - istart
+    cdef int i, k, ip, it, nb, nkeep
+    cdef double msum, ke
+    cdef double vcm[3]
+    cdef double *x = <double *> malloc(3*n*sizeof(double))
+    cdef double *v = <double *> malloc(3*n*sizeof(double))
+    cdef double *m = <double *> malloc(n*sizeof(double))
+    cdef double *phi = <double *> malloc(n*sizeof(double))
+    cdef int *active = <int *> malloc(n*sizeof(int))
+
+    if x == NULL or v == NULL or m == NULL or phi == NULL or active == NULL:
+        free(x)
+        free(v)
+        free(m)
+        free(phi)
+        free(active)
+        return -1
+    nogil_load_group_phys(istart, iend, pos, mass, Lbox, x, m)
+    for i in range(n):
+        active[i] = i
+        for k in range(3):
+            v[3*i+k] = vel[istart+i,k]
+    nb = n
+    it = 0
+    while it < n_iter and nb > 1:
+        it += 1
+        msum = 0.
+        for k in range(3):
+            vcm[k] = 0.
+        for i in range(nb):
+            ip = active[i]
+            msum += m[ip]
+            for k in range(3):
+                vcm[k] += m[ip]*v[3*ip+k]
+        for k in range(3):
+            vcm[k] /= msum
+
+        if nogil_group_phi(active, nb, x, m, eps2, direct_npart, theta, phi, nthreads) < 0:
+            it = -1
+            break
+
+        # keep particles with negative total energy per unit mass
+        nkeep = 0
+        for i in range(nb):
+            ip = active[i]
+            ke = 0.
+            for k in range(3):
+                ke += 0.5*(v[3*ip+k] - vcm[k])**2
+            if G*phi[i] + ke > 0.:
+                bound[istart+ip] = 0
+            else:
+                active[nkeep] = ip
+                nkeep += 1
+        if nkeep == nb:
+            break
+        nb = nkeep
+
+    free(x)
+    free(v)
+    free(m)
+    free(phi)
+    free(active)
+    return it
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef int nogil_potential_group(int istart, int iend, float[:,:] pos, float[:] mass, double Lbox, double G, double eps2, long direct_npart, double theta, float[:] pot, int nthreads) nogil:
+    """ Fills pot[istart:iend] with the potential of each particle of the group from all
+    of its other members; see nogil_group_phi.  Returns 0, or -1 if memory could not be
+    allocated. """
+    cdef int n = iend - istart
+    cdef int i, status
+    cdef double *x = <double *> malloc(3*n*sizeof(double))
+    cdef double *m = <double *> malloc(n*sizeof(double))
+    cdef double *phi = <double *> malloc(n*sizeof(double))
+    cdef int *active = <int *> malloc(n*sizeof(int))
+
+    if x == NULL or m == NULL or phi == NULL or active == NULL:
+        free(x)
+        free(m)
+        free(phi)
+        free(active)
+        return -1
+    nogil_load_group_phys(istart, iend, pos, mass, Lbox, x, m)
+    for i in range(n):
+        active[i] = i
+    status = nogil_group_phi(active, n, x, m, eps2, direct_npart, theta, phi, nthreads)
+    if status == 0:
+        for i in range(n):
+            pot[istart+i] = G*phi[i]
+
+    free(x)
+    free(m)
+    free(phi)
+    free(active)
+    return status
+
 """ ============================================================ """
 """ THESE ARE THE MAIN ROUTINE TO CALCULATE ALL GROUP PROPERTIES """
 """ ============================================================ """
@@ -431,21 +1475,22 @@ def get_group_gas_properties(group,grp_list):
             grp_ZTcgm[ig] /= grp_Tcgm[ig]
             grp_TZcgm[ig] /= grp_Zcgm[ig]
 
-    for ig in range(ng):
-        grp_list[ig].sfr = group.obj.yt_dataset.quan(grp_sfr[ig], '%s/%s' % (group.obj.units['mass'],group.obj.units['time']))
-        grp_list[ig].masses['H2'] = group.obj.yt_dataset.quan(grp_mH2[ig], group.obj.units['mass'])
-        grp_list[ig].metallicities = dict(
-            mass_weighted = group.obj.yt_dataset.quan(grp_Zm[ig], ''),
-            sfr_weighted  = group.obj.yt_dataset.quan(grp_Zsfr[ig], ''),
-            mass_weighted_cgm = group.obj.yt_dataset.quan(grp_Zcgm[ig], ''),
-            temp_weighted_cgm = group.obj.yt_dataset.quan(grp_ZTcgm[ig], '')
-        )
-        grp_list[ig].temperatures = dict(
-            mass_weighted = group.obj.yt_dataset.quan(grp_Tm[ig], group.obj.units['temperature']),
-            mass_weighted_cgm = group.obj.yt_dataset.quan(grp_Tcgm[ig], group.obj.units['temperature']),
-            metal_weighted_cgm = group.obj.yt_dataset.quan(grp_TZcgm[ig], group.obj.units['temperature'])
-        )
-        grp_list[ig].masses['dust'] = group.obj.yt_dataset.quan(grp_mdust[ig], group.obj.units['mass'])
+    from caesar.catalogue import group_catalogue
+    catalogue = group_catalogue(grp_list)
+    mass_units = group.obj.units['mass']
+    T_units = group.obj.units['temperature']
+    catalogue.set_column('sfr', np.asarray(grp_sfr, dtype=np.float64), '%s/%s' % (mass_units,group.obj.units['time']))
+    catalogue.set_column('masses', np.asarray(grp_mH2, dtype=np.float64), mass_units, key='H2')
+    catalogue.clear_dict('metallicities')
+    catalogue.set_column('metallicities', np.asarray(grp_Zm, dtype=np.float64), '', key='mass_weighted')
+    catalogue.set_column('metallicities', np.asarray(grp_Zsfr, dtype=np.float64), '', key='sfr_weighted')
+    catalogue.set_column('metallicities', np.asarray(grp_Zcgm, dtype=np.float64), '', key='mass_weighted_cgm')
+    catalogue.set_column('metallicities', np.asarray(grp_ZTcgm, dtype=np.float64), '', key='temp_weighted_cgm')
+    catalogue.clear_dict('temperatures')
+    catalogue.set_column('temperatures', np.asarray(grp_Tm, dtype=np.float64), T_units, key='mass_weighted')
+    catalogue.set_column('temperatures', np.asarray(grp_Tcgm, dtype=np.float64), T_units, key='mass_weighted_cgm')
+    catalogue.set_column('temperatures', np.asarray(grp_TZcgm, dtype=np.float64), T_units, key='metal_weighted_cgm')
+    catalogue.set_column('masses', np.asarray(grp_mdust, dtype=np.float64), mass_units, key='dust')
 
     return
 
@@ -490,13 +1535,13 @@ def get_group_star_properties(group,grp_list):
             grp_age[ig] /= grp_mass[ig]
             grp_ageZ[ig] /= grp_Zm[ig]
 
-    for ig in range(ng):
-        grp_list[ig].metallicities['stellar'] = group.obj.yt_dataset.quan(grp_Zm[ig], '')
-        grp_list[ig].sfr_100 = group.obj.yt_dataset.quan(grp_sfr100[ig]/100.e6, 'Msun/yr')
-        grp_list[ig].ages = dict(
-            mass_weighted = group.obj.yt_dataset.quan(grp_age[ig], 'Gyr'),
-            metal_weighted = group.obj.yt_dataset.quan(grp_ageZ[ig], 'Gyr')
-        )
+    from caesar.catalogue import group_catalogue
+    catalogue = group_catalogue(grp_list)
+    catalogue.set_column('metallicities', np.asarray(grp_Zm, dtype=np.float64), '', key='stellar')
+    catalogue.set_column('sfr_100', np.asarray(grp_sfr100, dtype=np.float64)/100.e6, 'Msun/yr')
+    catalogue.clear_dict('ages')
+    catalogue.set_column('ages', np.asarray(grp_age, dtype=np.float64), 'Gyr', key='mass_weighted')
+    catalogue.set_column('ages', np.asarray(grp_ageZ, dtype=np.float64), 'Gyr', key='metal_weighted')
 
     return
 
@@ -540,16 +1585,183 @@ def get_group_bh_properties(group,grp_list):
     from astropy import constants as const
     FRAD = 0.1  # assume 10% radiative efficiency
     edd_factor = (4 * np.pi * const.G * const.m_p / (FRAD * const.c * const.sigma_T)).to('1/yr').value
-    for ig in range(ng):
-        grp_list[ig].masses['bh'] = group.obj.yt_dataset.quan(bhm[ig], group.obj.units['mass'])
-        grp_list[ig].bhmdot = group.obj.yt_dataset.quan(bhrate[ig], 'Msun/yr')
-        if bhm[ig] > 0:
-            grp_list[ig].bh_fedd = group.obj.yt_dataset.quan(bhrate[ig] / (edd_factor * bhm[ig]), '')
-        else:
-            grp_list[ig].bh_fedd = group.obj.yt_dataset.quan(0.0, '')
+    from caesar.catalogue import group_catalogue
+    catalogue = group_catalogue(grp_list)
+    bhm_d = np.asarray(bhm, dtype=np.float64)
+    bhrate_d = np.asarray(bhrate, dtype=np.float64)
+    fedd = np.zeros(ng)
+    np.divide(bhrate_d, edd_factor * bhm_d, out=fedd, where=bhm_d > 0)
+    catalogue.set_column('masses', bhm_d, group.obj.units['mass'], key='bh')
+    catalogue.set_column('bhmdot', bhrate_d, 'Msun/yr')
+    catalogue.set_column('bh_fedd', fedd, '')
 
     return
 
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def group_overall_kernel(long int[:] hid_bins, float[:,:] pos, float[:,:] vel, float[:] mass, float[:] pot, int[:] ptype, int[:] group_ptypes, double[:] Densities, float Lbox, int gtflag, bint use_pot, int my_nproc, long big_npart=0, radial_method='sort'):
+    """Computes the overall properties of a set of groups from their concatenated particle data.
+
+    hid_bins: starting indexes of each group's particles, with the total count appended
+    pos, vel, mass, pot, ptype: particle data, ordered by group
+    group_ptypes: particle type integers present in this dataset
+    Densities: overdensities for virial quantities, in ascending order
+    Lbox: periodic box size in units of pos
+    gtflag: 1 for halos, 2 for galaxies, 3 for clouds
+    use_pot: if True, halo radial quantities are taken around the minimum potential
+    my_nproc: number of OpenMP threads
+    big_npart: groups with more particles than this are each processed by all threads
+               together; 0 (default) picks half of an even per-thread share of particles,
+               and at least 10000
+    radial_method: 'sort' (default) sorts each group's particles by radius; 'select' finds
+               the mass and virial radii from radius buckets in expected linear time,
+               sorting only the buckets they fall in (nogil_radial_quants_select).  The
+               radii are the same; other quantities differ by rounding.  Groups done with
+               all threads together always use the parallel sort.
+
+    Groups large enough to hold up the end of the run are done first, one at a time, with
+    parallel reductions and a parallel sort.  The rest are spread over the threads one group
+    each, every thread sorting its groups' particles in its own scratch buffer, grown as
+    needed to the largest group that thread has handled so far.
+
+    Returns grp_mtot, grp_mass, grp_count, grp_pos, grp_vel, grp_minpotpos, grp_minpotvel,
+    grp_R20, grp_Rhalf, grp_R80, grp_vdisp, grp_L, grp_mvir, grp_rvir as numpy arrays.
+    """
+    cdef:
+        int         nptypes = len(group_ptypes)
+        # general variables
+        int ng = len(hid_bins) - 1
+        int ndim = pos.shape[1]
+        int nDens = len(Densities)
+        int i,ig,ip,istart,iend,tid
+        long k
+        int nthreads = max(my_nproc, 1)
+        float mtarget
+        part_struct *grp_partinfo
+        part_struct *big_partinfo
+        part_struct *big_tmp
+        long[:] big_ids, small_ids
+        long nbig, nsmall, npbig
+        part_struct **thread_partinfo
+        long *thread_npmax
+        bint select_radii
+
+        # things to compute
+        float[:]   grp_mtot = np.zeros(ng,dtype=MY_DTYPE)  # total masses
+        float[:,:] grp_mass = np.zeros((ng,nptypes),dtype=MY_DTYPE)  # masses in the various types
+        int[:,:]   grp_count = np.zeros((ng,nptypes),dtype=np.int32)  # part counts in the various types
+        float[:,:] grp_pos = np.zeros((ng,ndim),dtype=MY_DTYPE)  # CoM positions
+        float[:,:] grp_vel = np.zeros((ng,ndim),dtype=MY_DTYPE)  # CoM velocities
+        float[:,:] grp_minpotpos = np.zeros((ng,ndim),dtype=MY_DTYPE)  # position of minimum potential
+        float[:,:] grp_minpotvel = np.zeros((ng,ndim),dtype=MY_DTYPE)  # velocity of minimum potential
+        float[:,:] grp_R20 = np.zeros((ng,nptypes+2),dtype=MY_DTYPE)  # 20% mass-enclosing radius
+        float[:,:] grp_Rhalf = np.zeros((ng,nptypes+2),dtype=MY_DTYPE)  # half-mass radius
+        float[:,:] grp_R80 = np.zeros((ng,nptypes+2),dtype=MY_DTYPE)  # 80% mass-enclosing radius 
+        float[:,:] grp_vdisp = np.zeros((ng,nptypes+2),dtype=MY_DTYPE)  # velocity dispersions
+        float[:,:,:] grp_L = np.zeros((ng,nptypes+2,7),dtype=MY_DTYPE)  # holds angular quants (Lx,Ly,Lz,ALPHA,BETA,B/T,kappa_rot)
+        float[:,:] grp_mvir = np.zeros((ng,nDens),dtype=MY_DTYPE)  # virial masses like M500, M2500, ...
+        float[:,:] grp_rvir = np.zeros((ng,nDens),dtype=MY_DTYPE)  # corresponding radii
+
+    if radial_method not in ('sort', 'select'):
+        raise ValueError("radial_method must be 'sort' or 'select', not %r" % (radial_method,))
+    select_radii = radial_method == 'select'
+
+    # split off groups too large for a single thread
+    npart = np.diff(np.asarray(hid_bins))
+    if big_npart <= 0:
+        big_npart = max(int(np.sum(npart)) // (2*nthreads), 10000)
+    if nthreads > 1:
+        big_ids = np.flatnonzero(npart > big_npart).astype(np.int64)
+    else:
+        big_ids = np.zeros(0, dtype=np.int64)
+    small_ids = np.flatnonzero(npart <= big_npart if nthreads > 1 else npart >= 0).astype(np.int64)
+    nbig = len(big_ids)
+    nsmall = len(small_ids)
+
+    if nbig > 0:
+        npbig = np.max(npart[np.asarray(big_ids)])
+        memlog('Processing %d groups with >%d particles using %d threads each'%(nbig,big_npart,nthreads))
+        big_partinfo = <part_struct *> malloc(npbig*sizeof(part_struct))
+        big_tmp = <part_struct *> malloc(npbig*sizeof(part_struct))
+        with nogil:
+            for k in range(nbig):
+                ig = big_ids[k]
+                istart = hid_bins[ig]
+                iend = hid_bins[ig+1]
+                nogil_masses_par(ig, mass, ptype, group_ptypes, istart, iend, grp_mtot, grp_mass, grp_count, nthreads)
+                nogil_CoM_quants_par(ig, pos, vel, mass, pot, grp_mtot, istart, iend, ndim, Lbox, grp_pos, grp_vel, grp_minpotpos, grp_minpotvel, nthreads)
+                if gtflag == 1 and use_pot: # if halo, use min potential for halo center
+                    nogil_load_partinfo_par(mass, pos, vel, ptype, grp_minpotpos[ig], grp_minpotvel[ig], big_partinfo, Lbox, istart, iend, ndim, nthreads)
+                else:
+                    nogil_load_partinfo_par(mass, pos, vel, ptype, grp_pos[ig], grp_vel[ig], big_partinfo, Lbox, istart, iend, ndim, nthreads)
+                nogil_sort_par(big_partinfo, big_tmp, iend-istart, nthreads)
+                nogil_velocity_dispersions_par(big_partinfo, group_ptypes, iend-istart, ndim, grp_vdisp[ig], nthreads)
+                # the type selections are independent scans of the sorted particles
+                for ip in prange(nptypes+2, num_threads=nthreads, schedule='dynamic'):
+                    mtarget = nogil_mass_target(ig, ip, grp_mass, group_ptypes)
+                    grp_R20[ig,ip] = nogil_half_mass_radius(big_partinfo, 0.2*mtarget, ip, group_ptypes, iend-istart)
+                    grp_Rhalf[ig,ip] = nogil_half_mass_radius(big_partinfo, 0.5*mtarget, ip, group_ptypes, iend-istart)
+                    grp_R80[ig,ip] = nogil_half_mass_radius(big_partinfo, 0.8*mtarget, ip, group_ptypes, iend-istart)
+                    nogil_angular_quants(big_partinfo, iend-istart, ip, group_ptypes, grp_L[ig,ip])
+                if gtflag == 1:  # only calculate these for halos
+                    nogil_virial_quants(big_partinfo, Densities, iend-istart, nDens, grp_rvir[ig], grp_mvir[ig])
+        free(big_partinfo)
+        free(big_tmp)
+
+    # one particle info buffer per thread, allocated lazily inside the loop
+    thread_partinfo = <part_struct **> malloc(nthreads*sizeof(part_struct *))
+    thread_npmax = <long *> malloc(nthreads*sizeof(long))
+    for i in range(nthreads):
+        thread_partinfo[i] = NULL
+        thread_npmax[i] = 0
+
+    ## loop over remaining objects, calculate properties for each object
+    for k in prange(nsmall,nogil=True,schedule='dynamic',num_threads=nthreads):
+        ig = small_ids[k]
+        istart = hid_bins[ig]
+        iend = hid_bins[ig+1]
+        if iend == istart:
+            continue
+
+        # get this thread's scratch buffer, growing it if this group is its largest yet;
+        # the selection path needs twice the space, for its counting sort
+        tid = threadid()
+        if iend-istart > thread_npmax[tid]:
+            free(thread_partinfo[tid])
+            thread_partinfo[tid] = <part_struct *> malloc((1+select_radii)*(iend-istart)*sizeof(part_struct))
+            thread_npmax[tid] = iend-istart
+        grp_partinfo = thread_partinfo[tid]
+
+        # masses, particle counts and center of mass quantities
+        nogil_masses_CoM(ig, pos, vel, mass, pot, ptype, group_ptypes, istart, iend, ndim, Lbox, grp_mtot, grp_mass, grp_count, grp_pos, grp_vel, grp_minpotpos, grp_minpotvel)
+
+        # get radius of each particle, sort by radii
+        if gtflag == 1 and use_pot: # if halo, use min potential for halo center
+            nogil_load_partinfo(mass, pos, vel, ptype, grp_minpotpos[ig], grp_minpotvel[ig], grp_partinfo, Lbox, istart, iend, ndim)
+        else:
+            nogil_load_partinfo(mass, pos, vel, ptype, grp_pos[ig], grp_vel[ig], grp_partinfo, Lbox, istart, iend, ndim)
+        if select_radii:
+            nogil_radial_quants_select(ig, grp_partinfo, grp_partinfo+(iend-istart), iend-istart, group_ptypes, ndim, grp_mass, grp_R20, grp_Rhalf, grp_R80, grp_vdisp, grp_L, gtflag == 1, Densities, nDens, grp_rvir[ig], grp_mvir[ig])
+            continue
+        qsort(<void*>grp_partinfo, <size_t>(iend-istart), sizeof(part_struct), mycmp)
+
+        # calculate radii, velocity dispersions, angular quantities for all ptype selections
+        nogil_radial_quants(ig, grp_partinfo, iend-istart, group_ptypes, ndim, grp_mass, grp_R20, grp_Rhalf, grp_R80, grp_vdisp, grp_L, 1)
+
+        # calculate virial quantities
+        if gtflag == 1:  # only calculate these for halos
+            nogil_virial_quants(grp_partinfo, Densities, iend-istart, nDens, grp_rvir[ig], grp_mvir[ig])
+
+    for i in range(nthreads):
+        free(thread_partinfo[i])
+    free(thread_partinfo)
+    free(thread_npmax)
+
+    return (np.asarray(grp_mtot), np.asarray(grp_mass), np.asarray(grp_count), np.asarray(grp_pos), np.asarray(grp_vel),
+            np.asarray(grp_minpotpos), np.asarray(grp_minpotvel), np.asarray(grp_R20), np.asarray(grp_Rhalf), np.asarray(grp_R80),
+            np.asarray(grp_vdisp), np.asarray(grp_L), np.asarray(grp_mvir), np.asarray(grp_rvir))
+
 @cython.cdivision(True)
 @cython.wraparound(False)
 @cython.boundscheck(False)
@@ -579,190 +1791,221 @@ def get_group_overall_properties(group,grp_list):
     for p in group.obj.data_manager.ptypes:
         pt_ints.append(ptype_ints[p])
 
-    cdef:
-        ## global quantities
-        long int[:] hid_bins = gid_bins   # starting indexes of particle IDs in each group
-        float[:,:] pos = group.obj.data_manager.pos[grpids]
-        float[:,:] vel = group.obj.data_manager.vel[grpids]
-        float[:]   mass = group.obj.data_manager.mass[grpids]
-        float[:]   pot = group.obj.data_manager.pot[grpids]
-        int[:]      ptype = group.obj.data_manager.ptype[grpids]
-        int[:]      group_ptypes = np.asarray(pt_ints,dtype=np.int32)
-        int         nptypes = len(group_ptypes)
-        # general variables
-        int ng = ngroup
-        int ndim = len(pos.T)
-        int imin = -1
-        int my_nproc = group.nproc
-        double[:] Densities = group.obj.simulation.Densities.in_units(group.obj.units['mass']+'/'+group.obj.units['length']+'**3')
-        int nDens = len(Densities)
-        float Lbox = group.obj.simulation.boxsize.d
-        bint use_pot = group.obj.load_pot
-        int gtflag,minpotpart
-        int i,j,ig,ip,ir,istart,iend,binary
-        float[3] dx
-        float mtarget
-        part_struct *grp_partinfo
-        float r200_fact, G_in_simunits
-
-        # things to compute
-        float[:]   grp_mtot = np.zeros(ngroup,dtype=MY_DTYPE)  # total masses
-        float[:,:] grp_mass = np.zeros((ngroup,nptypes),dtype=MY_DTYPE)  # masses in the various types
-        int[:,:]   grp_count = np.zeros((ngroup,nptypes),dtype=np.int32)  # part counts in the various types
-        float[:,:] grp_pos = np.zeros((ngroup,ndim),dtype=MY_DTYPE)  # CoM positions
-        float[:,:] grp_vel = np.zeros((ngroup,ndim),dtype=MY_DTYPE)  # CoM velocities
-        float[:,:] grp_minpotpos = np.zeros((ngroup,ndim),dtype=MY_DTYPE)  # position of minimum potential
-        float[:,:] grp_minpotvel = np.zeros((ngroup,ndim),dtype=MY_DTYPE)  # velocity of minimum potential
-        float[:,:] grp_R20 = np.zeros((ngroup,nptypes+2),dtype=MY_DTYPE)  # 80% mass-enclosing radius 
-        float[:,:] grp_Rhalf = np.zeros((ngroup,nptypes+2),dtype=MY_DTYPE)  # half-mass radius
-        float[:,:] grp_R80 = np.zeros((ngroup,nptypes+2),dtype=MY_DTYPE)  # 80% mass-enclosing radius 
-        float[:,:] grp_vdisp = np.zeros((ngroup,nptypes+2),dtype=MY_DTYPE)  # velocity dispersions
-        float[:,:,:] grp_L = np.zeros((ngroup,nptypes+2,7),dtype=MY_DTYPE)  # holds angular quants (Lx,Ly,Lz,ALPHA,BETA,B/T,kappa_rot)
-        float[:,:] grp_mvir = np.zeros((ngroup,nDens),dtype=MY_DTYPE)  # virial masses like M500, M2500, ...
-        float[:,:] grp_rvir = np.zeros((ngroup,nDens),dtype=MY_DTYPE)  # corresponding radii
-
-    # preliminary stuff to set up calculation of properties
-    npmax = max([hid_bins[i+1]-hid_bins[i] for i in range(0,ngroup)]) # get max number of particles in a group
-    grp_partinfo = <part_struct *> malloc(npmax*sizeof(part_struct))  # allocate particle info
     if group.obj_type == 'halo': gtflag = 1
     elif group.obj_type == 'galaxy': gtflag = 2
     elif group.obj_type == 'cloud': gtflag = 3
     else: sys.exit('Group type %s not recognized'%group.obj_type)
 
-    ## loop over objects, calculate properties for each object
-    for ig in prange(ng,nogil=True,schedule='dynamic',num_threads=my_nproc):
-    #for ig in range(ng):
-        istart = hid_bins[ig]
-        iend = hid_bins[ig+1]
-
-        # compute masses and particle counts
-        for ip in range(nptypes):
-            for i in range(istart,iend):
-                if ptype[i] == group_ptypes[ip]: 
-                    grp_mass[ig,ip] += mass[i]
-                    grp_count[ig,ip] += 1
-            grp_mtot[ig] += grp_mass[ig,ip]
-
-        # Center of mass quantities
-        nogil_CoM_quants(ig, pos, vel, mass, pot, grp_mtot, istart, iend, ndim, Lbox, grp_pos, grp_vel, grp_minpotpos, grp_minpotvel)
-
-        # get radius of each particle, sort by radii
-        if gtflag == 1 and use_pot: # if halo, use min potential for halo center
-            nogil_load_partinfo(mass, pos, vel, ptype, grp_minpotpos[ig], grp_minpotvel[ig], grp_partinfo, Lbox, istart, iend, ndim)
-        else:
-            nogil_load_partinfo(mass, pos, vel, ptype, grp_pos[ig], grp_vel[ig], grp_partinfo, Lbox, istart, iend, ndim)
-        qsort(<void*>grp_partinfo, <size_t>(iend-istart), sizeof(part_struct), mycmp)
-
-        # calculate radii, velocity dispersions, angular quantities
-        for ip in range(nptypes+2):
-            # compute total mass of a given ptype in order to set target
-            if ip == nptypes+1:  # last value stores radii for all particles together
-                mtarget = 0.
-                for i in range(nptypes):
-                    mtarget += grp_mass[ig,i]
-            elif ip == nptypes:  # second-to-last value stores baryonic radii 
-                mtarget = 0.
-                for i in range(nptypes):
-                    if group_ptypes[i] == 1 or group_ptypes[i] == 2: continue  # skip DM particles
-                    mtarget += grp_mass[ig,i]
-            else:
-                mtarget = grp_mass[ig,ip]
-            # compute radii for this ptype(s), and 20%, 50%, and 80% of total mass
-            grp_R20[ig,ip] = nogil_half_mass_radius(grp_partinfo, 0.2*mtarget, ip, group_ptypes, iend-istart)
-            grp_Rhalf[ig,ip] = nogil_half_mass_radius(grp_partinfo, 0.5*mtarget, ip, group_ptypes, iend-istart)
-            grp_R80[ig,ip] = nogil_half_mass_radius(grp_partinfo, 0.8*mtarget, ip, group_ptypes, iend-istart)
-            # compute velocity dispersions for this ptype(s)
-            grp_vdisp[ig,ip] = nogil_velocity_dispersions(grp_partinfo, ip, group_ptypes, iend-istart, ndim)
-            # calculate angular quantities for this ptypes(s)
-            nogil_angular_quants(grp_partinfo, iend-istart, ip, group_ptypes, grp_L[ig,ip])
-
-        # calculate virial quantities
-        if gtflag == 1:  # only calculate these for halos
-            nogil_virial_quants(grp_partinfo, Densities, iend-istart, nDens, grp_rvir[ig], grp_mvir[ig])
-
-    free(grp_partinfo)
+    radial_method = 'sort'
+    if 'radial_method' in group.obj._kwargs:
+        radial_method = group.obj._kwargs['radial_method']
+
+    # without a snapshot potential, optionally compute one from each group's own members
+    use_pot = group.obj.load_pot
+    pot = group.obj.data_manager.pot[grpids]
+    if not use_pot and 'compute_potential' in group.obj._kwargs and group.obj._kwargs['compute_potential']:
+        from caesar.group import group_potential
+        memlog('Computing potential of %d particles in %d %s'%(gid_bins[-1],ngroup,group_types[group.obj_type]))
+        pot[:gid_bins[-1]] = group_potential(group.obj, grpids[:gid_bins[-1]], gid_bins, group.nproc)
+        group.obj.data_manager.pot[grpids[:gid_bins[-1]]] = pot[:gid_bins[-1]]
+        use_pot = True
+
+    (grp_mtot, grp_mass, grp_count, grp_pos, grp_vel, grp_minpotpos, grp_minpotvel, grp_R20, grp_Rhalf, grp_R80,
+     grp_vdisp, grp_L, grp_mvir, grp_rvir) = group_overall_kernel(
+        gid_bins,
+        group.obj.data_manager.pos[grpids],
+        group.obj.data_manager.vel[grpids],
+        group.obj.data_manager.mass[grpids],
+        pot,
+        group.obj.data_manager.ptype[grpids],
+        np.asarray(pt_ints,dtype=np.int32),
+        group.obj.simulation.Densities.in_units(group.obj.units['mass']+'/'+group.obj.units['length']+'**3'),
+        group.obj.simulation.boxsize.d,
+        gtflag,
+        use_pot,
+        group.nproc,
+        radial_method=radial_method)
+    ng = ngroup
+    nptypes = len(pt_ints)
 
     # assign quantities to groups, with units
     from caesar.property_manager import has_ptype
     L_units = 'Msun * kpccm * km/s'
-    r200_fact = (200*group.obj.simulation.Om_z*1.3333333*np.pi*group.obj.simulation.critical_density.in_units('Msun/kpccm**3'))**(-1./3.)  
-    G_in_simunits = group.obj.simulation.G.to('(km**2 * kpc)/(Msun * s**2)')  # so we get vcirc in km/s
+    r200_fact = float((200*group.obj.simulation.Om_z*1.3333333*np.pi*group.obj.simulation.critical_density.in_units('Msun/kpccm**3'))**(-1./3.))
+    G_in_simunits = float(group.obj.simulation.G.to('(km**2 * kpc)/(Msun * s**2)'))  # so we get vcirc in km/s
     ds = group.obj.yt_dataset
-    if not group.obj.load_pot:
-        mylog.warning('Potential not found in snapshot: minpotpos/vel not computed, halo radial quantities taken around CoM')
-    for ig in range(ng):
-        mygroup = grp_list[ig]
-        mygroup.masses['total'] = group.obj.yt_dataset.quan(grp_mtot[ig], group.obj.units['mass'])
-        mbaryon = 0.
-        for ip,p in enumerate(group.obj.data_manager.ptypes):
-            if has_ptype(group.obj,p):
-                mygroup.masses[list_types[p]] = group.obj.yt_dataset.quan(grp_mass[ig,ip], group.obj.units['mass'])
-                if p is not 'dm' and p is not 'dm2':
-                    mbaryon += grp_mass[ig,ip]
-        mygroup.masses['baryon'] = group.obj.yt_dataset.quan(mbaryon, group.obj.units['mass'])
-        mygroup.pos = group.obj.yt_dataset.arr(grp_pos[ig], group.obj.units['length'])
-        mygroup.vel = group.obj.yt_dataset.arr(grp_vel[ig], group.obj.units['velocity'])
-        if group.obj.load_pot:
-            mygroup.minpotpos = group.obj.yt_dataset.arr(grp_minpotpos[ig], group.obj.units['length'])
-            mygroup.minpotvel = group.obj.yt_dataset.arr(grp_minpotvel[ig], group.obj.units['velocity'])
-        for ip in range(nptypes+2):
-            if ip == nptypes+1:
-                mygroup.radii['total_m20'] = group.obj.yt_dataset.quan(grp_R20[ig,ip], group.obj.units['length'])
-                mygroup.radii['total_half_mass'] = group.obj.yt_dataset.quan(grp_Rhalf[ig,ip], group.obj.units['length'])
-                mygroup.radii['total_m80'] = group.obj.yt_dataset.quan(grp_R80[ig,ip], group.obj.units['length'])
-                mygroup.velocity_dispersions['total'] = group.obj.yt_dataset.quan(grp_vdisp[ig,ip], group.obj.units['velocity'])
-                mygroup.rotation['total_L'] = group.obj.yt_dataset.arr( [grp_L[ig,ip,0],grp_L[ig,ip,1],grp_L[ig,ip,2]], L_units)
-                mygroup.rotation['total_ALPHA'] = group.obj.yt_dataset.quan(grp_L[ig,ip,3],'')
-                mygroup.rotation['total_BETA'] = group.obj.yt_dataset.quan(grp_L[ig,ip,4],'')
-                mygroup.rotation['total_BoverT'] = group.obj.yt_dataset.quan(grp_L[ig,ip,5],'')
-                mygroup.rotation['total_kappa_rot'] = group.obj.yt_dataset.quan(grp_L[ig,ip,6],'')
-            elif ip == nptypes:
-                mygroup.radii['baryon_m20'] = group.obj.yt_dataset.quan(grp_R20[ig,ip], group.obj.units['length'])
-                mygroup.radii['baryon_half_mass'] = group.obj.yt_dataset.quan(grp_Rhalf[ig,ip], group.obj.units['length'])
-                mygroup.radii['baryon_m80'] = group.obj.yt_dataset.quan(grp_R80[ig,ip], group.obj.units['length'])
-                mygroup.velocity_dispersions['baryon'] = group.obj.yt_dataset.quan(grp_vdisp[ig,ip], group.obj.units['velocity'])
-                mygroup.rotation['baryon_L'] = group.obj.yt_dataset.arr( [grp_L[ig,ip,0],grp_L[ig,ip,1],grp_L[ig,ip,2]], L_units)
-                mygroup.rotation['baryon_ALPHA'] = group.obj.yt_dataset.quan(grp_L[ig,ip,3],'')
-                mygroup.rotation['baryon_BETA'] = group.obj.yt_dataset.quan(grp_L[ig,ip,4],'')
-                mygroup.rotation['baryon_BoverT'] = group.obj.yt_dataset.quan(grp_L[ig,ip,5],'')
-                mygroup.rotation['baryon_kappa_rot'] = group.obj.yt_dataset.quan(grp_L[ig,ip,6],'')
-            else:
-                if has_ptype(group.obj,group.obj.data_manager.ptypes[ip]):
-                    name = list_types[group.obj.data_manager.ptypes[ip]]+'_m20'
-                    mygroup.radii[name] = group.obj.yt_dataset.quan(grp_R20[ig,ip], group.obj.units['length'])
-                    name = list_types[group.obj.data_manager.ptypes[ip]]+'_half_mass'
-                    mygroup.radii[name] = group.obj.yt_dataset.quan(grp_Rhalf[ig,ip], group.obj.units['length'])
-                    name = list_types[group.obj.data_manager.ptypes[ip]]+'_m80'
-                    mygroup.radii[name] = group.obj.yt_dataset.quan(grp_R80[ig,ip], group.obj.units['length'])
-                    mygroup.velocity_dispersions[list_types[group.obj.data_manager.ptypes[ip]]] = group.obj.yt_dataset.quan(grp_vdisp[ig,ip], group.obj.units['velocity'])
-                    name = list_types[group.obj.data_manager.ptypes[ip]]
-                    mygroup.rotation[name+'_L'] = group.obj.yt_dataset.arr( [grp_L[ig,0,ip],grp_L[ig,1,ip],grp_L[ig,2,ip]], L_units)
-                    mygroup.rotation[name+'_ALPHA'] = group.obj.yt_dataset.quan(grp_L[ig,ip,3],'')
-                    mygroup.rotation[name+'_BETA'] = group.obj.yt_dataset.quan(grp_L[ig,ip,4],'')
-                    mygroup.rotation[name+'_BoverT'] = group.obj.yt_dataset.quan(grp_L[ig,ip,5],'')
-                    mygroup.rotation[name+'_kappa_rot'] = group.obj.yt_dataset.quan(grp_L[ig,ip,6],'')
-
-        # some additional halo quantities to store
-        if mygroup.obj_type is 'halo':
-            mygroup.virial_quantities['r200'] = group.obj.yt_dataset.quan(r200_fact * grp_mtot[ig]**(1./3.), group.obj.units['length'])  # effective R200 calculated for total (FOF) mass.
-            mygroup.virial_quantities['circular_velocity'] = group.obj.yt_dataset.quan(np.sqrt(G_in_simunits * grp_mtot[ig] / mygroup.virial_quantities['r200']), group.obj.units['velocity'])  # sqrt(GM_FOF/R_200)
-            mygroup.virial_quantities['temperature'] = 3.6e5 * (mygroup.virial_quantities['circular_velocity'] / 100.0)**2  # eq 4 of Mo et al 2002 (K)
-            angular_momentum = group.obj.yt_dataset.quan(np.linalg.norm(grp_L[ig,0,:3]), L_units)
-            mygroup.virial_quantities['spin_param'] = angular_momentum / (1.4142135623730951 * mygroup.masses['total'] * mygroup.virial_quantities['circular_velocity'] * mygroup.virial_quantities['r200'])
-            for ir,rtype in enumerate(['200c','500c','2500c']):  # these should match the ones in simulation.Densities
-                mygroup.virial_quantities['r'+rtype] = group.obj.yt_dataset.quan(grp_rvir[ig,ir], group.obj.units['length'])
-                mygroup.virial_quantities['m'+rtype] = group.obj.yt_dataset.quan(grp_mvir[ig,ir], group.obj.units['mass'])
-
-        if ig < 0:
-            print('NEW: %g %g %g %g %g %g %g %g %g %g'%(mygroup.radii['total_m20'],mygroup.radii['total_half_mass'],mygroup.radii['total_m80'],mygroup.radii['baryon_m20'],mygroup.radii['baryon_half_mass'],mygroup.radii['baryon_m80'],mygroup.rotation['stellar_BoverT'],mygroup.rotation['gas_BoverT'],mygroup.rotation['stellar_kappa_rot'],mygroup.rotation['gas_kappa_rot']))
-            print('OLD: %g %g %g %g'%(grp_list[ig].radii['total_half_mass'],grp_list[ig].radii['baryon_half_mass'],grp_list[ig].radii['gas_half_mass'],grp_list[ig].radii['stellar_half_mass']))
-
-        grp_list[ig] = mygroup
-        #if ig < 5: print('%d: tot %g dm %g gas %g star %g bh %g [%g %g %g] sig %g %g %g'%(ig,np.log10(mygroup.masses['total']),np.log10(mygroup.masses['dm']),np.log10(mygroup.masses['gas']),np.log10(mygroup.masses['stellar']),np.log10(mygroup.masses['bh']),mygroup.pos[0],mygroup.pos[1],mygroup.pos[2],mygroup.velocity_dispersions['gas'],mygroup.velocity_dispersions['stellar'],mygroup.velocity_dispersions['dm']))
+    if not use_pot:
+        mylog.warning('Potential not found in snapshot: minpotpos/vel not computed, halo radial quantities taken around CoM (set compute_potential=True to compute one)')
+    from caesar.catalogue import group_catalogue
+    catalogue = group_catalogue(grp_list)
+    mass_units = group.obj.units['mass']
+    length_units = group.obj.units['length']
+    velocity_units = group.obj.units['velocity']
+    catalogue.set_column('masses', grp_mtot, mass_units, key='total')
+    mbaryon = np.zeros(ng, dtype=grp_mass.dtype)
+    for ip,p in enumerate(group.obj.data_manager.ptypes):
+        if has_ptype(group.obj,p):
+            catalogue.set_column('masses', grp_mass[:,ip], mass_units, key=list_types[p])
+            if p != 'dm' and p != 'dm2':
+                mbaryon += grp_mass[:,ip]
+    catalogue.set_column('masses', mbaryon, mass_units, key='baryon')
+    catalogue.set_column('pos', grp_pos, length_units)
+    catalogue.set_column('vel', grp_vel, velocity_units)
+    if use_pot:
+        catalogue.set_column('minpotpos', grp_minpotpos, length_units)
+        catalogue.set_column('minpotvel', grp_minpotvel, velocity_units)
+    for ip in range(nptypes+2):
+        if ip == nptypes+1:
+            name = 'total'
+            L = grp_L[:,ip,:3]
+        elif ip == nptypes:
+            name = 'baryon'
+            L = grp_L[:,ip,:3]
+        elif has_ptype(group.obj,group.obj.data_manager.ptypes[ip]):
+            name = list_types[group.obj.data_manager.ptypes[ip]]
+            L = grp_L[:,:3,ip]
+        else:
+            continue
+        catalogue.set_column('radii', grp_R20[:,ip], length_units, key=name+'_m20')
+        catalogue.set_column('radii', grp_Rhalf[:,ip], length_units, key=name+'_half_mass')
+        catalogue.set_column('radii', grp_R80[:,ip], length_units, key=name+'_m80')
+        catalogue.set_column('velocity_dispersions', grp_vdisp[:,ip], velocity_units, key=name)
+        catalogue.set_column('rotation', L, L_units, key=name+'_L')
+        catalogue.set_column('rotation', grp_L[:,ip,3], '', key=name+'_ALPHA')
+        catalogue.set_column('rotation', grp_L[:,ip,4], '', key=name+'_BETA')
+        catalogue.set_column('rotation', grp_L[:,ip,5], '', key=name+'_BoverT')
+        catalogue.set_column('rotation', grp_L[:,ip,6], '', key=name+'_kappa_rot')
+
+    # some additional halo quantities to store
+    if group.obj_type == 'halo':
+        mtot = grp_mtot.astype(np.float64)
+        r200 = ds.arr(r200_fact * mtot**(1./3.), length_units)  # effective R200 calculated for total (FOF) mass.
+        vcirc = ds.arr(np.sqrt(G_in_simunits * mtot / r200), velocity_units)  # sqrt(GM_FOF/R_200)
+        catalogue.set_column('virial_quantities', r200, key='r200')
+        catalogue.set_column('virial_quantities', vcirc, key='circular_velocity')
+        catalogue.set_column('virial_quantities', 3.6e5 * (vcirc / 100.0)**2, key='temperature')  # eq 4 of Mo et al 2002 (K)
+        angular_momentum = ds.arr(np.linalg.norm(grp_L[:,0,:3], axis=1), L_units)
+        catalogue.set_column('virial_quantities', angular_momentum / (1.4142135623730951 * catalogue.column('masses', 'total') * vcirc * r200), key='spin_param')
+        for ir,rtype in enumerate(['200c','500c','2500c']):  # these should match the ones in simulation.Densities
+            catalogue.set_column('virial_quantities', grp_rvir[:,ir], length_units, key='r'+rtype)
+            catalogue.set_column('virial_quantities', grp_mvir[:,ir], mass_units, key='m'+rtype)
 
     memlog('Computed properties for %d %s'%(group.counts[group.obj_type],group_types[group.obj_type]))
 
 
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def unbind_kernel(long int[:] hid_bins, float[:,:] pos, float[:,:] vel, float[:] mass, double Lbox, double G, double eps, int n_iter, int my_nproc, long direct_npart=1000, long big_npart=0, double theta=0.5):
+    """Iteratively unbinds a set of groups from their concatenated particle data.
+
+    hid_bins: starting indexes of each group's particles, with the total count appended
+    pos, vel, mass: particle data, ordered by group, in units consistent with G
+    Lbox: periodic box size in units of pos
+    G: gravitational constant
+    eps: Plummer softening length, in units of pos
+    n_iter: maximum number of unbinding iterations per group
+    my_nproc: number of OpenMP threads
+    direct_npart: groups (or what is left of them) up to this size use a direct-sum potential,
+               larger ones a Barnes-Hut octree with opening angle theta
+    big_npart: groups with more particles than this are each processed by all threads
+               together; 0 (default) picks the same size as group_overall_kernel
+
+    Returns bound, a uint8 array which is 1 for particles still bound, and the number of
+    iterations done for each group.  Raises MemoryError if the buffers or octree of a group
+    could not be allocated.
+    """
+    cdef:
+        int ng = len(hid_bins) - 1
+        int nthreads = max(my_nproc, 1)
+        int ig
+        long k, nbig, nsmall
+        long[:] big_ids, small_ids
+        double eps2 = eps*eps
+        unsigned char[:] bound = np.ones(hid_bins[ng], dtype=np.uint8)
+        int[:] niter = np.zeros(ng, dtype=np.int32)
+
+    npart = np.diff(np.asarray(hid_bins))
+    if big_npart <= 0:
+        big_npart = max(int(np.sum(npart)) // (2*nthreads), 10000)
+    if nthreads > 1:
+        big_ids = np.flatnonzero(npart > big_npart).astype(np.int64)
+    else:
+        big_ids = np.zeros(0, dtype=np.int64)
+    # remaining groups largest first, so that no large one is left for last
+    small = np.flatnonzero(npart <= big_npart) if nthreads > 1 else np.arange(ng)
+    small_ids = small[np.argsort(-npart[small], kind='stable')].astype(np.int64)
+    nbig = len(big_ids)
+    nsmall = len(small_ids)
+
+    with nogil:
+        for k in range(nbig):
+            ig = big_ids[k]
+            niter[ig] = nogil_unbind_group(hid_bins[ig], hid_bins[ig+1], pos, vel, mass, Lbox, G, eps2, n_iter, direct_npart, theta, bound, nthreads)
+    for k in prange(nsmall, nogil=True, schedule='dynamic', num_threads=nthreads):
+        ig = small_ids[k]
+        if hid_bins[ig+1] > hid_bins[ig]:
+            niter[ig] = nogil_unbind_group(hid_bins[ig], hid_bins[ig+1], pos, vel, mass, Lbox, G, eps2, n_iter, direct_npart, theta, bound, 1)
+
+    if np.any(np.asarray(niter) < 0):
+        raise MemoryError('unbind_kernel: could not allocate memory for %d group(s)' % np.count_nonzero(np.asarray(niter) < 0))
+    return np.asarray(bound), np.asarray(niter)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def potential_kernel(long int[:] hid_bins, float[:,:] pos, float[:] mass, double Lbox, double G, double eps, int my_nproc, long direct_npart=1000, long big_npart=0, double theta=0.5):
+    """Gravitational potential of each group's particles from the group's own members.
+
+    hid_bins: starting indexes of each group's particles, with the total count appended
+    pos, mass: particle data, ordered by group, in units consistent with G
+    Lbox: periodic box size in units of pos
+    G: gravitational constant
+    eps: Plummer softening length, in units of pos
+    my_nproc: number of OpenMP threads
+    direct_npart: groups up to this size use a direct-sum potential, larger ones a
+               Barnes-Hut octree with opening angle theta
+    big_npart: groups with more particles than this are each processed by all threads
+               together; 0 (default) picks the same size as group_overall_kernel
+
+    Returns the potential of every particle, ordered like pos, as a float32 array.  Raises
+    MemoryError if the buffers or octree of a group could not be allocated.
+    """
+    cdef:
+        int ng = len(hid_bins) - 1
+        int nthreads = max(my_nproc, 1)
+        int ig, nfailed = 0
+        long k, nbig, nsmall
+        long[:] big_ids, small_ids
+        double eps2 = eps*eps
+        float[:] pot = np.zeros(hid_bins[ng], dtype=MY_DTYPE)
+
+    npart = np.diff(np.asarray(hid_bins))
+    if big_npart <= 0:
+        big_npart = max(int(np.sum(npart)) // (2*nthreads), 10000)
+    if nthreads > 1:
+        big_ids = np.flatnonzero(npart > big_npart).astype(np.int64)
+    else:
+        big_ids = np.zeros(0, dtype=np.int64)
+    small = np.flatnonzero(npart <= big_npart) if nthreads > 1 else np.arange(ng)
+    small_ids = small[np.argsort(-npart[small], kind='stable')].astype(np.int64)
+    nbig = len(big_ids)
+    nsmall = len(small_ids)
+
+    with nogil:
+        for k in range(nbig):
+            ig = big_ids[k]
+            nfailed -= nogil_potential_group(hid_bins[ig], hid_bins[ig+1], pos, mass, Lbox, G, eps2, direct_npart, theta, pot, nthreads)
+    for k in prange(nsmall, nogil=True, schedule='dynamic', num_threads=nthreads):
+        ig = small_ids[k]
+        if hid_bins[ig+1] > hid_bins[ig]:
+            nfailed -= nogil_potential_group(hid_bins[ig], hid_bins[ig+1], pos, mass, Lbox, G, eps2, direct_npart, theta, pot, 1)
+
+    if nfailed > 0:
+        raise MemoryError('potential_kernel: could not allocate memory for %d group(s)' % nfailed)
+    return np.asarray(pot)
+
+
 """ ========================================================== """
 """ OLD CYTHON ROUTINES FOR GROUP PROPERTY CALCULATIONS        """
 """ ========================================================== """
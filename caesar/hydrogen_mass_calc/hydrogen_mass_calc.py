@@ -75,3 +75,64 @@ def assign_halo_gas_to_galaxies(
 
     """
     pass
+
+
+def selfshield_constants(redshift, fbaryon, uvb_model='FG11'):
+    """UV background constants for the self-shielding calculation.
+
+    Parameters
+    ----------
+    redshift : float
+        Snapshot redshift.
+    fbaryon : float
+        Cosmic baryon fraction, omega_baryon / omega_matter.
+    uvb_model : {'FG11', 'FG19', 'HM12', 'HM01'}, optional
+        UV background model.
+
+    Returns
+    -------
+    gamma_HI, nHss_part : float, float
+        HI photoionisation rate (zero beyond the end of the UVB table),
+        and the temperature-independent part of the Rahmati+13
+        self-shielding density.
+
+    """
+    pass
+
+
+def selfshield_kernel(gnh, gtemp, gfHI_in, gamma_HI, nHss_part, rho_thresh,
+                      my_nproc, use_table=True, nbins=256):
+    """HI and H2 fractions of gas particles, behind ``compute_selfshield``.
+
+    Cool gas between 1e-4 atoms/cm^3 and rho_thresh self-shields
+    following Rahmati+13 with HI fractions from Popping+09; denser gas
+    follows Leroy+08.  With use_table, the self-shielded HI fraction is
+    interpolated from an nbins x nbins table in (log nH, log T) built
+    once per call, which agrees with the fits to a few 1e-4 (see
+    ``scripts/check_selfshield_table.py``).  This is the default in
+    ``compute_selfshield`` unless the ``selfshield_table`` kwarg is
+    False.
+
+    Parameters
+    ----------
+    gnh, gtemp, gfHI_in : np.ndarray
+        float32 hydrogen number densities (atoms/cm^3), temperatures
+        (K) and optically thin HI fractions.
+    gamma_HI, nHss_part : float
+        From :func:`selfshield_constants`.
+    rho_thresh : float
+        Density of star forming gas, in atoms/cm^3.
+    my_nproc : int
+        Number of OpenMP threads.
+    use_table : bool, optional
+        Interpolate the self-shielded HI fraction from a table.
+    nbins : int, optional
+        Table bins in each of log nH and log T.
+
+    Returns
+    -------
+    fHI, fH2 : np.ndarray, np.ndarray
+        HI and H2 fractions of each particle.
+
+    """
+    pass
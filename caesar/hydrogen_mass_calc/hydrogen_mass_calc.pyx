@@ -9,7 +9,8 @@ from cython.parallel import prange
 from caesar.property_manager import MY_DTYPE
 
 from libc.stdio cimport printf, fflush, stderr, stdout
-from libc.math cimport sqrt as c_sqrt, fabs as c_fabs, log10 as c_log10
+from libc.stdlib cimport malloc, free
+from libc.math cimport sqrt as c_sqrt, fabs as c_fabs, log10 as c_log10, exp as c_exp
 
 cdef extern from "math.h":
     double sqrt(double x)
@@ -335,7 +336,7 @@ def assign_halo_gas_to_galaxies(
         #/if haloID == 0: print(i,max_index,internal_galaxy_index_list[max_index],np.sqrt(d2_at_max),max_mwd,np.log10(HImass[i]),np.log10(galaxy_HImass[internal_galaxy_index_list[max_index]]+1.))
     
 
-cdef double periodic(double x, double halfbox, double boxsize):
+cdef double periodic(double x, double halfbox, double boxsize) nogil:
     if x < -halfbox:
         x += boxsize
     if x >  halfbox:
@@ -351,6 +352,13 @@ cdef double periodic(double x, double halfbox, double boxsize):
 @cython.wraparound(False)
 @cython.boundscheck(False)
 def get_HIH2_masses(galaxies,aperture=30,rho_thresh=0.13):
+    ''' Compute HI and H2 masses of halos and galaxies, and within an aperture of each galaxy.
+    Each gas particle in a halo goes to the galaxy in that halo with the highest m/r^2.
+
+    The galaxies of each halo with more than a few of them are put in a kd-tree whose nodes
+    carry their largest galaxy mass, so each particle only checks galaxies within a cut-off
+    radius where m/r^2 could still beat the best found so far, or within the aperture.
+    Halos are processed in parallel, largest first. '''
 
     # get HI and H2 particle masses
     from caesar.group import collate_group_ids
@@ -360,14 +368,26 @@ def get_HIH2_masses(galaxies,aperture=30,rho_thresh=0.13):
     if ('compute_selfshielding' in galaxies.obj._kwargs and galaxies.obj._kwargs['compute_selfshielding']) or not has_property(galaxies.obj, 'gas', 'fh2'):
         compute_selfshield(galaxies.obj,grpids,rho_thresh)
 
-    # set up mass computation
-    galpos = np.asarray([i.pos for i in galaxies.obj.galaxy_list], dtype=np.float64)
-    galmass = np.asarray([i.masses['total'] for i in galaxies.obj.galaxy_list], dtype=np.float64)
+    # set up mass computation, with galaxies ordered by halo
+    galind = np.zeros(len(galaxies.obj.galaxy_list),dtype=np.int32)
+    galind_bins = np.zeros(len(galaxies.obj.halo_list)+1,dtype=np.int32)
+    ngal = 0
+    for i,h in enumerate(galaxies.obj.halo_list):
+        galind[ngal:ngal+len(h.galaxy_index_list)] = h.galaxy_index_list
+        ngal += len(h.galaxy_index_list)
+        galind_bins[i+1] = ngal
+    assert ngal==len(galaxies.obj.galaxy_list),"Assertion failed in galaxy counts: %d != %d"%(ngal,len(galaxies.obj.galaxy_list))
+    from caesar.catalogue import group_catalogue, set_group_column
+    catalogue = group_catalogue(galaxies.obj.galaxy_list)
+    galpos = np.asarray(catalogue.column('pos').d, dtype=np.float64).reshape(-1,3)[galind]
+    galmass = np.asarray(catalogue.column('masses', 'total').d, dtype=np.float64)[galind]
+    # biggest halos first, so that they do not hold up the end of the parallel loop
+    halo_work = np.diff(gid_bins) * np.diff(galind_bins)
+    order = np.argsort(-halo_work, kind='stable').astype(np.int32)
 
     cdef:
         ## global quantities
         int         nhalo = len(galaxies.obj.halo_list)
-        int         ngal = len(galaxies.obj.galaxy_list)
         int         npart = len(grpids)
         int         my_nproc = galaxies.nproc
         double      XH = galaxies.obj.simulation.XH
@@ -379,11 +399,11 @@ def get_HIH2_masses(galaxies,aperture=30,rho_thresh=0.13):
         float[:]    gas_nh = galaxies.obj.data_manager.gnh[grpids]
         float[:]    HImass = galaxies.obj.data_manager.gfHI[grpids]
         float[:]    H2mass = galaxies.obj.data_manager.gfH2[grpids]
-        int[:]      galaxy_indexes = np.zeros(ngal,dtype=np.int32)
-        int[:]      galind_bins = np.zeros(nhalo+1,dtype=np.int32)
+        int[:]      galaxy_bins = galind_bins
+        int[:]      halo_order = order
         ## general variables
         double      rho_th = rho_thresh        # atoms/cm^3
-        int         ih,ig,istart,iend,igstart,igend
+        int         ih,ik,ig,istart,iend,igstart,igend
         double      Lbox = galaxies.obj.simulation.boxsize.d
         double      apert2 = aperture*aperture
         double      myHI, myH2
@@ -396,16 +416,6 @@ def get_HIH2_masses(galaxies,aperture=30,rho_thresh=0.13):
         double[:]   halo_H2mass = np.zeros(nhalo)
 
     memlog('Doing HI/H2 calculation for %d galaxies in %d halos'%(ngal,nhalo))
-    # set up list of galaxies to process, associated to halos
-    ngal = 0
-    for ih in range(nhalo):
-        #if ih<1: print(ih,galaxies.obj.halo_list[ih].galaxy_index_list)
-        for ig in range(len(galaxies.obj.halo_list[ih].galaxy_index_list)):
-            galaxy_indexes[ngal+ig] = galaxies.obj.halo_list[ih].galaxy_index_list[ig]
-            #if ih<1: print(ig,ngal+ig,galaxies.obj.halo_list[ih].pos,galaxies.obj.galaxy_list[galaxy_indexes[ngal+ig]].pos)
-        ngal += len(galaxies.obj.halo_list[ih].galaxy_index_list)
-        galind_bins[ih+1] = ngal
-    assert ngal==len(galaxies.obj.galaxy_list),"Assertion failed in galaxy counts: %d != %d"%(ngal,len(galaxies.obj.galaxy_list))
 
     # compile HI and H2 masses for galaxies in halos
     for ih in prange(npart,nogil=True,num_threads=my_nproc):
@@ -416,36 +426,114 @@ def get_HIH2_masses(galaxies,aperture=30,rho_thresh=0.13):
         HImass[ih] *= XH * gas_mass[ih]
         H2mass[ih] *= XH * gas_mass[ih]
 
-    for ih in prange(nhalo,nogil=True,schedule='dynamic',num_threads=my_nproc):
-    #for ih in range(nhalo):
+    for ik in prange(nhalo,nogil=True,schedule='dynamic',num_threads=my_nproc):
+        ih = halo_order[ik]
         istart = hid_bins[ih]
         iend = hid_bins[ih+1]
         for ig in range(istart,iend):
             halo_HImass[ih] += HImass[ig]
-        igstart = galind_bins[ih]
-        igend = galind_bins[ih+1]
+        igstart = galaxy_bins[ih]
+        igend = galaxy_bins[ih+1]
         if igstart < igend:
             _get_galaxy_hydrogen_masses(igstart, igend, istart, iend, galaxy_pos, galaxy_mass, gas_pos, HImass, H2mass, Lbox, galaxy_HImass, galaxy_H2mass, apert_HImass, apert_H2mass, apert2)
 
-    # fill galaxy and halo lists
-    for ih in range(nhalo):
-        galaxies.obj.halo_list[ih].masses['HI'] = galaxies.obj.yt_dataset.quan(halo_HImass[ih], galaxies.obj.units['mass'])
+    # store as halo and galaxy columns, the galaxies back in list order
+    set_group_column(galaxies.obj.halo_list, 'masses', np.asarray(halo_HImass), galaxies.obj.units['mass'], key='HI')
     apert_str = '%dkpc'%aperture
-    for ig in range(ngal):
-        galaxies.obj.galaxy_list[ig].masses['HI'] = galaxies.obj.yt_dataset.quan(galaxy_HImass[ig], galaxies.obj.units['mass'])
-        galaxies.obj.galaxy_list[ig].masses['H2'] = galaxies.obj.yt_dataset.quan(galaxy_H2mass[ig], galaxies.obj.units['mass'])
-        galaxies.obj.galaxy_list[ig].masses['HI_%s'%(apert_str)] = galaxies.obj.yt_dataset.quan(apert_HImass[ig], galaxies.obj.units['mass'])
-        galaxies.obj.galaxy_list[ig].masses['H2_%s'%(apert_str)] = galaxies.obj.yt_dataset.quan(apert_H2mass[ig], galaxies.obj.units['mass'])
-        #if ig < 10: print(ig,np.log10(galaxies.obj.galaxy_list[ig].masses['HI']),np.log10(galaxies.obj.galaxy_list[ig].masses['H2']), np.log10(galaxies.obj.galaxy_list[ig].masses['HI_30kpc']), np.log10(galaxies.obj.galaxy_list[ig].masses['H2_30kpc']))
-        #if ig < 10: print(ig,np.log10(galaxies.obj.galaxy_list[ig].masses['H2']), np.log10(galaxies.obj.galaxy_list[ig].masses['H2_30kpc']), np.log10(galaxies.obj.galaxy_list[ig].masses['H2'])- np.log10(galaxies.obj.galaxy_list[ig].masses['H2_30kpc']))
+    gal_masses = np.empty((4,ngal))
+    gal_masses[:,galind] = [np.asarray(galaxy_HImass), np.asarray(galaxy_H2mass), np.asarray(apert_HImass), np.asarray(apert_H2mass)]
+    for im,name in enumerate(['HI', 'H2', 'HI_%s'%(apert_str), 'H2_%s'%(apert_str)]):
+        catalogue.set_column('masses', gal_masses[im], galaxies.obj.units['mass'], key=name)
 
     return 
 
 
+# kd-tree of the galaxies in a halo, each node holding the largest galaxy mass below it
+cdef int GAL_LEAFSIZE = 8
+
+cdef struct gal_node:
+    double lo[3]
+    double hi[3]
+    double mmax
+    int    start, end, left, right
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef void _gal_select(int *idx, double *x, int dim, int left, int right, int k) nogil:
+    """Partially sorts idx[left:right+1] by coordinate dim of x, so that idx[k] is in place."""
+    cdef int i, j, tmp
+    cdef double pivot
+    while right > left:
+        pivot = x[3*idx[(left+right)//2]+dim]
+        i = left
+        j = right
+        while i <= j:
+            while x[3*idx[i]+dim] < pivot: i += 1
+            while x[3*idx[j]+dim] > pivot: j -= 1
+            if i <= j:
+                tmp = idx[i]; idx[i] = idx[j]; idx[j] = tmp
+                i += 1
+                j -= 1
+        if k <= j: right = j
+        elif k >= i: left = i
+        else: break
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef int _gal_tree_build(gal_node *nodes, int *nnode, int *idx, double *x, double *m, int start, int end) nogil:
+    """Builds the node for idx[start:end] and its children; returns its index."""
+    cdef int i, k, dim, inode = nnode[0]
+    cdef double w, wmax
+    nnode[0] += 1
+    nodes[inode].start = start
+    nodes[inode].end = end
+    nodes[inode].left = -1
+    nodes[inode].right = -1
+    nodes[inode].mmax = 0.
+    for k in range(3):
+        nodes[inode].lo[k] = x[3*idx[start]+k]
+        nodes[inode].hi[k] = x[3*idx[start]+k]
+    for i in range(start,end):
+        if m[idx[i]] > nodes[inode].mmax: nodes[inode].mmax = m[idx[i]]
+        for k in range(3):
+            if x[3*idx[i]+k] < nodes[inode].lo[k]: nodes[inode].lo[k] = x[3*idx[i]+k]
+            if x[3*idx[i]+k] > nodes[inode].hi[k]: nodes[inode].hi[k] = x[3*idx[i]+k]
+    if end - start > GAL_LEAFSIZE:
+        dim = 0
+        wmax = -1.
+        for k in range(3):
+            w = nodes[inode].hi[k] - nodes[inode].lo[k]
+            if w > wmax:
+                wmax = w
+                dim = k
+        _gal_select(idx, x, dim, start, end-1, (start+end)//2)
+        nodes[inode].left = _gal_tree_build(nodes, nnode, idx, x, m, start, (start+end)//2)
+        nodes[inode].right = _gal_tree_build(nodes, nnode, idx, x, m, (start+end)//2, end)
+    return inode
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef double _gal_node_dist2(gal_node *node, double *q, double Lbox) nogil:
+    """Smallest squared periodic distance from q to the bounding box of node."""
+    cdef int k
+    cdef double d, dimg, d2 = 0.
+    for k in range(3):
+        d = max(max(node.lo[k] - q[k], q[k] - node.hi[k]), 0.)
+        if d > 0.:
+            dimg = max(max(node.lo[k] - q[k] - Lbox, q[k] + Lbox - node.hi[k]), 0.)
+            if dimg < d: d = dimg
+            dimg = max(max(node.lo[k] - q[k] + Lbox, q[k] - Lbox - node.hi[k]), 0.)
+            if dimg < d: d = dimg
+        d2 += d*d
+    return d2
+
 @cython.cdivision(True)
 @cython.wraparound(False)
 @cython.boundscheck(False)
-cdef void _get_galaxy_hydrogen_masses(int igstart, int igend, int istart, int iend, double[:,:] galaxy_pos, double[:] galaxy_mass, float[:,:] gpos, float[:] HImass, float[:] H2mass, float Lbox, double[:] galaxy_HImass, double[:] galaxy_H2mass, double[:] apert_HImass, double[:] apert_H2mass, double apert2) nogil:
+cdef void _get_galaxy_hydrogen_masses(int igstart, int igend, int istart, int iend, double[:,:] galaxy_pos, double[:] galaxy_mass, float[:,:] gpos, float[:] HImass, float[:] H2mass, double Lbox, double[:] galaxy_HImass, double[:] galaxy_H2mass, double[:] apert_HImass, double[:] apert_H2mass, double apert2) nogil:
     """Function to assign halo gas to galaxies.
 
     When we assign galaxies in CAESAR, we only consider dense gas.
@@ -454,109 +542,253 @@ cdef void _get_galaxy_hydrogen_masses(int igstart, int igend, int istart, int ie
     function calculates the mass weighted distance to each galaxy
     within a given halo and assigns low-density gas to the 'nearest'
     galaxy.
+
+    Tree nodes are skipped when their largest galaxy mass over their
+    smallest distance squared cannot reach the best mass weighted
+    distance so far, and they are beyond the aperture; ties go to the
+    first galaxy, as when checking every galaxy in turn.
     """
 
-    cdef int i,j,k,max_index
-    cdef double d2,mwd,max_mwd
+    cdef int i,j,k,l,ng,nnode,nstack,inode,near,far,max_index
+    cdef double d2,mwd,max_mwd,dnear,dfar
     cdef double dx[3]
+    cdef double q[3]
     cdef int ndim = 3
+    cdef double *x
+    cdef double *m
+    cdef int *idx
+    cdef int *stack
+    cdef gal_node *nodes
+
+    ng = igend - igstart
+    x = <double *>malloc(3*ng*sizeof(double))
+    m = <double *>malloc(ng*sizeof(double))
+    idx = <int *>malloc(ng*sizeof(int))
+    nodes = <gal_node *>malloc(2*ng*sizeof(gal_node))
+    stack = <int *>malloc(2*ng*sizeof(int))
+    # galaxy positions are taken relative to the first galaxy, so the tree needs no wrapping
+    for j in range(ng):
+        idx[j] = j
+        m[j] = galaxy_mass[igstart+j]
+        for k in range(ndim):
+            x[3*j+k] = periodic(galaxy_pos[igstart+j,k] - galaxy_pos[igstart,k], 0.5*Lbox, Lbox)
+    nnode = 0
+    _gal_tree_build(nodes, &nnode, idx, x, m, 0, ng)
 
     for i in range(istart,iend):
         if HImass[i] == 0. and H2mass[i] == 0.: continue  # no mass to assign
-        max_index = 0
+        for k in range(ndim):
+            q[k] = periodic(gpos[i,k] - galaxy_pos[igstart,k], 0.5*Lbox, Lbox)
+        max_index = igstart
         max_mwd   = 0.0
-        for j in range(igstart,igend):
-            d2 = 0.0
-            for k in range(ndim):
-                dx[k] = c_fabs(gpos[i,k] - galaxy_pos[j,k])
-                if dx[k] > 0.5*Lbox: 
-                    dx[k] = Lbox - dx[k]
-                d2 += dx[k]*dx[k]
-            mwd = galaxy_mass[j] / d2
-            if mwd > max_mwd:
-                    max_mwd = mwd
-                    max_index = j
-            if d2 < apert2:
-                apert_HImass[j] += HImass[i]
-                apert_H2mass[j] += H2mass[i]
-            #if c_sqrt(d2) > 5000:
-                #printf("TROUBLE? %d %d %g %g %g %g %g %g\n",j,i,gpos[i,0],galaxy_pos[j,0],c_sqrt(d2),c_sqrt(apert2),HImass[i],H2mass[i])
+        stack[0] = 0
+        nstack = 1
+        while nstack > 0:
+            nstack -= 1
+            inode = stack[nstack]
+            d2 = _gal_node_dist2(&nodes[inode], q, Lbox) * (1.-1.e-9)  # allow for rounding
+            if d2 >= apert2 and nodes[inode].mmax < max_mwd * d2:
+                continue
+            if nodes[inode].left < 0:
+                for l in range(nodes[inode].start,nodes[inode].end):
+                    j = igstart + idx[l]
+                    d2 = 0.0
+                    for k in range(ndim):
+                        dx[k] = c_fabs(gpos[i,k] - galaxy_pos[j,k])
+                        if dx[k] > 0.5*Lbox: 
+                            dx[k] = Lbox - dx[k]
+                        d2 += dx[k]*dx[k]
+                    mwd = galaxy_mass[j] / d2
+                    if mwd > max_mwd or (mwd == max_mwd and j < max_index):
+                        max_mwd = mwd
+                        max_index = j
+                    if d2 < apert2:
+                        apert_HImass[j] += HImass[i]
+                        apert_H2mass[j] += H2mass[i]
+            else:
+                # visit the closer child first
+                near = nodes[inode].left
+                far = nodes[inode].right
+                dnear = _gal_node_dist2(&nodes[near], q, Lbox)
+                dfar = _gal_node_dist2(&nodes[far], q, Lbox)
+                if dfar < dnear:
+                    near = nodes[inode].right
+                    far = nodes[inode].left
+                stack[nstack] = far
+                stack[nstack+1] = near
+                nstack += 2
         galaxy_HImass[max_index] += HImass[i]
         galaxy_H2mass[max_index] += H2mass[i]
 
+    free(x)
+    free(m)
+    free(idx)
+    free(nodes)
+    free(stack)
     return
 
 
-@cython.cdivision(True)
-@cython.wraparound(False)
-@cython.boundscheck(False)
-def compute_selfshield(caesar_obj,grpids,rho_thresh,uvb_model='FG11'):
-    # Use Rahmati+13 to get self-shielded HI fractions, and Leroy+08 to get H2 fractions
-    from caesar.property_manager import get_property
-
-    cdef double gamma_HI
+def selfshield_constants(redshift,fbaryon,uvb_model='FG11'):
+    ''' Photoionisation rate gamma_HI of the UV background at redshift, and the part of the
+    Rahmati+13 self-shielding density that does not depend on temperature.  Returns zero
+    gamma_HI beyond the end of the UVB table. '''
     from .treecool_data import UVB
     uvb = UVB[uvb_model]
 
-    if np.log10(caesar_obj.simulation.redshift + 1.0) > uvb['logz'][len(uvb['logz'])-1]:
+    if np.log10(redshift + 1.0) > uvb['logz'][len(uvb['logz'])-1]:
         gamma_HI = 0.0
     else:
-        gamma_HI = np.interp(np.log10(caesar_obj.simulation.redshift + 1.0),
+        gamma_HI = np.interp(np.log10(redshift + 1.0),
                              uvb['logz'],uvb['gH0'])
-    if uvb_model == 'FG11' or uvb_model== 'FG19' : sigmaHI = 2.63e-18 * (caesar_obj.simulation.scale_factor**0.158)
-    elif uvb_model == 'HM12': sigmaHI = 2.67e-18 * (caesar_obj.simulation.scale_factor**0.018)
-    if uvb_model == 'HM01': sigmaHI = 3.16e-18 * (caesar_obj.simulation.scale_factor**0.164)
+    scale_factor = 1.0 / (1.0 + redshift)
+    if uvb_model == 'FG11' or uvb_model== 'FG19' : sigmaHI = 2.63e-18 * (scale_factor**0.158)
+    elif uvb_model == 'HM12': sigmaHI = 2.67e-18 * (scale_factor**0.018)
+    if uvb_model == 'HM01': sigmaHI = 3.16e-18 * (scale_factor**0.164)
+    nHss_part = 6.73e-3 * (sigmaHI/2.49e-18)**(-2./3.) * (fbaryon / 0.17)**(-1./3.)
+
+    return gamma_HI, nHss_part
+
+
+def compute_selfshield(caesar_obj,grpids,rho_thresh,uvb_model='FG11'):
+    # Use Rahmati+13 to get self-shielded HI fractions, and Leroy+08 to get H2 fractions
+    gamma_HI, nHss_part = selfshield_constants(caesar_obj.simulation.redshift,
+                                               caesar_obj.simulation.omega_baryon / caesar_obj.simulation.omega_matter,
+                                               uvb_model)
+    # the shielded HI fraction is tabulated in (nH, T) unless selfshield_table=False
+    use_table = True
+    if 'selfshield_table' in caesar_obj._kwargs:
+        use_table = bool(caesar_obj._kwargs['selfshield_table'])
 
     memlog('Computing HI (Rahmati+13) and H2 (Leroy+08) fracs w/%s bkgnd (GammaHI=%g)'%(uvb_model,gamma_HI))
 
+    gfHI, gfH2 = selfshield_kernel(caesar_obj.data_manager.gnh[grpids], caesar_obj.data_manager.gT[grpids],
+                                   caesar_obj.data_manager.gfHI[grpids], gamma_HI, nHss_part, rho_thresh,
+                                   caesar_obj.nproc, use_table=use_table)
+
+    caesar_obj.data_manager.gfHI[grpids] = caesar_obj.yt_dataset.arr(gfHI, '')
+    caesar_obj.data_manager.gfH2[grpids] = caesar_obj.yt_dataset.arr(gfH2, '')
+
+    return 
+
+
+@cython.cdivision(True)
+cdef double _rahmati_fgamma(double nh, double T, double gamma_HI, double nHss_part) nogil:
+    """Rahmati+13 equations 2, 1: photoionisation rate over its optically thin value."""
+    cdef double nHss = nHss_part * (T * 1.0e-4)**0.17 * (gamma_HI * 1.0e12)**(2./3.)
+    return 0.98 * (1.0 + (nh / nHss)**(1.64))**(-2.28) + 0.02 * (1.0 + nh / nHss)**(-0.84)
+
+@cython.cdivision(True)
+cdef double _popping_fHI(double nh, double T, double gamma_HI, double fgamma_HI) nogil:
+    """Popping+09 equations 7, 6, 5: equilibrium HI fraction at photoionisation rate gamma_HI * fgamma_HI."""
+    cdef double a  = 7.982e-11                  # cm^3/s
+    cdef double b  = 0.7480
+    cdef double T0 = 3.148                      # K
+    cdef double T1 = 7.036e5                    # K
+    cdef double beta, C
+    beta     = a / (c_sqrt(T/T0) *
+                    (1.0 + c_sqrt(T/T0))**(1.0-b) *
+                    (1.0 + c_sqrt(T/T1))**(1.0+b))   # cm^3/s
+    C = nh * beta / (gamma_HI * fgamma_HI)
+    return (2.0 * C + 1.0 - c_sqrt((2.0*C+1.0)*(2.0*C+1.0) - 4.0 * C * C)) / (2.0*C)
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def selfshield_table(double gamma_HI, double nHss_part, double lognh_min, double lognh_max, double logT_min, double logT_max, int nbins=256):
+    """Tabulates log10 of the self-shielded HI fraction on an nbins x nbins grid evenly
+    spaced in log10 nH (atoms/cm^3) and log10 T (K), from the same fits as compute_selfshield.
+
+    Also returns lcrit, such that shielding is negligible (1 - fgamma_HI < 0.01) where
+    log10 nH - 0.17 log10(T/1e4) < lcrit; this is exact, as fgamma_HI only depends on nH/nHss.
+    """
+    cdef int i, j, it
+    cdef double lo, hi, x
+    cdef double dlnh = (lognh_max - lognh_min) / (nbins-1)
+    cdef double dlT = (logT_max - logT_min) / (nbins-1)
+    cdef double[:,:] table = np.zeros((nbins,nbins))
+
+    for i in range(nbins):
+        for j in range(nbins):
+            x = _rahmati_fgamma(10.**(lognh_min+i*dlnh), 10.**(logT_min+j*dlT), gamma_HI, nHss_part)
+            table[i,j] = c_log10(_popping_fHI(10.**(lognh_min+i*dlnh), 10.**(logT_min+j*dlT), gamma_HI, x))
+
+    # fgamma_HI falls with nH/nHss; bisect for 1 - fgamma_HI = 0.01 in log10 nH at T = 1e4 K
+    lo = -10.
+    hi = 10.
+    for it in range(200):
+        x = 0.5*(lo+hi)
+        if 1. - _rahmati_fgamma(10.**x, 1.e4, gamma_HI, nHss_part) < 1.e-2: lo = x
+        else: hi = x
+
+    return np.asarray(table), lo
+
+@cython.cdivision(True)
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def selfshield_kernel(float[:] gnh, float[:] gtemp, float[:] gfHI_in, double gamma_HI, double nHss_part, double rho_thresh, int my_nproc, bint use_table=True, int nbins=256):
+    """HI and H2 fractions of gas particles with hydrogen number density gnh (atoms/cm^3),
+    temperature gtemp (K) and optically thin HI fraction gfHI_in.
+
+    Cool gas between 1e-4 atoms/cm^3 and rho_thresh self-shields following Rahmati+13,
+    with HI fractions from Popping+09; denser gas follows Leroy+08.  With use_table, the
+    self-shielded HI fraction is interpolated bilinearly in log10 from selfshield_table
+    for temperatures above 10 K; otherwise, and without a UV background, it is evaluated
+    for each particle.
+    """
+
     cdef:
         ## density thresholds in atoms/cm^3
         double    low_rho_thresh = 0.0001       # atoms/cm^3
         double    rho_th      = rho_thresh
-        double    XH          = caesar_obj.simulation.XH
         double    FSHIELD     = 0.99
-        double    redshift    = caesar_obj.simulation.redshift
         ## Leroy et al 2008, Fig17 (THINGS) Table 6 ##
         double    P0BLITZ     = 1.7e4
         double    ALPHA0BLITZ = 0.8
-        ## Popping+09 constants (equation 7)
-        int    i
-        double beta, xi, nHss, fgamma_HI, C, Rmol, fHI, fH2, cold_phase_massfrac 
-        double a  = 7.982e-11                  # cm^3/s
-        double b  = 0.7480
-        double T0 = 3.148                      # K
-        double T1 = 7.036e5                    # K
-        double sigHI     = sigmaHI
-        double fbaryon   = caesar_obj.simulation.omega_baryon / caesar_obj.simulation.omega_matter
-        double nHss_part = 6.73e-3 * (sigHI/2.49e-18)**(-2./3.) * (fbaryon / 0.17)**(-1./3.)
-        ## gas quantities
-        float[:]   gmass = caesar_obj.data_manager.mass[grpids]
-        float[:]   gnh = caesar_obj.data_manager.gnh[grpids]
-        float[:]   gtemp = caesar_obj.data_manager.gT[grpids]
-        int        npart = len(gmass)
-        int        my_nproc = caesar_obj.nproc
+        int    i, ix, iy, npart = len(gnh)
+        double fgamma_HI, Rmol, fHI, fH2, cold_phase_massfrac
+        ## lookup table in log10 nH, log10 T
+        double lognh_min = c_log10(low_rho_thresh)
+        double lognh_max = c_log10(rho_th)
+        double logT_min = 1.0
+        double logT_max = 5.0
+        double dlnh = (lognh_max - lognh_min) / (nbins-1)
+        double dlT = (logT_max - logT_min) / (nbins-1)
+        double lcrit = 0.
+        double lnh, lT, tx, ty
+        double LN10 = np.log(10.)
+        double[:,:] table
         # things to compute
-        float[:]   gfHI = caesar_obj.data_manager.gfHI[grpids]
+        float[:]   gfHI = np.array(gfHI_in, dtype=MY_DTYPE)
         float[:]   gfH2 = np.zeros(npart,dtype=MY_DTYPE)
 
+    use_table = use_table and gamma_HI > 0. and rho_th > low_rho_thresh
+    if use_table:
+        table, lcrit = selfshield_table(gamma_HI, nHss_part, lognh_min, lognh_max, logT_min, logT_max, nbins)
+    else:
+        table = np.zeros((2,2))
+
     # determine HI, H2 fractions for all particles
-    for i in prange(npart,nogil=True,schedule='dynamic',num_threads=my_nproc):
+    for i in prange(npart,nogil=True,schedule='static',num_threads=my_nproc):
         fHI = gfHI[i]
         fH2 = 0.0
         ## low density cool gas self-shields following Rahmati+13
         if gnh[i] < rho_th and gnh[i] > low_rho_thresh and gtemp[i] < 1.e5:
-            ## Rahmati+13 equations 2, 1
-            nHss      = nHss_part * (gtemp[i] * 1.0e-4)**0.17 * (gamma_HI * 1.0e12)**(2./3.)
-            fgamma_HI = 0.98 * (1.0 + (gnh[i] / nHss)**(1.64))**(-2.28) + 0.02 * (1.0 + gnh[i] / nHss)**(-0.84)
-            if 1.-fgamma_HI < 1.e-2 and gfHI[i]>0: continue  # no significant self-shielding adjustment needed; skip
-            ### Popping+09 equation 7
-            beta     = a / (c_sqrt(gtemp[i]/T0) *
-                            (1.0 + c_sqrt(gtemp[i]/T0))**(1.0-b) *
-                            (1.0 + c_sqrt(gtemp[i]/T1))**(1.0+b))   # cm^3/s
-            ## Popping+09 equations 6, 5
-            C = gnh[i] * beta / (gamma_HI * fgamma_HI)
-            fHI = (2.0 * C + 1.0 - c_sqrt((2.0*C+1.0)*(2.0*C+1.0) - 4.0 * C * C)) / (2.0*C)
-            #printf("=== %g %g %g %g %g %g\n",gnh[i],gtemp[i],gfHI[i],fHI,fgamma_HI,nHss)
+            if use_table and gtemp[i] >= 10.:
+                lnh = c_log10(gnh[i])
+                lT = c_log10(gtemp[i])
+                if lnh - 0.17*(lT - 4.) < lcrit and gfHI[i]>0: continue  # no significant self-shielding adjustment needed; skip
+                tx = (lnh - lognh_min) / dlnh
+                ty = (lT - logT_min) / dlT
+                ix = min(max(<int>tx, 0), nbins-2)
+                iy = min(max(<int>ty, 0), nbins-2)
+                tx = tx - ix
+                ty = ty - iy
+                fHI = c_exp(LN10 * ((1.-tx) * ((1.-ty) * table[ix,iy] + ty * table[ix,iy+1]) +
+                                    tx * ((1.-ty) * table[ix+1,iy] + ty * table[ix+1,iy+1])))
+            else:
+                fgamma_HI = _rahmati_fgamma(gnh[i], gtemp[i], gamma_HI, nHss_part)
+                if 1.-fgamma_HI < 1.e-2 and gfHI[i]>0: continue  # no significant self-shielding adjustment needed; skip
+                fHI = _popping_fHI(gnh[i], gtemp[i], gamma_HI, fgamma_HI)
 
         if gnh[i] >= rho_th:  # dense gas
             cold_phase_massfrac = (1.0e8 - gtemp[i])/1.0e8
@@ -567,119 +799,57 @@ def compute_selfshield(caesar_obj,grpids,rho_thresh,uvb_model='FG11'):
         gfHI[i]    = fHI 
         gfH2[i]    = fH2
 
-    caesar_obj.data_manager.gfHI[grpids] = caesar_obj.yt_dataset.arr(gfHI, '')
-    caesar_obj.data_manager.gfH2[grpids] = caesar_obj.yt_dataset.arr(gfH2, '')
-
-    return 
+    return np.asarray(gfHI), np.asarray(gfH2)
 
-@cython.cdivision(True)
-@cython.wraparound(False)
-@cython.boundscheck(False)
 def get_aperture_masses(galaxies,aperture=30):
     ''' Compute aperture masses in various quantities.  The aperture should be specified
-    in the same units as the galaxy positions in data_manager, usually ckpc '''
+    in the same units as the galaxy positions in data_manager, usually ckpc.
+
+    Only particles in a galaxy's own halo count towards its aperture masses.  These are
+    found from a periodic tree of all halo particles (shared through obj.spatial_index),
+    with threaded ball queries around batches of galaxies. '''
 
     from caesar.group import collate_group_ids
-    from caesar.property_manager import has_property,ptype_ints
+    from caesar.property_manager import ptype_ints
 
     _, grpids, gid_bins = collate_group_ids(galaxies.obj.halo_list,'all',galaxies.obj.simulation.ntot)
+    grpids = grpids[:gid_bins[-1]]
 
-    # set up mass computation
-    galpos = np.asarray([i.pos for i in galaxies.obj.galaxy_list], dtype=np.float64)
-    galmass = np.asarray([i.masses['total'] for i in galaxies.obj.galaxy_list], dtype=np.float64)
-    ptype_array = []
-    for pt in ['gas','star','dm']:  # this is the ordering for ptypes to be computed
-        ptype_array.append(ptype_ints[pt])
-    ptype_array = np.array(ptype_array,dtype=np.int32)
-
-    cdef:
-        ## global quantities
-        int         nhalo = len(galaxies.obj.halo_list)
-        int         ngal = len(galaxies.obj.galaxy_list)
-        int         npart = len(grpids)
-        int         my_nproc = galaxies.nproc
-        long int[:] hid_bins = gid_bins   # starting indexes of particle IDs in each halo
-        double[:,:] galaxy_pos = galpos
-        double[:]   galaxy_mass = galmass
-        float[:,:]  ppos = galaxies.obj.data_manager.pos[grpids]
-        float[:]    pmass = galaxies.obj.data_manager.mass[grpids]
-        int[:]      ptype = galaxies.obj.data_manager.ptype[grpids]
-        int[:]      galaxy_indexes = np.zeros(ngal,dtype=np.int32)
-        int[:]      galind_bins = np.zeros(nhalo+1,dtype=np.int32)
-        ## general variables
-        int         ih,ig,istart,iend,igstart,igend
-        double      Lbox = galaxies.obj.simulation.boxsize.d
-        double      apert2 = aperture*aperture
-        int[:]      ptypes = ptype_array
-        long int[:] gas_index = np.zeros(npart,dtype=np.int64)
-        ## things to compute
-        double[:]   galaxy_gmass = np.zeros(ngal)
-        double[:]   galaxy_smass = np.zeros(ngal)
-        double[:]   galaxy_dmmass = np.zeros(ngal)
-
+    nhalo = len(galaxies.obj.halo_list)
+    ngal = len(galaxies.obj.galaxy_list)
+    batch = 1024  # galaxies per query, to bound the size of the neighbour lists
     memlog('Doing aperture mass calculation R=%g kpc'%aperture)
-    # set up list of galaxies to process, associated to halos
-    ngal = 0
-    for ih in range(nhalo):
-        for ig in range(len(galaxies.obj.halo_list[ih].galaxy_index_list)):
-            galaxy_indexes[ngal+ig] = galaxies.obj.halo_list[ih].galaxy_index_list[ig]
-        ngal += len(galaxies.obj.halo_list[ih].galaxy_index_list)
-        galind_bins[ih+1] = ngal
-
-    # associate gas indexes to overall indexes, so we can properly index HImass and H2mass
-    ih = 0
-    for ig in range(npart):
-        if ptype[ig] == ptypes[0]: 
-            gas_index[ig] = ih
-            ih += 1
-
-    for ih in prange(nhalo,nogil=True,schedule='dynamic',num_threads=my_nproc):
-        istart = hid_bins[ih]
-        iend = hid_bins[ih+1]
-        igstart = galind_bins[ih]
-        igend = galind_bins[ih+1]
-        if igstart < igend:
-            get_galaxy_aperture_masses(igstart, igend, istart, iend, galaxy_pos, pmass, ppos, ptype, Lbox, galaxy_gmass, galaxy_smass, galaxy_dmmass, ptypes, apert2, gas_index)
 
-    # fill galaxy and halo lists
+    # halo of each particle and of each galaxy
+    part_halo = np.repeat(np.arange(nhalo, dtype=np.int64), np.diff(gid_bins))
+    gal_halo = np.full(ngal, -1, dtype=np.int64)
+    for ih in range(nhalo):
+        gal_halo[np.asarray(galaxies.obj.halo_list[ih].galaxy_index_list, dtype=np.int64)] = ih
+    from caesar.catalogue import group_catalogue
+    catalogue = group_catalogue(galaxies.obj.galaxy_list)
+    galpos = np.asarray(catalogue.column('pos').d, dtype=np.float64)
+    pmass = galaxies.obj.data_manager.mass[grpids]
+    ptype = galaxies.obj.data_manager.ptype[grpids]
+    Lbox = galaxies.obj.simulation.boxsize.d
+
+    key = ('halo', galaxies.obj.spatial_index.selection_key(grpids), galaxies.obj.units['length'])
+    builder = lambda: (galaxies.obj.data_manager.pos[grpids], Lbox, None)
+    apert_mass = np.zeros((3,ngal))
+    for ig0 in range(0, ngal, batch):
+        ig1 = min(ig0+batch, ngal)
+        start, ind, dist = galaxies.obj.spatial_index.neighbors(key, builder, galpos[ig0:ig1], aperture)
+        seg = np.repeat(np.arange(ig1-ig0), np.diff(start))
+        keep = (dist < aperture) & (part_halo[ind] == gal_halo[ig0:ig1][seg])
+        seg = seg[keep]
+        ind = ind[keep]
+        for ip,pt in enumerate(['gas','star','dm']):
+            sel = ptype[ind] == ptype_ints[pt]
+            apert_mass[ip,ig0:ig1] = np.bincount(seg[sel], weights=pmass[ind[sel]], minlength=ig1-ig0)
+
+    # store as galaxy columns
     apert_str = '%dkpc'%int(aperture)
-    for ig in range(ngal):
-        galaxies.obj.galaxy_list[ig].masses['gas_%s'%(apert_str)] = galaxies.obj.yt_dataset.quan(galaxy_gmass[ig], galaxies.obj.units['mass'])
-        galaxies.obj.galaxy_list[ig].masses['stellar_%s'%(apert_str)] = galaxies.obj.yt_dataset.quan(galaxy_smass[ig], galaxies.obj.units['mass'])
-        galaxies.obj.galaxy_list[ig].masses['dm_%s'%(apert_str)] = galaxies.obj.yt_dataset.quan(galaxy_dmmass[ig], galaxies.obj.units['mass'])
-        #if ig < 10: print(ig,np.log10(galaxies.obj.galaxy_list[ig].masses['stellar']),galaxies.obj.galaxy_list[ig].sfr, np.log10(galaxies.obj.galaxy_list[ig].masses['stellar_30kpc']), np.log10(galaxies.obj.galaxy_list[ig].masses['dm_30kpc']))
+    for ip,pt in enumerate(['gas','stellar','dm']):
+        catalogue.set_column('masses', apert_mass[ip], galaxies.obj.units['mass'], key='%s_%s'%(pt,apert_str))
     memlog('filled galaxy_lists')
 
     return 
-
-@cython.cdivision(True)
-@cython.wraparound(False)
-@cython.boundscheck(False)
-cdef void get_galaxy_aperture_masses(int igstart, int igend, int istart, int iend, double[:,:] galaxy_pos, float[:] pmass, float[:,:] ppos, int[:] ptype, float Lbox, double[:] galaxy_gmass, double[:] galaxy_smass, double[:] galaxy_dmmass, int[:] ptypes, float apert2, long int[:] gas_index) nogil:
-    """Function to compute aperture masses for galaxies within halos.
-    Note that this only looks at mass within a galaxy's halo, so it may miss some mass
-    particularly for satellites on the outskirts of the halo.
-    Should be good for centrals, though!
-
-    """
-
-    cdef int i,j,k
-    cdef double d2
-    cdef double dx[3]
-
-    for i in range(istart,iend):
-        for j in range(igstart,igend):
-            d2 = 0.0
-            for k in range(3):
-                dx[k] = c_fabs(ppos[i,k] - galaxy_pos[j,k])
-                if dx[k] > 0.5*Lbox: 
-                    dx[k] = Lbox - dx[k]
-                d2 += dx[k]*dx[k]
-            if d2 < apert2:
-                if ptype[i] == ptypes[0]: galaxy_gmass[j] += pmass[i]
-                if ptype[i] == ptypes[1]: galaxy_smass[j] += pmass[i]
-                if ptype[i] == ptypes[2]: galaxy_dmmass[j] += pmass[i]
-                d2 = apert2
-
-    return
-
@@ -20,16 +20,17 @@ def link_galaxies_and_halos(obj):
 
     mylog.info('Linking galaxies and halos')
     
+    halos = obj.halos
+    galaxies = obj.galaxies
+
     # halos
-    for halo in obj.halos:
-        halo.galaxies = []
-        for galaxy_index in halo.galaxy_index_list:
-            halo.galaxies.append(obj.galaxies[galaxy_index])
+    for halo in halos:
+        halo.galaxies = [galaxies[i] for i in np.asarray(halo.galaxy_index_list, dtype=np.int64).tolist()]
     
     # galaxies
-    for galaxy in obj.galaxies:
+    for galaxy in galaxies:
         if galaxy.parent_halo_index > -1:
-            galaxy.halo = obj.halos[galaxy.parent_halo_index]
+            galaxy.halo = halos[galaxy.parent_halo_index]
         else:
             galaxy.halo = None
 
@@ -54,15 +55,16 @@ def link_clouds_and_galaxies(obj):
   
     mylog.info('Linking clouds and galaxies')
 
+    galaxies = obj.galaxies
+    clouds = obj.clouds
+
     #galaxies
-    for galaxy in obj.galaxies:
-        galaxy.clouds = []
-        for cloud_index in galaxy.cloud_index_list:
-            galaxy.clouds.append(obj.clouds[cloud_index])
+    for galaxy in galaxies:
+        galaxy.clouds = [clouds[i] for i in np.asarray(galaxy.cloud_index_list, dtype=np.int64).tolist()]
     
-    for cloud in obj.clouds:
+    for cloud in clouds:
         if cloud.parent_galaxy_index > -1:
-            cloud.galaxy = obj.galaxies[cloud.parent_galaxy_index]
+            cloud.galaxy = galaxies[cloud.parent_galaxy_index]
         else:
             cloud.galaxy = None
 
@@ -26,6 +26,10 @@ from collections.abc import Sequence, Mapping
 
 import h5py
 import numpy as np
+try:
+    import hdf5plugin  # registers the Blosc/Zstd filters the saver can use
+except ImportError:
+    pass
 from yt.units.yt_array import YTArray, UnitRegistry
 from yt.funcs import mylog, get_hash
 
@@ -303,6 +307,12 @@ class CAESAR:
         self._ds = value
         self._ds_type = DatasetType(self._ds)
 
+    @property
+    def spatial_index(self):
+        """On demand :class:`spatial_index.SpatialIndex` of shared kd-trees."""
+        from caesar.spatial_index import get_spatial_index
+        return get_spatial_index(self)
+
     @property
     def central_galaxies(self):
         return [h.central_galaxy for h in self.halos]
@@ -362,7 +372,7 @@ class Group:
                             printer=True):
         from caesar.zoom_funcs import construct_lowres_tree
 
-        construct_lowres_tree(self, lowres)
+        key, builder = construct_lowres_tree(self, lowres)
 
         if self.obj_type == 'halo':
             halo = self
@@ -375,9 +385,8 @@ class Group:
 
         r = halo.radii['virial'].d * search_factor
 
-        result = self.obj._lowres['TREE'].query_ball_point(halo.pos.d, r)
-        ncontam = len(result)
-        lrmass = np.sum(self.obj._lowres['MASS'][result])
+        ncontam = self.obj.spatial_index.count(key, builder, halo.pos.d, r)
+        lrmass = self.obj.spatial_index.sum_within(key, builder, halo.pos.d, r)[0]
 
         self.contamination = lrmass / halo.masses['total'].d
 
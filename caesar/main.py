@@ -30,6 +30,19 @@ class CAESAR(object):
         Time unit to store data with. Defaults to 'yr'.
     temperature : str, optional
         Temperature unit to store data with. Defaults to 'K'.
+    reader : str, optional
+        Backend for reading particle data.  'yt' (default), or 'hdf5'
+        to read GIZMO/Gadget HDF5 snapshots directly with h5py.
+    io_threads : int, optional
+        Number of sub-files/hyperslabs the 'hdf5' reader reads
+        concurrently.  Defaults to 8.
+    field_cache : float, optional
+        Memory budget in GB for caching snapshot fields that are read
+        more than once.  Defaults to 0 (off), so that no extra memory
+        is held unless asked for.
+    spatial_index_cache : float, optional
+        Memory budget in GB for caching kd-trees shared between
+        neighbour searches.  Defaults to 2; 0 disables the cache.
 
     Examples
     --------
@@ -101,7 +114,10 @@ class CAESAR(object):
             self.hash = get_hash(infile)
 
         self._ds = value
-        self._ds_type = DatasetType(self._ds)
+        reader = self._kwargs['reader'] if 'reader' in self._kwargs else 'yt'
+        io_threads = self._kwargs['io_threads'] if 'io_threads' in self._kwargs else 8
+        cache_size = self._kwargs['field_cache'] if 'field_cache' in self._kwargs else 0.
+        self._ds_type = DatasetType(self._ds, reader=reader, io_threads=io_threads, cache_size=cache_size)
         self._assign_simulation_attributes()
         
     @property
@@ -120,6 +136,12 @@ class CAESAR(object):
         else:
             return False
         
+    @property
+    def spatial_index(self):
+        """On demand :class:`spatial_index.SpatialIndex` of shared kd-trees."""
+        from caesar.spatial_index import get_spatial_index
+        return get_spatial_index(self)
+
     @property
     def data_manager(self):
         """On demand DataManager class."""
@@ -245,21 +267,26 @@ class CAESAR(object):
         link.create_sublists(self)
 
 
-    def save(self, filename):
+    def save(self, filename, **kwargs):
         """Save CAESAR file.
 
         Parameters
         ----------
         filename : str
             The name of the output file.
+        compression : {'gzip', 'lzf', 'blosc', 'zstd', None}, optional
+            Compression filter of the datasets (default gzip level 1);
+            see :func:`saver.save` for this and the other options
+            (compression_opts, shuffle, nproc).
 
         Examples
         --------
         >>> obj.save('output.hdf5')
+        >>> obj.save('output.hdf5', compression='lzf', shuffle=True)
 
         """        
         from caesar.saver import save
-        save(self, filename)
+        save(self, filename, **kwargs)
     
     def member_search(self, *args, **kwargs):
         """Meat and potatoes of CAESAR.
@@ -274,6 +301,11 @@ class CAESAR(object):
             Unbind halos?  Defaults to False
         unbind_galaxies : boolean, optional
             Unbind galaxies?  Defaults to False
+        unbind_iterations : int, optional
+            Maximum number of unbinding passes per group.  Defaults to 10.
+        unbind_softening : float, optional
+            Plummer softening used for the unbinding potential, in
+            code length units.  Defaults to 0.
         b_halo : float, optional
             Quantity used in the linking length (LL) for halos.
             LL = mean_interparticle_separation * b_halo.  Defaults to 
@@ -297,8 +329,45 @@ class CAESAR(object):
             Sets minimum group size for fof6d
         fof6d_velLL: float, optional
             Sets linking length for velocity in fof6d
+        fof6d_shared: boolean, optional
+            With nproc>1, fof6d workers read particle data from
+            memory-mapped files shared by all of them, rather than each
+            halo's particles being copied to them.  Defaults to True.
         nproc: int, optional
-            Sets number of processors for fof6d and progen_rad
+            Sets number of processors for 3D FOF, fof6d and progen_rad
+        fof_engine: str, optional
+            3D FOF implementation to use for halos: ``'caesar'`` (the
+            default, a parallel periodic cell-linked-list FOF) or
+            ``'yt'`` (yt's serial ParticleContourTree).
+        radial_method: str, optional
+            How group mass radii and virial radii are found: ``'sort'``
+            (the default) sorts each group's particles by radius;
+            ``'select'`` only sorts the few radius buckets those radii
+            fall in, which is faster for large groups.
+        compute_potential : boolean, optional
+            If the snapshot has no Potential field, compute one for
+            grouped particles from the members of each group (with a
+            Barnes-Hut tree for large groups), so that minimum-potential
+            centres are still found.  Defaults to False.
+        potential_softening : float, optional
+            Plummer softening used by ``compute_potential``, in code
+            length units.  Defaults to 0.
+        so_masses : boolean, optional
+            Compute halo m200c/m500c/m2500c and radii from all particles
+            around each halo with a periodic kd-tree, rather than from
+            FOF members only.  Defaults to False.
+        so_search_factor : float, optional
+            Initial ``so_masses`` search radius, in units of the radius
+            enclosing the FOF mass at 200 times critical.  Defaults to 1.5.
+        so_max_iter : int, optional
+            Number of times the ``so_masses`` search radius is doubled for
+            halos still above the lowest overdensity at its edge; a warning
+            is issued for any left after the last.  Defaults to 3.
+        selfshield_table : boolean, optional
+            When HI/H2 fractions are computed by CAESAR, interpolate the
+            Rahmati+13 self-shielded HI fraction from a table in density
+            and temperature rather than evaluating it per particle.
+            Defaults to True.
         blackholes : boolean, optional
             Indicate if blackholes are present in your simulation.  
             This must be toggled on manually as there is no clear 
@@ -352,6 +421,10 @@ class CAESAR(object):
         from caesar.zoom_funcs import all_object_contam_check
         all_object_contam_check(self)
 
+        cache = self._ds_type.cache
+        mylog.info('Field cache: %d hits, %d misses, %.2f GB in use' %
+                   (cache.hits, cache.misses, cache.nbytes / 1024.**3))
+
 
     def vtk_vis(self, **kwargs):
         """Method to visualize an entire simulation with VTK.
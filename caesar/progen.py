@@ -130,35 +130,30 @@ def collect_group_IDs(obj, data_type, part_type, snap_dir):
         snapfile = snap_dir+'/'+obj.simulation.basename.decode('utf-8')
     all_pids = np.array(readsnap(snapfile,'pid',part_type),dtype=np.uint64)
 
-    from caesar.fubar_halo import plist_dict
+    from caesar.group import plist_dict, collate_group_lists, gather_ranges
+    from caesar.loader import LazyDataset
     if data_type == 'halo':
-        part_list = 'obj.halos[i].%s'%plist_dict[part_type]
-        ngroups = len(obj.halos)
+        groups = obj.halos
     elif data_type == 'galaxy':
-        part_list = 'obj.galaxies[i].%s'%plist_dict[part_type]
-        ngroups = len(obj.galaxies)
+        groups = obj.galaxies
     elif data_type == 'cloud':
-        part_list = 'obj.clouds[i].%s'%plist_dict[part_type]
-        ngroups = len(obj.clouds)
-
-    # count number of total particles in groups
-    npart = 0
-    for i in range(ngroups):
-        mylist = eval(part_list)
-        npart += len(mylist)
+        groups = obj.clouds
+    ngroups = len(groups)
+
+    # gather the index lists of all groups
+    name = plist_dict[part_type]
+    stored = getattr(obj, '_%s_%s' % (data_type, name), None)
+    if isinstance(stored, LazyDataset) and ngroups > 0:  # loaded from a caesar file: slice the stored lists directly
+        data = getattr(obj, '_%s_data' % data_type)
+        mylist, bins = gather_ranges(stored[:], data['%s_start' % name][:], data['%s_end' % name][:])
+    else:
+        mylist, bins = collate_group_lists(groups, name)
+    npart = bins[-1]
 
     # fill particle and group ID lists
-    pids = np.zeros(npart,dtype=np.int64)
-    gids = np.zeros(npart,dtype=np.int32)
-    pid_hash = np.zeros(ngroups,dtype=np.int64)
-    count = 0
-    for i in range(ngroups):
-        mylist = eval(part_list)
-        pids[count:count+len(mylist)] = all_pids[mylist]
-        gids[count:count+len(mylist)] = np.full(len(mylist),i)
-        pid_hash[i] = count
-        count += len(mylist)
-    pid_hash = np.append(pid_hash,npart+1)
+    pids = np.asarray(all_pids[mylist.astype(np.int64)], dtype=np.int64)
+    gids = np.repeat(np.arange(ngroups, dtype=np.int32), np.diff(bins))
+    pid_hash = np.append(bins[:-1], npart+1)
 
     return ngroups, pids, gids, pid_hash
 
@@ -72,6 +72,87 @@ grid_datasets = [
     'RAMSESDataset',
 ]
 
+class FieldCache(object):
+    """Least-recently-used cache of particle fields with a memory budget.
+
+    Entries are keyed by (ptype, prop, selection).  When adding an entry
+    would exceed ``max_bytes``, the least recently used entries are
+    evicted; arrays larger than the whole budget are never cached.
+    Cached arrays are marked read-only and handed out as they are, so a
+    hit costs no copy; callers that modify a field in place must copy it
+    first.  Hits and misses are counted overall and per key, so that it
+    is easy to see which fields are requested repeatedly.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory budget in bytes; 0 disables caching.
+
+    """
+    def __init__(self, max_bytes):
+        from collections import OrderedDict
+        self.max_bytes = max_bytes
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.counts    = {}  # key -> [hits, misses]
+        self._data     = OrderedDict()
+
+    @staticmethod
+    def selection_key(selection):
+        """Hashable description of a selection mask/index array."""
+        if selection is None:
+            return 'all'
+        import hashlib
+        selection = np.ascontiguousarray(selection)
+        return (selection.dtype.str, selection.shape, hashlib.sha1(selection.view(np.uint8)).hexdigest())
+
+    def get(self, key):
+        """Returns the (read-only) cached array for key, or None on a miss."""
+        counts = self.counts.setdefault(key, [0, 0])
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            counts[0] += 1
+            return self._data[key]
+        self.misses += 1
+        counts[1] += 1
+        return None
+
+    def put(self, key, data):
+        """Caches data under key, marking it read-only, and evicts old
+        entries to stay in budget."""
+        nbytes = data.nbytes
+        if nbytes > self.max_bytes:
+            return
+        if key in self._data:
+            self.nbytes -= self._data.pop(key).nbytes
+        while self.nbytes + nbytes > self.max_bytes:
+            old_key, old_data = self._data.popitem(last=False)
+            self.nbytes -= old_data.nbytes
+        data.flags.writeable = False
+        self._data[key] = data
+        self.nbytes += nbytes
+
+    def clear(self):
+        """Drops all cached fields (the counters are kept)."""
+        self._data.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """Summary of cache usage.
+
+        Returns
+        -------
+        dict
+            Overall hits/misses, bytes and entries in use, and the
+            [hits, misses] of every key requested so far.
+
+        """
+        return dict(hits=self.hits, misses=self.misses, nbytes=self.nbytes,
+                    max_bytes=self.max_bytes, nentries=len(self._data),
+                    counts=dict(self.counts))
+
 class DatasetType(object):
     """Class to help check for, or load data from different dataset 
     types.
@@ -80,16 +161,37 @@ class DatasetType(object):
     ----------
     ds : yt dataset
         yt dataset loaded via yt.load().
+    reader : str, optional
+        Backend used to read particle fields.  'yt' (default) goes
+        through yt; 'hdf5' reads GIZMO/Gadget HDF5 snapshots directly
+        with h5py (see :class:`hdf5_reader.HDF5Reader`), falling back
+        to yt for anything it does not know about.
+    io_threads : int, optional
+        Number of concurrent read streams used by the 'hdf5' reader.
+    cache_size : float, optional
+        Memory budget in GB for memoizing fields read from disk
+        (see :class:`FieldCache`); 0 (default) disables the cache.
 
     """
-    def __init__(self, ds):
+    def __init__(self, ds, reader='yt', io_threads=8, cache_size=0.):
         self.ds      = ds
         self.ds_type = ds.__class__.__name__
-        self.dd      = ds.all_data()
+        self._dd     = None
+        self.cache   = FieldCache(int(cache_size * 1024**3))
 
         if self.ds_type not in ptype_aliases.keys():
             raise NotImplementedError('%s not yet supported' % self.ds_type)
 
+        self.reader = None
+        if reader == 'hdf5':
+            if self.ds_type in ['GizmoDataset','GadgetHDF5Dataset']:
+                from caesar.hdf5_reader import HDF5Reader
+                self.reader = HDF5Reader(ds, nthreads=io_threads)
+            else:
+                mylog.warning('hdf5 reader not available for %s, reading through yt' % self.ds_type)
+        elif reader is not None and reader != 'yt':
+            raise ValueError('reader must be \'yt\' or \'hdf5\', not %s' % reader)
+
         self.ptype_aliases = ptype_aliases[self.ds_type]
 
         self.indexes = 'all'
@@ -99,6 +201,13 @@ class DatasetType(object):
         else:
             self.grid = False
 
+    @property
+    def dd(self):
+        """yt all_data() region, only created when something needs it."""
+        if self._dd is None:
+            self._dd = self.ds.all_data()
+        return self._dd
+
     def has_ptype(self, requested_ptype):
         """Returns True/False if requested ptype is present.
 
@@ -115,6 +224,8 @@ class DatasetType(object):
         requested_ptype = requested_ptype.lower()
         if requested_ptype in self.ptype_aliases.keys():
             ptype = self.ptype_aliases[requested_ptype]
+            if self.reader is not None:
+                return self.reader.has_ptype(ptype)
             if requested_ptype == 'gas' and self.grid:
                 for field in self.ds.derived_field_list:
                     if field[0] == ptype:
@@ -187,6 +298,9 @@ class DatasetType(object):
             True if property/field is present, False otherwise.
 
         """
+        if self.reader is not None and self.reader.knows_property(requested_prop):
+            return self.reader.has_property(self.get_ptype_name(requested_ptype), requested_prop)
+
         prop  = self.get_property_name(requested_ptype, requested_prop)
         ptype = self.get_ptype_name(requested_ptype)
 
@@ -203,15 +317,25 @@ class DatasetType(object):
         return False
 
 
-    def get_property(self, requested_ptype, requested_prop):
+    def get_property(self, requested_ptype, requested_prop, selection=None):
         """Returns the requested property if present.
 
+        Results are memoized in ``self.cache`` (a :class:`FieldCache`),
+        so repeated requests for the same field do not touch the disk.
+        The returned array is read-only, whether or not it was cached;
+        copy it to modify it in place.
+
         Parameters
         ----------
         requested_ptype : str
             Typically 'gas','dm','star','bh'
         requested_prop : str
             Requested property/field.
+        selection : np.ndarray, optional
+            Boolean mask or index array; if given only the selected
+            entries are returned (and cached).  The 'hdf5' reader reads
+            just the rows of a boolean mask from disk; otherwise the
+            whole field is read and then selected.
 
         Returns
         -------
@@ -219,6 +343,17 @@ class DatasetType(object):
             The requested property values.
 
         """
+        key  = (requested_ptype.lower(), requested_prop.lower(), FieldCache.selection_key(selection))
+        data = self.cache.get(key)
+        if data is None:
+            data = self._read_property(requested_ptype, requested_prop, selection)
+            data.flags.writeable = False
+            self.cache.put(key, data)
+        return data
+
+    def _read_property(self, requested_ptype, requested_prop, selection=None):
+        """Reads the requested property (or its selected entries) from
+        disk, bypassing the cache."""
         if not self.has_ptype(requested_ptype):
             raise NotImplementedError('ptype %s not found!' % requested_ptype)
         if not self.has_property(requested_ptype, requested_prop):
@@ -227,6 +362,12 @@ class DatasetType(object):
         ptype = self.get_ptype_name(requested_ptype)
         prop  = self.get_property_name(requested_ptype, requested_prop)
 
+        if self.reader is not None and self.reader.knows_property(requested_prop):
+            if selection is not None and np.asarray(selection).dtype == bool:
+                return self.reader.get_property(ptype, requested_prop, selection)
+            data = self.reader.get_property(ptype, requested_prop)
+            return data if selection is None else data[selection]
+
         # Correct for special cases of grid code indexes
         if self.ds_type == 'EnzoDataset' and requested_ptype != 'gas':
             self._set_indexes_for_enzo(ptype, requested_ptype)
@@ -245,8 +386,34 @@ class DatasetType(object):
         #if not isinstance(self.indexes, str):
         #    data = data[self.indexes]
         #    self.indexes = 'all'
+        if selection is not None:
+            data = data[selection]
         return data
 
+    def get_count(self, requested_ptype):
+        """Returns the number of particles/cells of the requested ptype.
+
+        Uses the dataset's particle counts where available, so that no
+        field has to be read just to find out its length.
+
+        Parameters
+        ----------
+        requested_ptype : str
+            Typically 'gas','dm','star','bh'
+
+        Returns
+        -------
+        int
+
+        """
+        ptype = self.get_ptype_name(requested_ptype)
+        if self.reader is not None:
+            return self.reader.get_count(ptype)
+        if (not self.grid and self.ds_type not in ['EnzoDataset','RAMSESDataset'] and
+            hasattr(self.ds, 'particle_type_counts') and ptype in self.ds.particle_type_counts):
+            return int(self.ds.particle_type_counts[ptype])
+        return len(self.get_property(requested_ptype, 'mass'))
+
     def _get_simba_property(self,ptype,prop):
         from readgadget import readsnap
         snapfile = ('%s/%s'%(self.ds.fullpath,self.ds.basename))
@@ -345,7 +512,7 @@ def has_property(obj, requested_ptype, requested_prop):
     """
     return obj._ds_type.has_property(requested_ptype, requested_prop)
 
-def get_property(obj, requested_prop, requested_ptype):
+def get_property(obj, requested_prop, requested_ptype, selection=None):
     """Helper function to return a property.
 
     Parameters
@@ -356,15 +523,37 @@ def get_property(obj, requested_prop, requested_ptype):
         Requested property name
     requested_ptype : str
         Requested ptype ('gas','star','dm','bh')
+    selection : np.ndarray, optional
+        Boolean mask or index array of the entries to return.
 
     Returns
     -------
     np.ndarray
-        The requested property for the requested particle/field type.
+        The requested property for the requested particle/field type
+        (read-only; see :meth:`DatasetType.get_property`).
 
     """
     ds_type = obj._ds_type    
-    return obj._ds_type.get_property(requested_ptype, requested_prop)
+    return obj._ds_type.get_property(requested_ptype, requested_prop, selection)
+
+
+def get_count(obj, requested_ptype):
+    """Helper function to return the number of particles of a ptype.
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Main caesar object.
+    requested_ptype : str
+        Requested ptype ('gas','star','dm','bh')
+
+    Returns
+    -------
+    int
+        Number of particles/cells of the requested type.
+
+    """
+    return obj._ds_type.get_count(requested_ptype)
 
 
 def get_high_density_gas_indexes(obj):
@@ -395,6 +584,11 @@ def get_particles_for_FOF(obj, ptypes, select='all', my_dtype=MY_DTYPE):
     into pos/vel/mass/ptype/index arrays for use throughout the 
     analysis.
 
+    Particle counts are gathered first so that each output array is
+    allocated once; every field is then read with the selection applied
+    (by the 'hdf5' reader, only the selected rows are read from disk),
+    copied into its slice, and converted to caesar units in place.
+
     Parameters
     ----------
     obj : :class:`main.CAESAR`
@@ -403,6 +597,8 @@ def get_particles_for_FOF(obj, ptypes, select='all', my_dtype=MY_DTYPE):
         List containing which ptypes to concat.
     select : a list of length len(ptypes) containing numpy arrays, where
         only particles with array values>=0 will be selected
+    my_dtype : dtype
+        Floating point type of the pos/vel/mass/pot arrays.
 
     Returns
     -------
@@ -420,55 +616,77 @@ def get_particles_for_FOF(obj, ptypes, select='all', my_dtype=MY_DTYPE):
     #if not obj.load_pot:
     #    mylog.warning('Potential not found in snapshot!')
 
-    pos  = np.empty((0,3),dtype=MY_DTYPE)
-    vel  = np.empty((0,3),dtype=MY_DTYPE)
-    mass = np.empty(0,dtype=MY_DTYPE)
-    pot = np.empty(0,dtype=MY_DTYPE)
-    if obj.load_haloid:
-        haloid  = np.empty(0, dtype=np.int64)
-
-    ptype   = np.empty(0,dtype=np.int32)
-    indexes = np.empty(0,dtype=np.int64)
-
+    # first pass: count the (selected) particles of each type
+    flags  = {}
+    nparts = {}
     for ip,p in enumerate(ptypes):
         if not has_ptype(obj, p):
             continue
-      
-        count = len(get_property(obj, 'mass', p))
-        if select is 'all': 
-            flag = [True]*count
+        if select is None or isinstance(select, str):
+            flags[p]  = None
+            nparts[p] = get_count(obj, p)
         else:
-            flag = (select[ip]>=0)
+            flags[p]  = (np.asarray(select[ip]) >= 0)
+            nparts[p] = np.count_nonzero(flags[p])
+    ntot = sum(nparts.values())
+
+    pos  = np.empty((ntot,3),dtype=my_dtype)
+    vel  = np.empty((ntot,3),dtype=my_dtype)
+    mass = np.empty(ntot,dtype=my_dtype)
+    pot  = np.zeros(ntot,dtype=my_dtype)
+    if obj.load_haloid:
+        haloid  = np.empty(ntot, dtype=np.int64)
 
-        data = get_property(obj, 'pos', p).to(obj.units['length'])[flag]
-        pos  = np.append(pos, data.d, axis=0)
-        
-        data = get_property(obj, 'vel', p).to(obj.units['velocity'])[flag]
-        vel  = np.append(vel, data.d, axis=0)
-        
-        data = get_property(obj, 'mass', p).to(obj.units['mass'])[flag]
-        mass = np.append(mass, data.d, axis=0)
+    ptype   = np.empty(ntot,dtype=np.int32)
+    indexes = np.empty(ntot,dtype=np.int64)
 
-        if obj.load_pot:
-            data = get_property(obj, 'pot', p)[flag]
-            pot = np.append(pot, data.d, axis=0)
-        else:
-            pot = np.append(pot, np.zeros(count,dtype=MY_DTYPE), axis=0)
+    # second pass: fill each ptype's slice in place
+    offset = 0
+    for p in nparts:
+        flag = flags[p]
+        sl = slice(offset, offset+nparts[p])
 
+        _fill_selected(obj, pos[sl],  get_property(obj, 'pos', p, flag),  obj.units['length'])
+        _fill_selected(obj, vel[sl],  get_property(obj, 'vel', p, flag),  obj.units['velocity'])
+        _fill_selected(obj, mass[sl], get_property(obj, 'mass', p, flag), obj.units['mass'])
+        if obj.load_pot:
+            _fill_selected(obj, pot[sl], get_property(obj, 'pot', p, flag))
         if obj.load_haloid:
-            data = get_property(obj, 'haloid', p)[flag]
-            haloid = np.append(haloid, data.d.astype(np.int64), axis=0)
+            _fill_selected(obj, haloid[sl], get_property(obj, 'haloid', p, flag))
 
-        nparts = len(data)
-
-        ptype   = np.append(ptype,   np.full(nparts, ptype_ints[p], dtype=np.int32), axis=0)
-        indexes = np.append(indexes, np.arange(0, count, dtype=np.int64)[flag])
-        #indexes = np.append(indexes, np.arange(0, nparts, dtype=np.int64))
+        ptype[sl] = ptype_ints[p]
+        if flag is None:
+            indexes[sl] = np.arange(0, nparts[p], dtype=np.int64)
+        else:
+            indexes[sl] = np.flatnonzero(flag)
+        offset += nparts[p]
 
     if obj.load_haloid:
         return dict(pos=pos,vel=vel,pot=pot,mass=mass,haloid=haloid,ptype=ptype,indexes=indexes)
     else: return dict(pos=pos,vel=vel,pot=pot,mass=mass,ptype=ptype,indexes=indexes)
 
+def _fill_selected(obj, out, data, units=None):
+    """Copy selected data into the preallocated out array, converting it
+    to units (if given) in place.
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Main caesar object.
+    out : np.ndarray
+        Output slice, with one entry per selected particle.
+    data : YTArray or np.ndarray
+        Selected property as returned by :func:`get_property`.
+    units : str, optional
+        Units to convert data to.
+
+    """
+    out[...] = data.d if hasattr(data, 'd') else np.asarray(data)
+    if units is not None and hasattr(data, 'units'):
+        factor = obj.yt_dataset.quan(1.0, data.units).to(units).d
+        if factor != 1.0:
+            out *= factor
+
 def get_haloid(obj, ptypes, offset=-1):
     """This function returns a list of HaloID numpy arrays from the snapshot, 
     corresponding to the HaloID for the particle types in ptypes.
@@ -1,8 +1,12 @@
 import os
+import zlib
 import h5py
 import numpy as np
 import pdb
 import six
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from yt.units.yt_array import YTQuantity, YTArray
 from yt import mylog
 blacklist = [
@@ -11,15 +15,204 @@ blacklist = [
     'unbound_particles', '_units',
     'unit_registry_json',
     'unbound_indexes',
-    'lists','dicts'
+    'lists','dicts',
+    '_membership_row'
 ]
 
+# optional compressors: hdf5plugin registers the Blosc and Zstd HDF5
+# filters, and blosc/zstandard let chunks be encoded outside HDF5
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_BYTES = 1024**2  # target uncompressed size of a chunk
+
 ######################################################################
 
-def _write_dataset(key, data, hd):
-    hd.create_dataset(key, data=data, compression=1)
+def chunk_shape(shape, itemsize, chunk_bytes=CHUNK_BYTES):
+    """Chunk shape for a dataset of the given shape: whole rows (e.g.
+    xyz vectors), as many as fit in chunk_bytes, or all of them.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the dataset.
+    itemsize : int
+        Bytes per element.
+    chunk_bytes : int, optional
+        Target uncompressed size of a chunk.
+
+    """
+    row_bytes = itemsize * int(np.prod(shape[1:], dtype=np.int64))
+    nrows = min(shape[0], max(1, chunk_bytes // max(row_bytes, 1)))
+    return (int(nrows),) + tuple(shape[1:])
+
+def _shuffle(buf, itemsize):
+    """Byte shuffle of a chunk, as done by the HDF5 shuffle filter."""
+    if itemsize == 1:
+        return buf
+    return np.frombuffer(buf, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+class ChunkedWriter(object):
+    """Writes datasets chunk by chunk, compressing the chunks on a thread
+    pool and writing them to the file with direct chunk writes.
+
+    Chunk shapes follow the dataset shapes (see :func:`chunk_shape`).
+    Chunks of all datasets pass through one pipeline of at most a few
+    chunks per thread, so that small datasets are compressed in
+    parallel with each other as well as large ones chunk by chunk; the
+    file itself is only written from the calling thread.  Filters that
+    cannot be applied outside HDF5 (lzf, or Blosc/Zstd without the
+    blosc/zstandard modules) are left to HDF5 instead.
+
+    Parameters
+    ----------
+    compression : {'gzip', 'lzf', 'blosc', 'zstd', None}, optional
+        Compression filter.  'blosc' (Blosc with its zstd codec) and
+        'zstd' need the hdf5plugin package, and readers of the file then
+        need it too; without it they fall back to 'gzip'.
+    compression_opts : int, optional
+        Compression level: 0-9 for gzip (default 1), 1-9 for blosc
+        (default 5), 1-22 for zstd (default 3).
+    shuffle : bool, optional
+        Byte shuffle the chunks before compression (for blosc, its own
+        shuffle), which usually makes floating point data compress
+        better.
+    nproc : int, optional
+        Number of compression threads (<= 0 for all cores).
+    chunk_bytes : int, optional
+        Target uncompressed size of a chunk.
+
+    """
+    def __init__(self, compression='gzip', compression_opts=None, shuffle=False, nproc=1, chunk_bytes=CHUNK_BYTES):
+        if compression in ['blosc', 'zstd'] and hdf5plugin is None:
+            mylog.warning('hdf5plugin not found, needed for %s compression; using gzip' % compression)
+            compression, compression_opts = 'gzip', None
+        if compression not in ['gzip', 'lzf', 'blosc', 'zstd', None]:
+            raise ValueError('Unknown compression %s' % compression)
+        if compression_opts is None:
+            compression_opts = {'gzip': 1, 'blosc': 5, 'zstd': 3}.get(compression)
+        if nproc is None or nproc <= 0:
+            nproc = os.cpu_count()
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.nproc = nproc
+        self.chunk_bytes = chunk_bytes
+        self._pending = deque()  # (dataset, chunk offset, future of encoded chunk)
+        self._executor = ThreadPoolExecutor(max_workers=nproc) if nproc > 1 else None
+
+    def _filters(self):
+        """create_dataset keywords describing the filter pipeline."""
+        if self.compression == 'gzip':
+            return dict(compression='gzip', compression_opts=self.compression_opts, shuffle=self.shuffle)
+        if self.compression == 'lzf':
+            return dict(compression='lzf', shuffle=self.shuffle)
+        if self.compression == 'blosc':
+            shuffle = hdf5plugin.Blosc.SHUFFLE if self.shuffle else hdf5plugin.Blosc.NOSHUFFLE
+            return dict(hdf5plugin.Blosc(cname='zstd', clevel=self.compression_opts, shuffle=shuffle))
+        if self.compression == 'zstd':
+            return dict(hdf5plugin.Zstd(clevel=self.compression_opts), shuffle=self.shuffle)
+        return {}
+
+    def _encoder(self, itemsize):
+        """Function encoding a chunk's bytes as the filter pipeline
+        would, or None if only HDF5 can."""
+        level = self.compression_opts
+        shuffle = self.shuffle
+        if self.compression == 'gzip':
+            if shuffle:
+                return lambda buf: zlib.compress(_shuffle(buf, itemsize), level)
+            return lambda buf: zlib.compress(buf, level)
+        if self.compression == 'zstd' and zstandard is not None:
+            # a compressor per chunk, as they cannot be shared between threads
+            if shuffle:
+                return lambda buf: zstandard.ZstdCompressor(level=level).compress(_shuffle(buf, itemsize))
+            return lambda buf: zstandard.ZstdCompressor(level=level).compress(buf)
+        if self.compression == 'blosc' and blosc is not None:
+            mode = blosc.SHUFFLE if shuffle else blosc.NOSHUFFLE
+            return lambda buf: blosc.compress(buf, typesize=itemsize, clevel=level, shuffle=mode, cname='zstd')
+        return None
+
+    def write(self, hd, key, data, unit=None):
+        """Creates dataset key in hd holding data, with a 'unit' attribute
+        if given.  Chunks may be written later, by :meth:`flush` at the
+        latest.
+
+        Parameters
+        ----------
+        hd : h5py.Group
+            Open HDF5 group.
+        key : str
+            Name of the dataset.
+        data : array_like
+            Values to write.
+        unit : str, optional
+            Units of data.
+
+        """
+        scalar = np.ndim(data) == 0
+        if not scalar:  # ascontiguousarray would give a scalar shape (1,)
+            data = np.ascontiguousarray(data)
+        if self.compression is None or scalar or data.size == 0 or data.dtype.kind not in 'biuf':
+            dset = hd.create_dataset(key, data=data)
+        else:
+            chunks = chunk_shape(data.shape, data.dtype.itemsize, self.chunk_bytes)
+            dset = hd.create_dataset(key, shape=data.shape, dtype=data.dtype, chunks=chunks, **self._filters())
+            encode = self._encoder(data.dtype.itemsize)
+            if encode is None:
+                dset[...] = data
+            else:
+                for start in range(0, data.shape[0], chunks[0]):
+                    chunk = data[start:start+chunks[0]]
+                    if len(chunk) < chunks[0]:  # edge chunks are written whole
+                        chunk = np.concatenate((chunk, np.zeros((chunks[0]-len(chunk),)+chunk.shape[1:], dtype=chunk.dtype)))
+                    self._submit(dset, (start,)+(0,)*(data.ndim-1), encode, chunk)
+        if unit is not None:
+            dset.attrs.create('unit', str(unit).encode('utf8'))
+        return dset
+
+    def _submit(self, dset, offset, encode, chunk):
+        if self._executor is None:
+            dset.id.write_direct_chunk(offset, encode(chunk.tobytes()))
+            return
+        self._pending.append((dset, offset, self._executor.submit(lambda: encode(chunk.tobytes()))))
+        while len(self._pending) > 4*self.nproc:
+            self._write_next()
+
+    def _write_next(self):
+        dset, offset, future = self._pending.popleft()
+        dset.id.write_direct_chunk(offset, future.result())
+
+    def flush(self):
+        """Writes all chunks still being compressed."""
+        while len(self._pending) > 0:
+            self._write_next()
+
+    def close(self):
+        """Writes all remaining chunks and stops the threads."""
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+def _write_dataset(key, data, hd, writer=None, unit=None):
+    if writer is None:
+        writer = ChunkedWriter()
+        writer.write(hd, key, data, unit)
+        writer.close()
+        return
+    writer.write(hd, key, data, unit)
 
-def check_and_write_dataset(obj, key, hd):
+def check_and_write_dataset(obj, key, hd, writer=None):
     """General function for writing an HDF5 dataset.
 
     Parameters
@@ -30,15 +223,17 @@ def check_and_write_dataset(obj, key, hd):
         Name of dataset to write.
     hd : h5py.Group
         Open HDF5 group.
+    writer : :class:`ChunkedWriter`, optional
+        Writer of the dataset; gzip level 1 if not given.
 
     """
     if not hasattr(obj, key): return
     if isinstance(getattr(obj, key), int): return
-    _write_dataset(key, getattr(obj, key), hd)
+    _write_dataset(key, getattr(obj, key), hd, writer)
 
 ######################################################################
 
-def serialize_list(obj_list, key, hd):
+def serialize_list(obj_list, key, hd, writer=None):
     """Function that serializes a index list (glist/etc) for objects.
 
     Parameters
@@ -49,31 +244,34 @@ def serialize_list(obj_list, key, hd):
         Name of the index list.
     hd : h5py.Group
         Open HDF5 group.
+    writer : :class:`ChunkedWriter`, optional
+        Writer of the dataset; gzip level 1 if not given.
 
     """
     if key in blacklist: return
     if not hasattr(obj_list[0], key): return
     data = _get_serialized_list(obj_list, key)
-    _write_dataset(key, data, hd)
+    _write_dataset(key, data, hd, writer)
 
 def _get_serialized_list(obj_list, key):
-    tmp, index = [], 0
-    for i in obj_list:
-        current_list = getattr(i, key)
-        n = len(current_list)
-        tmp.extend(current_list)
-
-        setattr(i, '%s_start' % key, index)
-        index += n
-        setattr(i, '%s_end'   % key, index)
-    return tmp
+    from caesar.group import collate_group_lists
+    from caesar.catalogue import set_group_column
+    data, bins = collate_group_lists(obj_list, key)
+    bins = np.asarray(bins, dtype=np.int64)
+    set_group_column(obj_list, '%s_start' % key, bins[:-1])
+    set_group_column(obj_list, '%s_end' % key, bins[1:])
+    return data
 
 ######################################################################
 
-def serialize_attributes(obj_list, hd, hd_dicts):
+def serialize_attributes(obj_list, hd, hd_dicts, writer=None):
     """Function that goes through a list full of halos/galaxies/clouds and
     serializes their attributes.
 
+    Properties held in the groups' catalogue are written straight from
+    its columns; anything the groups hold themselves is gathered from
+    each of them.
+
     Parameters
     ----------
     obj : :class:`main.CAESAR`
@@ -82,31 +280,60 @@ def serialize_attributes(obj_list, hd, hd_dicts):
         Open HDF5 group for lists.
     hd_dicts : h5py.Group
         Open HDF5 group for dictionaries.
+    writer : :class:`ChunkedWriter`, optional
+        Writer of the datasets; gzip level 1 if not given.
 
     """
+    from caesar.catalogue import group_catalogue
+    close = writer is None
+    if close:
+        writer = ChunkedWriter()
+
+    catalogue = group_catalogue(obj_list)
+    for k in catalogue.attributes(0):
+        if k in blacklist: continue
+        _write_column(obj_list, catalogue, k, None, k, hd, writer)
+    for k in catalogue.dicts:
+        if k in blacklist: continue
+        for kk in catalogue.keys(0, k):
+            _write_column(obj_list, catalogue, k, kk, '%s.%s' % (k,kk), hd_dicts, writer)
+
     for k,v in six.iteritems(obj_list[0].__dict__):
         if k in blacklist: continue
 
-        if isinstance(v, dict):
-            _write_dict(obj_list, k, v, hd_dicts)
+        if isinstance(v, Mapping):
+            _write_dict(obj_list, k, v, hd_dicts, writer)
+        else:
+            _write_attrib(obj_list, k, v, hd, writer)
+    if close:
+        writer.close()
+
+def _write_column(obj_list, catalogue, k, kk, dname, hd, writer):
+    """Writes attribute k, or key kk of dict k, from its catalogue column,
+    or from each group if not all of them hold a value."""
+    column = catalogue.column(k, kk)
+    if column.dtype == object or not catalogue.present(k, kk).all():
+        if kk is None:
+            _write_attrib(obj_list, k, getattr(obj_list[0], k), hd, writer)
         else:
-            _write_attrib(obj_list, k, v, hd)
+            _write_dict(obj_list, k, {kk: getattr(obj_list[0], k)[kk]}, hd, writer)
+        return
+    if isinstance(column, YTArray):
+        writer.write(hd, dname, column.d, unit=column.units)
+    else:
+        writer.write(hd, dname, column)
 
-def _write_attrib(obj_list, k, v, hd):
-    #print('obj_list: ',dir(obj_list))
-    #print('k: ',k)
-    #print('v: ', v)
-    
-    unit = False
+def _write_attrib(obj_list, k, v, hd, writer=None):
+    unit = None
     if isinstance(v, YTQuantity):
         data = [getattr(i,k).d for i in obj_list]
-        unit = True
+        unit = v.units
     elif isinstance(v, YTArray):
         if np.shape(v)[0] == 3:
             data = np.vstack([getattr(i,k).d for i in obj_list])
         else:
             data = [getattr(i,k).d for i in obj_list]
-        unit = True
+        unit = v.units
     elif isinstance(v, np.ndarray) and np.shape(v)[0] == 3 and 'list' not in k:
         try:
             data = np.vstack([getattr(i,k) for i in obj_list])
@@ -118,22 +345,18 @@ def _write_attrib(obj_list, k, v, hd):
     else:
         return
 
-    _write_dataset(k, data, hd)
-    if unit:
-        hd[k].attrs.create('unit', str(v.units).encode('utf8'))
+    _write_dataset(k, data, hd, writer, unit)
             
-def _write_dict(obj_list, k, v, hd):
+def _write_dict(obj_list, k, v, hd, writer=None):
     for kk,vv in six.iteritems(v):
-        unit = False        
+        unit = None
         if isinstance(vv, (YTQuantity, YTArray)):
             data = np.array([getattr(i,k)[kk].d for i in obj_list])
-            unit = True
+            unit = vv.units
         else:
             data = np.array([getattr(i,k)[kk] for i in obj_list])            
 
-        _write_dataset('%s.%s' % (k,kk), data, hd)
-        if unit:
-            hd['%s.%s' % (k,kk)].attrs.create('unit', str(vv.units).encode('utf8'))        
+        _write_dataset('%s.%s' % (k,kk), data, hd, writer, unit)
 
 ######################################################################
 
@@ -170,19 +393,32 @@ def serialize_global_attribs(obj, hd):
             
 ######################################################################
     
-def save(obj, filename='test.hdf5'):
+def save(obj, filename='test.hdf5', compression='gzip', compression_opts=None, shuffle=False, nproc=None):
     """Function to save a CAESAR file to disk.
 
+    Datasets are written in chunks, compressed on ``nproc`` threads;
+    see :class:`ChunkedWriter`.
+
     Parameters
     ----------
     obj : :class:`main.CAESAR`
         Main caesar object to save.
     filename : str, optional
         Filename of the output file.
+    compression : {'gzip', 'lzf', 'blosc', 'zstd', None}, optional
+        Compression filter of the datasets.  'blosc' and 'zstd' need
+        the hdf5plugin package to write and to read the file.
+    compression_opts : int, optional
+        Compression level; gzip defaults to 1.
+    shuffle : bool, optional
+        Byte shuffle the data before compression.
+    nproc : int, optional
+        Number of compression threads; defaults to obj.nproc.
 
     Examples
     --------
     >>> obj.save('output.hdf5')
+    >>> obj.save('output.hdf5', compression='gzip', compression_opts=4, shuffle=True)
     
     """
     from yt.funcs import mylog
@@ -192,6 +428,10 @@ def save(obj, filename='test.hdf5'):
         os.remove(filename)
     mylog.info('Writing %s' % filename)
         
+    if nproc is None:
+        nproc = getattr(obj, 'nproc', 1)
+    writer = ChunkedWriter(compression, compression_opts, shuffle, nproc)
+
     outfile = h5py.File(filename, 'w')
     outfile.attrs.create('caesar', 315)
     
@@ -216,8 +456,8 @@ def save(obj, filename='test.hdf5'):
 
         #write        
         for vals in index_lists:
-            serialize_list(obj.halos, vals, hdd)
-        serialize_attributes(obj.halos, hd, hddd)
+            serialize_list(obj.halos, vals, hdd, writer)
+        serialize_attributes(obj.halos, hd, hddd, writer)
   
     if hasattr(obj, 'galaxies') and obj.ngalaxies > 0:
         hd   = outfile.create_group('galaxy_data')
@@ -233,8 +473,8 @@ def save(obj, filename='test.hdf5'):
 
         # write
         for vals in index_lists:
-            serialize_list(obj.galaxies, vals, hdd)
-        serialize_attributes(obj.galaxies, hd, hddd)
+            serialize_list(obj.galaxies, vals, hdd, writer)
+        serialize_attributes(obj.galaxies, hd, hddd, writer)
 
 
     if hasattr(obj, 'clouds') and obj.nclouds > 0:
@@ -247,8 +487,8 @@ def save(obj, filename='test.hdf5'):
  
         # write
         for vals in index_lists:
-            serialize_list(obj.clouds, vals, hdd)
-        serialize_attributes(obj.clouds, hd, hddd)
+            serialize_list(obj.clouds, vals, hdd, writer)
+        serialize_attributes(obj.clouds, hd, hddd, writer)
 
 
         
@@ -265,6 +505,7 @@ def save(obj, filename='test.hdf5'):
 
         # write
         for vals in global_index_lists:
-            check_and_write_dataset(obj.global_particle_lists, vals, hd)
-            
+            check_and_write_dataset(obj.global_particle_lists, vals, hd, writer)
+
+    writer.close()
     outfile.close()
@@ -72,6 +72,7 @@ class SimulationAttributes(object):
         # Romeel: Removed virial density, because the FOF with b=0.2*MIS 
         # only finds contour enclosing ~200, so halos do not have all the particles they
         # need to compute spherical ~100xrhocrit. 
+        # With so_masses=True these are instead computed from all particles (spherical_overdensity.py).
         #self.Densities = np.array([virial_density*self.critical_density.to('Msun/kpc**3').d,
         self.Densities = np.array([ 200.*self.critical_density.to('Msun/kpc**3').d,
                                     500.*self.critical_density.to('Msun/kpc**3').d,
@@ -0,0 +1,215 @@
+import numpy as np
+from collections import OrderedDict
+
+def periodic_tree(pos, boxsize=None, leafsize=16):
+    """Builds a kd-tree of pos, periodic in a cubic box of side boxsize.
+
+    Uses the native periodic support of ``scipy.spatial.cKDTree``, which
+    needs no ghost copies of the points; positions are wrapped into
+    [0, boxsize) as it requires.
+
+    Parameters
+    ----------
+    pos : np.ndarray
+        Nx3 array of positions.
+    boxsize : float, optional
+        Periodic box size, in units of pos; None for a non-periodic tree.
+    leafsize : int, optional
+        Points per leaf of the tree.
+
+    Returns
+    -------
+    scipy.spatial.cKDTree
+
+    """
+    from scipy.spatial import cKDTree
+    pos = np.asarray(pos, dtype=np.float64)
+    if boxsize is not None:
+        pos = np.mod(pos, boxsize)
+        pos[pos >= boxsize] = 0.
+    return cKDTree(pos, leafsize=leafsize, boxsize=boxsize)
+
+def _ball_indexes(tree, x, r, nproc=1):
+    """Query positions (wrapped into the box), and CSR offsets and indexes
+    of the points of tree within r of each of them."""
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    if tree.boxsize is not None:
+        x = np.mod(x, tree.boxsize[:3])
+        x[x >= tree.boxsize[:3]] = 0.
+    ngb = tree.query_ball_point(x, r, workers=nproc, return_sorted=False)
+    counts = np.fromiter((len(n) for n in ngb), dtype=np.int64, count=len(ngb))
+    start = np.zeros(len(ngb)+1, dtype=np.int64)
+    np.cumsum(counts, out=start[1:])
+    if start[-1] == 0:
+        return x, start, np.zeros(0, dtype=np.int64)
+    return x, start, np.concatenate([n for n in ngb if len(n) > 0]).astype(np.int64)
+
+def ball_neighbors(tree, x, r, nproc=1):
+    """All points of tree within r of each of x, as CSR arrays.
+
+    Parameters
+    ----------
+    tree : scipy.spatial.cKDTree
+        Tree to search, e.g. from :func:`periodic_tree`.
+    x : np.ndarray
+        Mx3 array of query positions.
+    r : float or np.ndarray
+        Search radius, or one radius per query position.
+    nproc : int, optional
+        Number of threads for the query (-1 for all cores).
+
+    Returns
+    -------
+    start : np.ndarray
+        Offsets of the neighbours of each query position into ind/dist;
+        length M+1.
+    ind : np.ndarray
+        Indexes into the tree's points of the neighbours.
+    dist : np.ndarray
+        (Periodic) distances to the neighbours.
+
+    """
+    x, start, ind = _ball_indexes(tree, x, r, nproc)
+    if start[-1] == 0:
+        return start, ind, np.zeros(0)
+    dx = tree.data[ind] - np.repeat(x, np.diff(start), axis=0)
+    if tree.boxsize is not None:
+        dx -= tree.boxsize[:3] * np.round(dx / tree.boxsize[:3])
+    return start, ind, np.sqrt(np.sum(dx*dx, axis=1))
+
+def _tree_nbytes(tree):
+    """Rough memory footprint of a cKDTree: its copy of the data, index
+    array and nodes."""
+    n, ndim = tree.data.shape
+    return n * (8*ndim + 8) + (2*n // max(tree.leafsize, 1) + 1) * 96
+
+class SpatialIndex(object):
+    """Shared periodic kd-trees over particle and object positions.
+
+    Trees are built once per key, typically (ptype, selection, units), and
+    kept in a least-recently-used cache with a memory budget, like
+    :class:`property_manager.FieldCache`; trees larger than the whole
+    budget are returned but not kept.  Each tree may carry per-point
+    weights (e.g. masses) for :meth:`sum_within`.  All queries are
+    batched over query positions and use ``nproc`` threads.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Memory budget in bytes; 0 disables caching.
+    nproc : int
+        Number of threads for queries (-1 for all cores).
+
+    """
+    def __init__(self, max_bytes, nproc=1):
+        self.max_bytes = max_bytes
+        self.nproc     = nproc
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self._data     = OrderedDict()  # key -> (tree, weights, nbytes)
+
+    @staticmethod
+    def selection_key(selection):
+        """Hashable description of a selection mask/index array, or of a
+        set of positions."""
+        from caesar.property_manager import FieldCache
+        return FieldCache.selection_key(selection)
+
+    def get(self, key, builder):
+        """Returns (tree, weights) for key, building and caching them on a miss.
+
+        Parameters
+        ----------
+        key : hashable
+            Identifies the point set, e.g. ('dm', 'all', 'code_length').
+        builder : callable
+            Called on a miss, with no arguments; returns (pos, boxsize,
+            weights), where boxsize and weights may be None.
+
+        """
+        if key in self._data:
+            self._data.move_to_end(key)
+            self.hits += 1
+            tree, weights, nbytes = self._data[key]
+            return tree, weights
+        self.misses += 1
+        pos, boxsize, weights = builder()
+        tree = periodic_tree(pos, boxsize)
+        if weights is not None:
+            weights = np.asarray(weights)
+        nbytes = _tree_nbytes(tree) + (0 if weights is None else weights.nbytes)
+        if nbytes <= self.max_bytes:
+            while self.nbytes + nbytes > self.max_bytes:
+                old_key, old = self._data.popitem(last=False)
+                self.nbytes -= old[2]
+            self._data[key] = (tree, weights, nbytes)
+            self.nbytes += nbytes
+        return tree, weights
+
+    def query_ball_point(self, key, builder, x, r, return_length=False):
+        """Indexes of the points within r of each of x, as a list of arrays
+        (or their numbers, if return_length); see cKDTree.query_ball_point."""
+        tree, weights = self.get(key, builder)
+        return tree.query_ball_point(x, r, workers=self.nproc, return_length=return_length)
+
+    def query(self, key, builder, x, k=1, distance_upper_bound=np.inf):
+        """Distances and indexes of the k nearest points to each of x; see
+        cKDTree.query."""
+        tree, weights = self.get(key, builder)
+        return tree.query(x, k=k, distance_upper_bound=distance_upper_bound, workers=self.nproc)
+
+    def count(self, key, builder, x, r):
+        """Number of points within r of each of x."""
+        return self.query_ball_point(key, builder, x, r, return_length=True)
+
+    def neighbors(self, key, builder, x, r):
+        """Points within r of each of x as CSR arrays; see :func:`ball_neighbors`."""
+        tree, weights = self.get(key, builder)
+        return ball_neighbors(tree, x, r, self.nproc)
+
+    def sum_within(self, key, builder, x, r, return_count=False):
+        """Sum of the weights of the points within r of each of x, and
+        optionally the number of those points, from the same query."""
+        tree, weights = self.get(key, builder)
+        x, start, ind = _ball_indexes(tree, x, r, self.nproc)
+        sums = np.zeros(len(start)-1)
+        full = start[1:] > start[:-1]
+        if np.any(full):
+            sums[full] = np.add.reduceat(weights[ind], start[:-1][full])
+        if return_count:
+            return sums, np.diff(start)
+        return sums
+
+    def clear(self):
+        """Drops all cached trees (the counters are kept)."""
+        self._data.clear()
+        self.nbytes = 0
+
+    def info(self):
+        """Summary of cache usage.
+
+        Returns
+        -------
+        dict
+            Hits/misses, bytes and trees in use, and the cached keys.
+
+        """
+        return dict(hits=self.hits, misses=self.misses, nbytes=self.nbytes,
+                    max_bytes=self.max_bytes, keys=list(self._data.keys()))
+
+def get_spatial_index(obj):
+    """The :class:`SpatialIndex` of a CAESAR object, created on first use.
+
+    Its memory budget is the ``spatial_index_cache`` kwarg in GB (default
+    2), and it queries with ``nproc`` threads.
+
+    """
+    if getattr(obj, '_spatial_index', None) is None:
+        kwargs = getattr(obj, '_kwargs', {})
+        cache_size = kwargs['spatial_index_cache'] if 'spatial_index_cache' in kwargs else 2.
+        nproc = getattr(obj, 'nproc', kwargs['nproc'] if 'nproc' in kwargs else 1)
+        if nproc <= 0:  # all cores, as far as scipy is concerned
+            nproc = -1
+        obj._spatial_index = SpatialIndex(int(cache_size * 1024**3), nproc=nproc)
+    return obj._spatial_index
@@ -0,0 +1,136 @@
+import numpy as np
+from yt.funcs import mylog
+from caesar.utils import memlog
+
+# names of the overdensities in simulation.Densities, in the same order
+SO_NAMES = ['200c', '500c', '2500c']
+
+def get_so_quantities(obj, halo_list, nproc=1):
+    """Spherical overdensity masses and radii of halos from all particles.
+
+    The virial quantities from the group property pass only count each
+    halo's FOF members, so they miss mass outside the FOF contour.  This
+    builds one periodic kd-tree over every particle in the snapshot and,
+    for batches of halos, finds all particles within a search radius of
+    each halo centre (minpotpos if available, else pos) with parallel
+    ball queries.  Enclosed mass is accumulated outwards in radius, and
+    r_Delta is taken as the outermost radius with mean enclosed density
+    above each of simulation.Densities, as for the FOF-only values.
+
+    The search radius starts at ``so_search_factor`` (default 1.5) times
+    the radius at which the halo's FOF mass would have the lowest of the
+    overdensities, and is doubled for halos still above it at that
+    radius, at most ``so_max_iter`` (default 3) times.
+
+    Replaces virial_quantities['m200c'], ['r200c'], etc. of each halo.
+
+    Parameters
+    ----------
+    obj : :class:`main.CAESAR`
+        Main caesar object.
+    halo_list : list
+        Halos to compute spherical overdensity quantities for.
+    nproc : int
+        Number of threads for the ball queries (-1 for all cores).
+
+    """
+    if len(halo_list) == 0:
+        return
+    try:
+        import scipy.spatial
+    except:
+        mylog.warning('Could not import scipy.spatial! '   \
+                      'Please install scipy to allow for ' \
+                      'spherical overdensity calculations.')
+        return
+    from caesar.property_manager import has_ptype, get_property
+
+    search_factor = 1.5
+    if 'so_search_factor' in obj._kwargs:
+        search_factor = float(obj._kwargs['so_search_factor'])
+    max_iter = 3
+    if 'so_max_iter' in obj._kwargs:
+        max_iter = int(obj._kwargs['so_max_iter'])
+    batch = 4096
+
+    # periodic tree of all particles, shared through the spatial index
+    Lbox = obj.simulation.boxsize.to(obj.units['length']).d
+    def builder():
+        pos = []
+        mass = []
+        for p in obj.data_manager.ptypes:
+            if not has_ptype(obj, p):
+                continue
+            pos.append(get_property(obj, 'pos', p).to(obj.units['length']).d)
+            mass.append(get_property(obj, 'mass', p).to(obj.units['mass']).d)
+        return np.concatenate(pos), Lbox, np.concatenate(mass).astype(np.float64)
+    key = ('all', 'all', obj.units['length'], obj.units['mass'])
+    tree, mass = obj.spatial_index.get(key, builder)
+    memlog('Using kd-tree of %d particles for spherical overdensities' % len(mass))
+
+    Densities = obj.simulation.Densities.in_units(obj.units['mass']+'/'+obj.units['length']+'**3').d
+    nDens = len(Densities)
+    nhalo = len(halo_list)
+    from caesar.catalogue import group_catalogue
+    catalogue = group_catalogue(halo_list)
+    centres = catalogue.column('pos').to(obj.units['length']).d.astype(np.float64)
+    if 'minpotpos' in catalogue.data:
+        has_minpot = catalogue.present('minpotpos')
+        centres[has_minpot] = catalogue.column('minpotpos').to(obj.units['length']).d[has_minpot]
+    mfof = catalogue.column('masses', 'total').to(obj.units['mass']).d.astype(np.float64)
+    rsearch = search_factor * (3.*mfof / (4.*np.pi*Densities[0]))**(1./3.)
+
+    rvir = np.zeros((nhalo, nDens))
+    mvir = np.zeros((nhalo, nDens))
+    todo = np.arange(nhalo)
+    for it in range(max_iter+1):
+        redo = []
+        for ib in range(0, len(todo), batch):
+            ids = todo[ib:ib+batch]
+            edge_density = _so_batch(tree, mass, centres[ids], rsearch[ids], Densities, rvir, mvir, ids, nproc)
+            redo.append(ids[edge_density > Densities[0]])
+        todo = np.concatenate(redo)
+        if len(todo) == 0 or it == max_iter:
+            break
+        rsearch[todo] *= 2.
+    if len(todo) > 0:
+        mylog.warning('%d halos are still above the lowest overdensity at their largest search radius '
+                      'after so_max_iter=%d doublings; their SO radii and masses are lower limits' % (len(todo), max_iter))
+
+    for ir, rtype in enumerate(SO_NAMES[:nDens]):
+        catalogue.set_column('virial_quantities', rvir[:,ir], obj.units['length'], key='r'+rtype)
+        catalogue.set_column('virial_quantities', mvir[:,ir], obj.units['mass'], key='m'+rtype)
+    memlog('Computed spherical overdensity quantities for %d halos' % nhalo)
+
+def _so_batch(tree, mass, centres, rsearch, Densities, rvir, mvir, ids, nproc):
+    """Fills rvir[ids], mvir[ids] from the particles within rsearch of each
+    of centres; returns the mean density within each search radius."""
+    from caesar.spatial_index import ball_neighbors
+    start, ind, r = ball_neighbors(tree, centres, rsearch, nproc)
+    counts = np.diff(start)
+    edge_density = np.zeros(len(ids))
+    if start[-1] == 0:
+        return edge_density
+    seg = np.repeat(np.arange(len(ids)), counts)
+    order = np.lexsort((r, seg))
+    r = r[order]
+    m = mass[ind[order]]
+
+    # enclosed mass within each group's sorted radii
+    full = counts > 0
+    starts = start[:-1][full]
+    mcum = np.cumsum(m)
+    mcum -= np.repeat(mcum[starts] - m[starts], counts[full])
+    density = np.zeros(len(r))
+    nonzero = r > 0.
+    density[nonzero] = mcum[nonzero] / (4./3.*np.pi*r[nonzero]**3)
+
+    # r_Delta is the outermost radius with enclosed density above Delta
+    k = np.arange(len(r))
+    for j in range(len(Densities)):
+        last = np.maximum.reduceat(np.where(density > Densities[j], k, -1), starts)
+        found = last >= 0
+        rvir[ids[full][found], j] = r[last[found]]
+        mvir[ids[full][found], j] = mcum[last[found]]
+    edge_density[full] = mcum[starts+counts[full]-1] / (4./3.*np.pi*rsearch[full]**3)
+    return edge_density
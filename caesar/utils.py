@@ -59,6 +59,12 @@ def rotator(vals, ALPHA=0, BETA=0):
 def calculate_local_densities(obj, group_list):
     """Calculate the local number and mass density of objects.
 
+    For each search radius, the number and total mass of objects within
+    it are found for all objects at once, from one threaded query of the
+    shared periodic tree of object positions; units are attached to the
+    resulting arrays once, and they are stored as the columns of each
+    object's ``local_mass_density`` and ``local_number_density`` dicts.
+
     Parameters
     ----------
     obj : SPHGR object
@@ -70,8 +76,7 @@ def calculate_local_densities(obj, group_list):
         return
     
     try:
-        from scipy.spatial import KDTree, cKDTree
-        from caesar.periodic_kdtree import PeriodicCKDTree
+        from scipy.spatial import cKDTree
         #mylog.info('Calculating local densities')
     except:
         mylog.warning('Could not import scipy.spatial! '   \
@@ -79,12 +84,16 @@ def calculate_local_densities(obj, group_list):
                       'local density calculations.')
         return
 
-    pos  = np.array([i.pos for i in group_list])
-    mass = np.array([i.masses['total'] for i in group_list])
-    box  = obj.simulation.boxsize
-    box  = np.array([box,box,box])
-    
-    TREE = PeriodicCKDTree(box, pos)
+    # convert units once for all groups, which share them
+    from caesar.catalogue import group_catalogue
+    catalogue = group_catalogue(group_list)
+    pos  = catalogue.column('pos').to(obj.units['length']).d
+    mass = catalogue.column('masses', 'total').to(obj.units['mass']).d
+    box  = obj.simulation.boxsize.to(obj.units['length']).d
+
+    # shared tree of the group positions, keyed by the positions themselves
+    key  = (group_list[0].obj_type, obj.spatial_index.selection_key(pos), obj.units['length'])
+    builder = lambda: (pos, box, mass)
 
     if 'search_radius' in obj._kwargs:
         if isinstance(obj._kwargs['search_radius'],(int,float)):
@@ -93,16 +102,15 @@ def calculate_local_densities(obj, group_list):
             obj.simulation.search_radius = np.array(obj._kwargs['search_radius'])
         obj.simulation.search_radius = obj.yt_dataset.arr(obj.simulation.search_radius, obj.units['length'])
 
-    for group in group_list:
-        group.local_mass_density   = {}
-        group.local_number_density = {}
-        for search_radius in obj.simulation.search_radius:
-            search_volume = 4.0/3.0 * np.pi * search_radius**3
-            inrange = TREE.query_ball_point(group.pos, search_radius.d)
-            total_mass = obj.yt_dataset.quan(np.sum(mass[inrange]), obj.units['mass'])
-            rname = str(int(search_radius.d))
-            group.local_mass_density[rname] = total_mass / search_volume
-            group.local_number_density[rname] = float(len(inrange)) / search_volume
+    catalogue.clear_dict('local_mass_density')
+    catalogue.clear_dict('local_number_density')
+    for search_radius in obj.simulation.search_radius:
+        r = search_radius.to(obj.units['length']).d
+        search_volume = 4.0/3.0 * np.pi * r**3
+        total_mass, number = obj.spatial_index.sum_within(key, builder, pos, r, return_count=True)
+        rname = str(int(search_radius.d))
+        catalogue.set_column('local_mass_density', total_mass / search_volume, '%s/%s**3' % (obj.units['mass'], obj.units['length']), key=rname)
+        catalogue.set_column('local_number_density', number / search_volume, '%s**-3' % obj.units['length'], key=rname)
 
 
 def info_printer(obj, group_type, top):
@@ -101,7 +101,6 @@ def get_IC_pos(group, ic_ds, radius_type,search_factor=2.5, return_mask=False):
     
     """    
     from caesar.property_manager import ptype_aliases, get_property, DatasetType
-    from caesar.periodic_kdtree import PeriodicCKDTree
 
     ic_ds_type = ic_ds.__class__.__name__
     if ic_ds_type not in ptype_aliases:
@@ -131,14 +130,13 @@ def get_IC_pos(group, ic_ds, radius_type,search_factor=2.5, return_mask=False):
     )
         
     box    = ic_ds.domain_width[0].d
-    bounds = np.array([box,box,box])
 
     dmpids = get_property(obj.obj, 'pid', 'dm').d
-    dmpos  = get_property(obj.obj, 'pos', 'dm').d
-    
-    dm_TREE = PeriodicCKDTree(bounds, dmpos)
 
-    valid = dm_TREE.query_ball_point(search_params['pos'], search_params['r'])
+    valid = obj.obj.spatial_index.query_ball_point(
+        ('dm', 'all', 'code_length'),
+        lambda: (get_property(obj.obj, 'pos', 'dm').d, box, None),
+        search_params['pos'], search_params['r'])
     search_params['ids'] = dmpids[valid]
 
     ic_ds_type = DatasetType(ic_ds)
@@ -169,7 +167,7 @@ def get_IC_pos(group, ic_ds, radius_type,search_factor=2.5, return_mask=False):
 
 
 def construct_lowres_tree(group, lowres):
-    """Construct a periodic KDTree for low-resolution particles.
+    """Key and builder of the periodic KDTree of low-resolution particles.
 
     Parameters
     ----------
@@ -179,41 +177,34 @@ def construct_lowres_tree(group, lowres):
         Particle types to be considered low-resolution.  Typically
         [2,3,5]
 
-    Notes
-    -----
-    Assigns the dict ``_lowres`` to the :class:`main.CAESAR` object.
+    Returns
+    -------
+    key, builder
+        Arguments identifying the tree, with the low-resolution particle
+        masses as weights, in the :class:`spatial_index.SpatialIndex` of
+        the :class:`main.CAESAR` object; it is built on first use.
 
     """
     obj = group.obj
-    if hasattr(obj, '_lowres') and obj._lowres['ptypes'] == lowres:
-        return
-    mylog.info('Gathering low-res particles and constructing tree')
-    from caesar.property_manager import get_property
-    
-    lr_pos  = np.empty((0,3))
-    lr_mass = np.empty(0)
-
     pos_unit  = group.pos.units
     mass_unit = group.masses['total'].units
-    
-    for p in lowres:
-        ptype = 'PartType%d' % p
-        if ptype in obj.yt_dataset.particle_fields_by_type:
-            cur_pos  = obj._ds_type.dd[ptype, 'particle_position'].to(pos_unit)
-            cur_mass = obj._ds_type.dd[ptype, 'particle_mass'].to(mass_unit)
-
-            lr_pos  = np.append(lr_pos,  cur_pos.d, axis=0)
-            lr_mass = np.append(lr_mass, cur_mass.d, axis=0)
-    
-    from caesar.periodic_kdtree import PeriodicCKDTree
-    box    = obj.simulation.boxsize.to(pos_unit)
-    bounds = np.array([box,box,box])
-
-    obj._lowres = dict(
-        TREE   = PeriodicCKDTree(bounds, lr_pos),
-        MASS   = lr_mass,
-        ptypes = lowres
-    )
+
+    def builder():
+        mylog.info('Gathering low-res particles and constructing tree')
+        lr_pos  = np.empty((0,3))
+        lr_mass = np.empty(0)
+        for p in lowres:
+            ptype = 'PartType%d' % p
+            if ptype in obj.yt_dataset.particle_fields_by_type:
+                cur_pos  = obj._ds_type.dd[ptype, 'particle_position'].to(pos_unit)
+                cur_mass = obj._ds_type.dd[ptype, 'particle_mass'].to(mass_unit)
+
+                lr_pos  = np.append(lr_pos,  cur_pos.d, axis=0)
+                lr_mass = np.append(lr_mass, cur_mass.d, axis=0)
+        box = obj.simulation.boxsize.to(pos_unit).d
+        return lr_pos, box, lr_mass
+
+    return ('lowres', tuple(lowres), str(pos_unit), str(mass_unit)), builder
 
 
 def all_object_contam_check(obj):
@@ -0,0 +1,68 @@
+"""Benchmark caesar's parallel 3D FOF against yt's ParticleContourTree.
+
+Runs the halo 3D FOF that member_search() uses with haloid='fof' on all
+particles of a snapshot, once with yt's (serial) ParticleContourTree and
+once per requested thread count with caesar's cell-linked-list FOF, and
+checks that both engines find the same groups.
+
+usage: python benchmark_fof.py SNAPSHOT [-nproc 1 2 4 8] [--skip-yt]
+"""
+import argparse
+import time
+
+import numpy as np
+import yt
+import caesar
+from caesar.fubar import fof, get_mean_interparticle_separation, get_b
+from caesar.property_manager import get_property, has_ptype
+
+parser = argparse.ArgumentParser()
+parser.add_argument('snapshot', type=str, help='Snapshot to run the 3D FOF on')
+parser.add_argument('-nproc', type=int, nargs='+', default=[1, 2, 4, 8], help='Thread counts for the caesar FOF')
+parser.add_argument('--skip-yt', action='store_true', help='Do not time the yt FOF')
+args = parser.parse_args()
+
+ds = yt.load(args.snapshot)
+obj = caesar.CAESAR(ds)
+obj._args = ()
+obj._kwargs = {}
+
+LL = get_mean_interparticle_separation(obj) * get_b(obj, 'halo')
+pos = np.empty((0, 3), dtype=np.float32)
+for p in obj.data_manager.ptypes:
+    if not has_ptype(obj, p):
+        continue
+    pos = np.append(pos, get_property(obj, 'pos', p).to(obj.units['length']).d.astype(np.float32), axis=0)
+print('%d particles, LL=%g %s' % (len(pos), LL, obj.units['length']))
+
+
+def partition(tags):
+    """Relabels tags in order of first appearance, so different engines compare equal."""
+    grouped = tags >= 0
+    _, first, inverse = np.unique(tags[grouped], return_index=True, return_inverse=True)
+    labels = np.full(len(tags), -1, dtype=np.int64)
+    labels[grouped] = np.argsort(np.argsort(first))[inverse]
+    return labels
+
+
+def run(engine, nproc):
+    obj._kwargs['fof_engine'] = engine
+    obj.nproc = nproc
+    t0 = time.time()
+    tags = fof(obj, pos, LL, group_type='halo')
+    dt = time.time() - t0
+    print('%6s nproc=%-3d %8.2f s  %d groups, %d grouped particles' %
+          (engine, nproc, dt, len(np.unique(tags[tags >= 0])), np.sum(tags >= 0)))
+    return tags, dt
+
+
+reference = None
+if not args.skip_yt:
+    tags, t_yt = run('yt', 1)
+    reference = partition(tags)
+
+for nproc in args.nproc:
+    tags, dt = run('caesar', nproc)
+    if reference is not None:
+        print('       speedup vs yt: %.1fx, identical groups: %s' %
+              (t_yt / dt, np.array_equal(partition(tags), reference)))
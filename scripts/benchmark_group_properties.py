@@ -0,0 +1,76 @@
+"""Scaling benchmark for the group property kernel (group_funcs).
+
+Builds a synthetic catalogue of groups with a power-law size distribution
+(gas, DM and star particles in NFW-like clumps), runs the compiled kernel
+behind get_group_overall_properties once per requested thread count, and
+reports wall time and speedup relative to one thread.  Results for every
+thread count are compared with the first run; groups above the big-group
+threshold are summed in a different order when split over threads, so the
+comparison allows for rounding differences.
+
+usage: python benchmark_group_properties.py [-ngroup 20000] [-npmax 200000]
+                                            [-nproc 1 2 4 8 16 32 64] [-big_npart 0]
+                                            [-halos] [-seed 0]
+"""
+import argparse
+import time
+
+import numpy as np
+from caesar.group_funcs import group_overall_kernel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-ngroup', type=int, default=20000, help='Number of groups')
+parser.add_argument('-npmin', type=int, default=32, help='Particles in the smallest group')
+parser.add_argument('-npmax', type=int, default=200000, help='Particles in the largest group')
+parser.add_argument('-nproc', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64], help='Thread counts')
+parser.add_argument('-halos', action='store_true', help='Treat groups as halos (also computes virial quantities)')
+parser.add_argument('-big_npart', type=int, default=0, help='Groups above this size use all threads each (0: automatic)')
+parser.add_argument('-seed', type=int, default=0, help='Random seed')
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+Lbox = 1.e5
+group_ptypes = np.array([0, 1, 4], dtype=np.int32)  # gas, dm, star
+
+# dN/dn ~ n^-2 between npmin and npmax, like a halo mass function
+u = rng.uniform(size=args.ngroup)
+npart = (1. / (1. / args.npmin - u * (1. / args.npmin - 1. / args.npmax))).astype(np.int64)
+npart = np.sort(npart)[::-1]
+hid_bins = np.append(0, np.cumsum(npart)).astype(np.int64)
+ntot = hid_bins[-1]
+
+centres = np.repeat(rng.uniform(0, Lbox, (args.ngroup, 3)), npart, axis=0)
+rscale = np.repeat(10. * (npart / float(args.npmin))**(1. / 3.), npart)
+r = rscale * rng.uniform(size=ntot)**2
+mu = rng.uniform(-1, 1, ntot)
+phi = rng.uniform(0, 2 * np.pi, ntot)
+sinth = np.sqrt(1 - mu**2)
+pos = (centres + r[:, None] * np.column_stack((sinth * np.cos(phi), sinth * np.sin(phi), mu))) % Lbox
+vel = rng.normal(0, 100., (ntot, 3)) + np.cross(np.array([0., 0., 0.5]), pos - centres)
+ptype = group_ptypes[rng.integers(0, len(group_ptypes), ntot)]
+mass = np.where(ptype == 1, 5.e7, 1.e7) * rng.uniform(0.9, 1.1, ntot)
+pot = -1.e5 / (1. + r)
+del centres, rscale, r, mu, phi, sinth
+
+pos = np.ascontiguousarray(pos, dtype=np.float32)
+vel = np.ascontiguousarray(vel, dtype=np.float32)
+mass = mass.astype(np.float32)
+pot = pot.astype(np.float32)
+ptype = ptype.astype(np.int32)
+Densities = np.array([200., 500., 2500.]) * 150.  # Msun/kpc**3 scale
+gtflag = 1 if args.halos else 2
+print('%d groups, %d particles, largest group %d' % (args.ngroup, ntot, npart[0]))
+
+reference = None
+t1 = None
+for nproc in args.nproc:
+    t0 = time.time()
+    result = group_overall_kernel(hid_bins, pos, vel, mass, pot, ptype, group_ptypes, Densities, Lbox, gtflag, True, nproc, args.big_npart)
+    dt = time.time() - t0
+    if reference is None:
+        reference = result
+    if t1 is None and nproc == 1:
+        t1 = dt
+    same = all(np.allclose(a, b, rtol=1.e-4, atol=1.e-5) for a, b in zip(result, reference))
+    print('nproc=%-3d %8.2f s  speedup %5.1fx  matches first run: %s' %
+          (nproc, dt, (t1 / dt) if t1 is not None else np.nan, same))
@@ -0,0 +1,80 @@
+"""Benchmark of the radial quantile paths of the group property kernel.
+
+For each group size, builds a set of synthetic NFW-like halos (gas, DM and
+star particles) and runs the compiled kernel behind
+get_group_overall_properties with radial_method='sort' (a full qsort of
+every group by radius) and radial_method='select' (radius buckets, only
+the buckets holding the 20/50/80% mass radii and virial radii sorted).
+Reports the time per group of each, and how many of the mass and virial
+radii differ between the two; the other quantities are summed in a
+different order by 'select', so are compared allowing for rounding.
+
+usage: python benchmark_radial_quantiles.py [-npart 1000 10000 100000 1000000]
+                                            [-nparttot 2000000] [-galaxies] [-seed 0]
+"""
+import argparse
+import time
+
+import numpy as np
+from caesar.group_funcs import group_overall_kernel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-npart', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help='Particles per group')
+parser.add_argument('-nparttot', type=int, default=2000000, help='Particles per run (sets the number of groups)')
+parser.add_argument('-galaxies', action='store_true', help='Treat groups as galaxies (skips virial quantities)')
+parser.add_argument('-seed', type=int, default=0, help='Random seed')
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+Lbox = 1.e5
+group_ptypes = np.array([0, 1, 4], dtype=np.int32)  # gas, dm, star
+Densities = np.array([200., 500., 2500.]) * 150.  # Msun/kpc**3 scale
+gtflag = 2 if args.galaxies else 1
+
+
+def make_groups(ngroup, npart):
+    ntot = ngroup * npart
+    hid_bins = np.arange(ngroup + 1, dtype=np.int64) * npart
+    centres = np.repeat(rng.uniform(0, Lbox, (ngroup, 3)), npart, axis=0)
+    rs = 10. * (npart / 1000.)**(1. / 3.)
+    # enclosed fraction of an NFW profile with concentration 10, sampled by inversion
+    c = 10.
+    fc = np.log(1 + c) - c / (1 + c)
+    xs = np.logspace(-4, np.log10(c), 2000)
+    r = rs * np.interp(rng.uniform(size=ntot) * fc, np.log(1 + xs) - xs / (1 + xs), xs)
+    mu = rng.uniform(-1, 1, ntot)
+    phi = rng.uniform(0, 2 * np.pi, ntot)
+    sinth = np.sqrt(1 - mu**2)
+    pos = (centres + r[:, None] * np.column_stack((sinth * np.cos(phi), sinth * np.sin(phi), mu))) % Lbox
+    vel = rng.normal(0, 100., (ntot, 3)) + np.cross(np.array([0., 0., 0.5]), pos - centres)
+    ptype = group_ptypes[rng.integers(0, len(group_ptypes), ntot)]
+    mass = np.where(ptype == 1, 5.e7, 1.e7) * rng.uniform(0.9, 1.1, ntot)
+    pot = -1.e5 / (1. + r)
+    return (hid_bins, np.ascontiguousarray(pos, dtype=np.float32), np.ascontiguousarray(vel, dtype=np.float32),
+            mass.astype(np.float32), pot.astype(np.float32), ptype.astype(np.int32))
+
+
+print('%10s %7s %12s %12s %7s %14s %10s' % ('npart', 'ngroup', 'sort/grp', 'select/grp', 'speedup', 'radii differ', 'others ok'))
+for npart in args.npart:
+    ngroup = max(args.nparttot // npart, 1)
+    hid_bins, pos, vel, mass, pot, ptype = make_groups(ngroup, npart)
+    timing = {}
+    result = {}
+    for method in ['sort', 'select']:
+        t0 = time.time()
+        result[method] = group_overall_kernel(hid_bins, pos, vel, mass, pot, ptype, group_ptypes, Densities,
+                                              Lbox, gtflag, True, 1, 0, radial_method=method)
+        timing[method] = (time.time() - t0) / ngroup
+    # R20, Rhalf, R80 and mvir, rvir are items 7-9 and 12-13 of the returned tuple
+    radii = [7, 8, 9, 12, 13]
+    ndiff = sum(np.sum(result['sort'][i] != result['select'][i]) for i in radii)
+    nradii = sum(result['sort'][i].size for i in radii)
+    # angular momenta (item 11) are compared as vectors, as components can cancel
+    others = all(np.allclose(result['sort'][i], result['select'][i], rtol=1.e-4, atol=1.e-5)
+                 for i in range(len(result['sort'])) if i not in radii + [11])
+    Ls, Lq = result['sort'][11], result['select'][11]
+    others &= np.all(np.linalg.norm(Ls[..., :3] - Lq[..., :3], axis=-1) <= 1.e-4 * np.linalg.norm(Ls[..., :3], axis=-1))
+    others &= np.allclose(Ls[..., 3:], Lq[..., 3:], rtol=1.e-3, atol=1.e-3)
+    print('%10d %7d %10.3f ms %10.3f ms %6.1fx %7d/%-6d %10s' %
+          (npart, ngroup, 1.e3 * timing['sort'], 1.e3 * timing['select'], timing['sort'] / timing['select'],
+           ndiff, nradii, others))
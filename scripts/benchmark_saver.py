@@ -0,0 +1,134 @@
+"""Benchmark the chunked columnar saver on a synthetic galaxy catalogue.
+
+Builds -ngal galaxies with a catalogue of properties laid out like those
+of member_search (masses, radii, rotation, ... dicts and pos/vel-like
+vectors) and a global index list of -nlist entries per galaxy, then
+writes them as saver.save does, once per requested filter setting and
+thread count.  With --legacy it first writes them the way the saver did
+before, gathering each property from every galaxy and compressing with
+gzip level 1 in HDF5, for comparison.  Each file is read back and
+checked against the catalogue.
+
+usage: python benchmark_saver.py [-ngal 1000000] [-nlist 20] [-nproc 1 4 8]
+                                 [-compression gzip lzf zstd blosc] [--shuffle] [--legacy]
+"""
+import argparse
+import os
+import time
+
+import h5py
+import numpy as np
+from yt.units.yt_array import YTArray
+from caesar.group import Galaxy
+from caesar.catalogue import group_catalogue
+from caesar.saver import ChunkedWriter, serialize_attributes
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-ngal', type=int, default=1000000, help='Number of galaxies')
+parser.add_argument('-nlist', type=int, default=20, help='Global index list entries per galaxy')
+parser.add_argument('-nproc', type=int, nargs='+', default=[1, 4, 8], help='Compression thread counts')
+parser.add_argument('-compression', type=str, nargs='+', default=['gzip', 'lzf', 'zstd', 'blosc'], help='Filters to time')
+parser.add_argument('--shuffle', action='store_true', help='Byte shuffle before compression')
+parser.add_argument('--legacy', action='store_true', help='Also time per-galaxy gathers with h5py gzip level 1')
+parser.add_argument('-out', type=str, default='benchmark_saver.hdf5', help='Output file, overwritten')
+args = parser.parse_args()
+
+
+class _Dataset(object):
+    def arr(self, values, units):
+        return YTArray(values, units)
+
+class _CAESAR(object):
+    yt_dataset = _Dataset()
+
+rng = np.random.default_rng(0)
+ngal = args.ngal
+t0 = time.time()
+galaxies = [Galaxy(_CAESAR()) for i in range(ngal)]
+catalogue = group_catalogue(galaxies)
+ptypes = ['gas', 'stellar', 'dm', 'bh', 'baryon', 'total']
+lognormal = lambda dtype: np.exp(rng.normal(20, 2, ngal)).astype(dtype)
+for p in ptypes:
+    catalogue.set_column('masses', lognormal(np.float32), 'Msun', key=p)
+    for r in ['_m20', '_half_mass', '_m80']:
+        catalogue.set_column('radii', lognormal(np.float32), 'kpc', key=p+r)
+    catalogue.set_column('velocity_dispersions', lognormal(np.float32), 'km/s', key=p)
+    catalogue.set_column('rotation', rng.normal(0, 1e12, (ngal, 3)).astype(np.float32), 'Msun*kpc*km/s', key=p+'_L')
+    for a in ['_ALPHA', '_BETA', '_BoverT', '_kappa_rot']:
+        catalogue.set_column('rotation', rng.random(ngal).astype(np.float32), '', key=p+a)
+for k in ['HI', 'H2', 'dust', 'HI_30kpc', 'H2_30kpc', 'gas_30kpc', 'stellar_30kpc', 'dm_30kpc']:
+    catalogue.set_column('masses', lognormal(np.float64), 'Msun', key=k)
+for k in ['mass_weighted', 'sfr_weighted', 'mass_weighted_cgm', 'temp_weighted_cgm', 'stellar']:
+    catalogue.set_column('metallicities', rng.random(ngal), '', key=k)
+for k in ['mass_weighted', 'mass_weighted_cgm', 'metal_weighted_cgm']:
+    catalogue.set_column('temperatures', lognormal(np.float64), 'K', key=k)
+for k in ['mass_weighted', 'metal_weighted']:
+    catalogue.set_column('ages', 13*rng.random(ngal), 'Gyr', key=k)
+for k in ['pos', 'minpotpos']:
+    catalogue.set_column(k, (1e5*rng.random((ngal, 3))).astype(np.float32), 'kpc')
+for k in ['vel', 'minpotvel']:
+    catalogue.set_column(k, rng.normal(0, 300, (ngal, 3)).astype(np.float32), 'km/s')
+for k in ['sfr', 'sfr_100', 'bhmdot']:
+    catalogue.set_column(k, lognormal(np.float64), 'Msun/yr')
+catalogue.set_column('GroupID', np.arange(ngal))
+for k in ['ngas', 'nstar', 'nbh']:
+    catalogue.set_column(k, rng.integers(0, 10000, ngal))
+catalogue.set_column('parent_halo_index', rng.integers(0, ngal, ngal))
+catalogue.set_column('central', rng.random(ngal) < 0.5)
+global_list = np.sort(rng.integers(0, ngal, ngal*args.nlist))
+ndata = len(catalogue.data) + sum(len(d) for d in catalogue.dicts.values())
+print('%d galaxies with %d properties, %d index list entries (%.2f s to build)' % (ngal, ndata, len(global_list), time.time()-t0))
+
+
+def check(filename):
+    """Whether filename holds the catalogue and index list."""
+    with h5py.File(filename, 'r') as hd:
+        ok = np.array_equal(hd['global_lists/galaxy_glist'][:], global_list)
+        for k, column in catalogue.data.items():
+            ok &= np.array_equal(hd['galaxy_data/%s' % k][:], np.asarray(column))
+        for name, columns in catalogue.dicts.items():
+            for k, column in columns.items():
+                ok &= np.array_equal(hd['galaxy_data/dicts/%s.%s' % (name, k)][:], np.asarray(column))
+    return ok
+
+def legacy_save(filename):
+    """Gathers each property from every galaxy, as the saver used to."""
+    with h5py.File(filename, 'w') as hd:
+        gd = hd.create_group('galaxy_data')
+        gdd = gd.create_group('dicts')
+        for k, v in galaxies[0]._attributes().items():
+            if isinstance(v, dict) or hasattr(v, 'keys'):
+                for kk in v:
+                    data = np.array([getattr(g, k)[kk].d if hasattr(v[kk], 'units') else getattr(g, k)[kk] for g in galaxies])
+                    gdd.create_dataset('%s.%s' % (k, kk), data=data, compression=1)
+            elif hasattr(v, 'units'):
+                gd.create_dataset(k, data=np.array([getattr(g, k).d for g in galaxies]), compression=1)
+            elif isinstance(v, (int, float, bool, np.number)):
+                gd.create_dataset(k, data=[getattr(g, k) for g in galaxies], compression=1)
+        hd.create_group('global_lists').create_dataset('galaxy_glist', data=global_list, compression=1)
+
+def columnar_save(filename, compression, nproc):
+    """Writes the catalogue and index list as saver.save does."""
+    writer = ChunkedWriter(compression, shuffle=args.shuffle, nproc=nproc)
+    with h5py.File(filename, 'w') as hd:
+        gd = hd.create_group('galaxy_data')
+        serialize_attributes(galaxies, gd, gd.create_group('dicts'), writer)
+        writer.write(hd.create_group('global_lists'), 'galaxy_glist', global_list)
+        writer.close()
+
+print('%-22s %10s %10s %9s %6s' % ('writer', 'time', 'size (MB)', 'speedup', 'ok'))
+t_legacy = None
+if args.legacy:
+    t0 = time.time()
+    legacy_save(args.out)
+    t_legacy = time.time() - t0
+    print('%-22s %8.2f s %10.1f %9s %6s' % ('legacy gzip-1', t_legacy, os.path.getsize(args.out)/1024.**2, '1', check(args.out)))
+for compression in args.compression:
+    for nproc in args.nproc:
+        t0 = time.time()
+        columnar_save(args.out, compression, nproc)
+        dt = time.time() - t0
+        speedup = '%.1f' % (t_legacy/dt) if t_legacy is not None else '-'
+        print('%-22s %8.2f s %10.1f %9s %6s' % ('%s%s nproc=%d' % (compression, '+shuffle' if args.shuffle else '', nproc),
+                                                  dt, os.path.getsize(args.out)/1024.**2, speedup, check(args.out)))
+os.remove(args.out)
@@ -0,0 +1,68 @@
+"""Benchmark of the compiled gravitational unbinding kernel (group_funcs).
+
+Builds groups of a given size, each a cold, centrally concentrated clump
+plus a fraction of fast-moving background particles that the unbinding
+should remove, and runs the kernel behind caesar.group.unbind_groups with
+the direct-sum potential and with the Barnes-Hut octree.  Reports the time
+per group of each, the fraction of clump and background particles kept,
+and how many particles the two potentials disagree on.
+
+usage: python benchmark_unbinding.py [-npart 300 3000 30000] [-nparttot 300000]
+                                     [-background 0.1] [-theta 0.5] [-nproc 1] [-seed 0]
+"""
+import argparse
+import time
+
+import numpy as np
+from caesar.group_funcs import unbind_kernel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-npart', type=int, nargs='+', default=[300, 3000, 30000], help='Clump particles per group')
+parser.add_argument('-nparttot', type=int, default=300000, help='Particles per run (sets the number of groups)')
+parser.add_argument('-background', type=float, default=0.1, help='Unbound background particles, as a fraction of npart')
+parser.add_argument('-theta', type=float, default=0.5, help='Barnes-Hut opening angle')
+parser.add_argument('-nproc', type=int, default=1, help='Number of OpenMP threads')
+parser.add_argument('-seed', type=int, default=0, help='Random seed')
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+Lbox = 1.e5  # kpc
+G = 4.30091e-6  # kpc (km/s)**2 / Msun
+mpart = 1.e8  # Msun
+
+
+def make_groups(ngroup, npart, nbg):
+    ntot = npart + nbg
+    pos = np.empty((ngroup, ntot, 3))
+    vel = np.empty((ngroup, ntot, 3))
+    centres = rng.uniform(0, Lbox, (ngroup, 1, 3))
+    r = 5. * rng.uniform(size=(ngroup, npart))**2
+    d = rng.normal(size=(ngroup, npart, 3))
+    d /= np.linalg.norm(d, axis=-1)[..., None]
+    sigma = 0.3 * np.sqrt(G * npart * mpart / 5.)
+    pos[:, :npart] = r[..., None] * d
+    vel[:, :npart] = rng.normal(0, sigma, (ngroup, npart, 3))
+    pos[:, npart:] = rng.uniform(-20., 20., (ngroup, nbg, 3))
+    vel[:, npart:] = rng.normal(0, 50. * sigma, (ngroup, nbg, 3))
+    pos = (pos + centres) % Lbox
+    hid_bins = np.arange(ngroup + 1, dtype=np.int64) * ntot
+    return (hid_bins, np.ascontiguousarray(pos.reshape(-1, 3), dtype=np.float32),
+            np.ascontiguousarray(vel.reshape(-1, 3), dtype=np.float32), np.full(ngroup * ntot, mpart, dtype=np.float32))
+
+
+print('%8s %7s %12s %12s %7s %12s %10s %9s' % ('npart', 'ngroup', 'direct/grp', 'tree/grp', 'speedup', 'clump kept', 'bg kept', 'differ'))
+for npart in args.npart:
+    nbg = int(args.background * npart)
+    ngroup = max(args.nparttot // (npart + nbg), 1)
+    hid_bins, pos, vel, mass = make_groups(ngroup, npart, nbg)
+    timing = {}
+    bound = {}
+    for method, direct_npart in [('direct', npart + nbg), ('tree', 0)]:
+        t0 = time.time()
+        bound[method] = unbind_kernel(hid_bins, pos, vel, mass, Lbox, G, 0.01, 10, args.nproc,
+                                      direct_npart=direct_npart, theta=args.theta)[0].reshape(ngroup, -1)
+        timing[method] = (time.time() - t0) / ngroup
+    b = bound['tree'].astype(bool)
+    print('%8d %7d %9.3f ms %9.3f ms %6.1fx %12.4f %10.4f %9d' %
+          (npart, ngroup, 1.e3 * timing['direct'], 1.e3 * timing['tree'], timing['direct'] / timing['tree'],
+           b[:, :npart].mean(), b[:, npart:].mean(), np.sum(bound['tree'] != bound['direct'])))
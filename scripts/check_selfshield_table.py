@@ -0,0 +1,50 @@
+"""Accuracy report for the tabulated self-shielding in compute_selfshield.
+
+For each UV background model and redshift, draws gas particles uniformly in
+log nH and log T over the self-shielding regime (1e-4 atoms/cm^3 < nH <
+rho_thresh, 10 K < T < 1e5 K), and runs the compiled kernel behind
+compute_selfshield with the (log nH, log T) lookup table and with the
+analytic Rahmati+13/Popping+09 fits evaluated per particle.  Reports the
+maximum and rms relative differences of the HI fractions, how many
+particles differ by more than -tol, and the time of each path.
+
+usage: python check_selfshield_table.py [-npart 2000000] [-nbins 256] [-tol 1e-3]
+                                        [-redshifts 0 1 2 3 4 6] [-seed 0]
+"""
+import argparse
+import time
+
+import numpy as np
+from caesar.hydrogen_mass_calc import selfshield_constants, selfshield_kernel
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-npart', type=int, default=2000000, help='Particles per redshift')
+parser.add_argument('-nbins', type=int, default=256, help='Table bins in each of log nH and log T')
+parser.add_argument('-tol', type=float, default=1.e-3, help='Relative difference to count as an outlier')
+parser.add_argument('-redshifts', type=float, nargs='+', default=[0., 1., 2., 3., 4., 6.], help='Snapshot redshifts')
+parser.add_argument('-seed', type=int, default=0, help='Random seed')
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+rho_thresh = 0.13  # atoms/cm^3, as in get_HIH2_masses
+fbaryon = 0.048 / 0.3
+
+nh = (10**rng.uniform(-4, np.log10(rho_thresh), args.npart)).astype(np.float32)
+T = (10**rng.uniform(1, 5, args.npart)).astype(np.float32)
+fHI_thin = (10**rng.uniform(-7, -2, args.npart)).astype(np.float32)
+
+print('%5s %5s %10s %10s %10s %9s %10s %10s' % ('UVB', 'z', 'GammaHI', 'max rel', 'rms rel', '>tol', 'analytic', 'table'))
+for uvb_model in ['FG11', 'FG19', 'HM12', 'HM01']:
+    for z in args.redshifts:
+        gamma_HI, nHss_part = selfshield_constants(z, fbaryon, uvb_model)
+        if gamma_HI == 0.:
+            print('%5s %5g %10s  no UV background, analytic only' % (uvb_model, z, '0'))
+            continue
+        t0 = time.time()
+        fHI_exact, fH2_exact = selfshield_kernel(nh, T, fHI_thin, gamma_HI, nHss_part, rho_thresh, 1, use_table=False)
+        t1 = time.time()
+        fHI_table, fH2_table = selfshield_kernel(nh, T, fHI_thin, gamma_HI, nHss_part, rho_thresh, 1, use_table=True, nbins=args.nbins)
+        t2 = time.time()
+        rel = np.abs(fHI_table.astype(np.float64) / fHI_exact - 1.)
+        print('%5s %5g %10.3e %10.3e %10.3e %9d %8.3f s %8.3f s' %
+              (uvb_model, z, gamma_HI, rel.max(), np.sqrt(np.mean(rel**2)), np.sum(rel > args.tol), t1 - t0, t2 - t1))
@@ -54,6 +54,10 @@ cython_extensions = [
               sources=['caesar/hydrogen_mass_calc/hydrogen_mass_calc.pyx'],
               extra_compile_args=[compile_arg],
               extra_link_args=[link_arg]),
+    Extension('caesar.fof_funcs',
+              sources=['caesar/fof_funcs/fof_funcs.pyx'],
+              extra_compile_args=[compile_arg],
+              extra_link_args=[link_arg]),
     Extension('caesar.cyloser',
               sources=['caesar/pyloser/cyloser.pyx'],
               extra_compile_args=[compile_arg],
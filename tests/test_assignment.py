@@ -0,0 +1,41 @@
+import numpy as np
+
+from caesar.assignment import index_lists, majority_parents
+
+
+def _majority_reference(child, parent, nchild):
+    """Per child bincount argmax, as the assignment loops used to do."""
+    result = np.full(nchild, -1, dtype=np.int64)
+    for i in range(nchild):
+        combined = parent[(child == i) & (parent > -1)]
+        if len(combined) > 0:
+            result[i] = np.bincount(combined).argmax()
+    return result
+
+
+def test_majority_parents_reference():
+    rng = np.random.default_rng(3)
+    nchild, nparent = 200, 30
+    child = rng.integers(0, nchild, 5000)
+    # few parents per child so that ties are common
+    parent = (child % nparent + rng.integers(-1, 2, len(child))) % nparent
+    parent[rng.random(len(child)) < 0.2] = -1
+    parent[child == 17] = -1
+    result = majority_parents(child, parent, nchild)
+    assert result.dtype == np.int64
+    assert np.array_equal(result, _majority_reference(child, parent, nchild))
+    assert result[17] == -1
+
+    assert np.array_equal(majority_parents([], [], 3), [-1, -1, -1])
+    assert np.array_equal(majority_parents([0, 1], [-1, -1], 2), [-1, -1])
+
+
+def test_index_lists_reference():
+    rng = np.random.default_rng(4)
+    nparent = 25
+    parents = rng.integers(-1, nparent-3, 400)
+    lists = index_lists(parents, nparent)
+    assert len(lists) == nparent
+    for i in range(nparent):
+        assert np.array_equal(lists[i], [j for j in range(len(parents)) if parents[j] == i])
+    assert all(len(l) == 0 for l in index_lists([-1, -1], 2))
@@ -0,0 +1,45 @@
+import numpy as np
+from yt.units.yt_array import YTArray, YTQuantity
+
+from caesar.catalogue import group_catalogue, set_group_column
+from caesar.group import Galaxy
+
+
+class _Dataset(object):
+    def arr(self, values, units):
+        return YTArray(values, units)
+
+
+class _CAESAR(object):
+    yt_dataset = _Dataset()
+
+
+def _galaxies(n=5, masses=None):
+    obj = _CAESAR()
+    galaxies = [Galaxy(obj) for i in range(n)]
+    if masses is not None:
+        galaxies[0].masses = masses
+    group_catalogue(galaxies)
+    return galaxies
+
+
+def test_column_replaces_group_attribute():
+    gals = _galaxies()
+    gals[0].foo = 7
+    set_group_column(gals, 'foo', np.arange(5)*10)
+    assert [g.foo for g in gals] == [0, 10, 20, 30, 40]
+    gals[1].bar = 'not a number'
+    group_catalogue(gals).set_column('bar', np.arange(2), rows=np.array([0, 1]))
+    assert gals[0].bar == 0 and gals[1].bar == 1
+    assert not hasattr(gals[2], 'bar')
+
+
+def test_column_replaces_group_dict():
+    # a dict that does not fit the columns stays on its group
+    gals = _galaxies(masses={'gas': YTQuantity(1., 'Msun'), 'note': 'kept'})
+    assert 'masses' in gals[0].__dict__
+    set_group_column(gals, 'masses', np.arange(5.), 'Msun', key='stellar')
+    assert gals[0].masses['stellar'] == YTQuantity(0., 'Msun')
+    assert gals[0].masses['gas'] == YTQuantity(1., 'Msun')
+    assert gals[0].masses['note'] == 'kept'
+    assert gals[3].masses['stellar'] == YTQuantity(3., 'Msun') and 'gas' not in gals[3].masses
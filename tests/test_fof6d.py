@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+from sklearn.neighbors import NearestNeighbors
+
+from caesar.fof6d import fof6d_halo, fof6d_main, fof_sorting, kernel, kernel_table, periodic, sort_parts
+
+
+def _fof6d_reference(poslist, vellist, kerneltab, mingrp, fof_LL, vel_LL):
+    """Galaxy index of each particle, from the NearestNeighbors-based
+    fof6d_main that the compiled linking replaced."""
+    nactive = len(poslist)
+    nlist = NearestNeighbors(radius=fof_LL).fit(poslist).radius_neighbors(poslist)
+    siglist = []
+    for i in range(nactive):
+        wt = kernel(nlist[0][i]/fof_LL, kerneltab)
+        dv = np.linalg.norm(vellist[nlist[1][i]]-vellist[i], axis=1)
+        siglist.append(dv <= vel_LL*np.sqrt(np.sum(wt*dv*dv)/np.sum(wt)))
+    ncount = np.array([len(n) for n in nlist[1]])
+    galind = np.zeros(nactive, dtype=int)-1
+    linked = []
+    for densest in np.argsort(-ncount):
+        galind_ngb = np.where(siglist[densest], galind[nlist[1][densest]], -1)
+        if np.any(galind_ngb >= 0):
+            galmin = np.unique(galind_ngb[galind_ngb >= 0])
+            galind[nlist[1][densest]] = galmin[0]
+            for g in galmin[1:]:
+                linked[g] = min(linked[g], galmin[0])
+        else:
+            galind[nlist[1][densest]] = len(linked)
+            linked.append(len(linked))
+    for i in range(len(linked)-1, -1, -1):
+        galind[galind == i] = linked[i]
+    pcount = np.histogram(galind, bins=len(linked))[0]  # binned over the range of galind, as before
+    galind[pcount[galind] < mingrp] = -1
+    ingal = galind >= 0
+    galind[ingal] = np.unique(galind[ingal], return_inverse=True)[1]
+    return galind
+
+
+def _same_partition(a, b):
+    """Whether galaxy indexes a and b group the particles the same way."""
+    if not np.array_equal(a < 0, b < 0):
+        return False
+    pairs = np.unique(np.stack([a, b]), axis=1)
+    return len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+
+
+def _clumps(centres, n=150, size=0.3, seed=0):
+    """Gaussian clumps of particles, with float32 positions and velocities
+    like those of the data manager."""
+    rng = np.random.default_rng(seed)
+    pos = np.concatenate([c + size*rng.normal(size=(n, 3)) for c in centres])
+    vel = 10.*rng.normal(size=pos.shape)
+    return pos.astype(np.float32), vel.astype(np.float32)
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_fof6d_matches_reference(seed):
+    # Velocity differences are float32 in both, but the dispersion sums are
+    # in a different order, so the partitions are only required to agree
+    # because no pair of these random particles lies within that last-bit
+    # rounding of the vel_LL threshold.
+    pos, vel = _clumps([[2., 2., 2.], [2.6, 2., 2.], [6., 6., 6.]], seed=seed)
+    fof_LL = 0.2
+    kerneltab = kernel_table(fof_LL)
+    ngal, galind = fof6d_main(0, [[0, len(pos)]], pos, vel, kerneltab, 0., 10., 16, fof_LL, 1.0)
+    reference = _fof6d_reference(pos, vel, kerneltab, 16, fof_LL, 1.0)
+    assert ngal == reference.max()+1
+    assert _same_partition(galind, reference)
+
+
+def test_fof6d_not_periodic():
+    # one clump straddling the x=0 box edge, its halves at opposite sides of the box
+    Lbox = 10.
+    pos, vel = _clumps([[0., 5., 5.]])
+    pos[:,0] %= Lbox
+    fof_LL = 0.2
+    kerneltab = kernel_table(fof_LL)
+    ngal, galind = fof6d_main(0, [[0, len(pos)]], pos, vel, kerneltab, 0., Lbox, 16, fof_LL, 1.0)
+    reference = _fof6d_reference(pos, vel, kerneltab, 16, fof_LL, 1.0)
+    assert _same_partition(galind, reference)
+    low, high = pos[:,0] < 0.5*Lbox, pos[:,0] > 0.5*Lbox
+    assert not np.any(np.isin(galind[low & (galind >= 0)], galind[high & (galind >= 0)]))
+
+
+def test_fof6d_threads():
+    pos, vel = _clumps([[2., 2., 2.], [2.6, 2., 2.], [6., 6., 6.]], n=400)
+    fof_LL = 0.2
+    kerneltab = kernel_table(fof_LL)
+    serial = fof6d_main(0, [[0, len(pos)]], pos, vel, kerneltab, 0., 10., 16, fof_LL, 1.0, nproc=1)
+    for nproc in [2, 4]:
+        threaded = fof6d_main(0, [[0, len(pos)]], pos, vel, kerneltab, 0., 10., 16, fof_LL, 1.0, nproc=nproc)
+        assert threaded[0] == serial[0]
+        assert np.array_equal(threaded[1], serial[1])
+    serial = fof6d_halo(len(pos), len(pos), pos, vel, 16, 10., fof_LL, 1.0, kerneltab)
+    for nproc in [2, 4]:
+        assert np.array_equal(fof6d_halo(len(pos), len(pos), pos, vel, 16, 10., fof_LL, 1.0, kerneltab, nproc), serial)
+
+
+def _fof_sorting_reference(groups, pos, vel, haloID, pindex, fof_LL, Lbox, mingrp, idir):
+    """The particle-by-particle scan that split_sorted_groups replaced."""
+    oldgroups = groups[:]
+    groups = [[0, len(pindex)]]
+    grpcount = 0
+    for istart, iend in oldgroups:
+        sort_parts(pos, vel, haloID, pindex, istart, iend, idir, 'pos')
+        oldpos = pos[idir][istart]
+        groups[grpcount][0] = istart
+        for i in range(istart, iend):
+            if periodic(pos[idir][i], oldpos, Lbox) > fof_LL or i == iend-1:
+                groups[grpcount][1] = i
+                groups.append([i, i])
+                grpcount += 1
+            oldpos = pos[idir][i]
+    return [g for g in groups if g[1]-g[0] >= mingrp]
+
+
+def test_fof_sorting_reference():
+    pos, vel = _clumps([[0.1, 5., 5.], [3., 3., 3.], [3.2, 7., 3.], [8., 8., 9.9]], n=300, size=0.5)
+    pos %= 10.
+    data = [pos.T.copy(), vel.T.copy(), np.zeros(len(pos), dtype=np.int64), np.arange(len(pos))]
+    reference = [a.copy() for a in data]
+    groups = reference_groups = [[0, len(pos)]]
+    for idir in [0, 1, 2, 0]:
+        groups = fof_sorting(groups, *data, 0.05, 10., 16, idir)
+        reference_groups = _fof_sorting_reference(reference_groups, *reference, 0.05, 10., 16, idir)
+        assert groups == reference_groups
+        for a, b in zip(data, reference):
+            assert np.array_equal(a, b)
@@ -0,0 +1,46 @@
+import numpy as np
+from caesar.fof_funcs import cell_ids, fof3d
+
+
+def test_cell_ids_threads():
+    """Cell ids do not depend on the number of threads, and wrap periodically."""
+    rng = np.random.default_rng(1)
+    pos = rng.uniform(-10., 110., (200000, 3)).astype(np.float32)
+    ref = cell_ids(pos, 10, 10., nproc=1)
+    wrapped = np.floor(pos / np.float32(10.)).astype(np.int64) % 10
+    assert np.array_equal(ref, (wrapped[:,0]*10 + wrapped[:,1])*10 + wrapped[:,2])
+    for nproc in [2, 4, 8]:
+        assert np.array_equal(cell_ids(pos, 10, 10., nproc=nproc), ref)
+
+
+def test_fof3d_threads():
+    """fof3d finds the same groups with any number of threads."""
+    rng = np.random.default_rng(2)
+    centres = rng.uniform(0., 100., (50, 3))
+    pos = (centres[rng.integers(0, 50, 20000)] + rng.normal(0., 0.5, (20000, 3))) % 100.
+    ref = fof3d(pos, 100., 0.3, nproc=1)
+    for nproc in [2, 4]:
+        assert np.array_equal(fof3d(pos, 100., 0.3, nproc=nproc), ref)
+
+
+def test_fof3d_reference():
+    """fof3d groups particles as periodic pair linking does, across the box edges too."""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+    rng = np.random.default_rng(3)
+    centres = np.concatenate([rng.uniform(0., 100., (30, 3)), [[0., 50., 50.], [99.9, 0.1, 99.9]]])
+    pos = (centres[rng.integers(0, len(centres), 10000)] + rng.normal(0., 0.5, (10000, 3))) % 100.
+    tags = fof3d(pos, 100., 0.3, nproc=1, minimum_count=8)
+
+    pairs = cKDTree(pos, boxsize=100.).query_pairs(0.3, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:,0], pairs[:,1])), shape=(len(pos), len(pos)))
+    ncomp, labels = connected_components(graph, directed=False)
+    labels[np.bincount(labels)[labels] < 8] = -1
+    assert np.array_equal(tags < 0, labels < 0)
+    grouped = tags >= 0
+    # the same partition: each group of one maps to exactly one group of the other
+    pairs = np.unique(np.stack([tags[grouped], labels[grouped]]), axis=1)
+    assert len(np.unique(pairs[0])) == len(np.unique(pairs[1])) == pairs.shape[1]
+    # groups are tagged with one of their members
+    assert np.all(tags[tags[grouped]] == tags[grouped])
@@ -0,0 +1,59 @@
+import copy
+import pickle
+
+import numpy as np
+from yt.units.yt_array import YTArray, YTQuantity
+
+from caesar.catalogue import group_catalogue, set_group_column
+from caesar.group import Galaxy, collate_group_lists
+
+
+class _Dataset(object):
+    def arr(self, values, units):
+        return YTArray(values, units)
+
+
+class _CAESAR(object):
+    yt_dataset = _Dataset()
+
+
+def _galaxies(lists):
+    obj = _CAESAR()
+    galaxies = []
+    for l in lists:
+        g = Galaxy(obj)
+        g.glist = np.asarray(l, dtype=np.int64)
+        galaxies.append(g)
+    return galaxies
+
+
+def test_collate_group_lists():
+    lists = [[3, 1], [], [7, 8, 9]]
+    collated, bins = collate_group_lists(_galaxies(lists), 'glist')
+    assert np.array_equal(collated, [3, 1, 7, 8, 9])
+    assert np.array_equal(bins, [0, 2, 2, 5])
+
+
+def test_collate_group_lists_empty():
+    for lists in [[], [[], []]]:
+        collated, bins = collate_group_lists(_galaxies(lists), 'glist')
+        assert collated.dtype == np.int64 and len(collated) == 0
+        assert np.array_equal(bins, np.zeros(len(lists)+1))
+
+
+def test_copy_and_pickle():
+    galaxies = _galaxies([[1, 2], [3]])
+    group_catalogue(galaxies)
+    set_group_column(galaxies, 'sfr', np.array([1., 2.]), 'Msun/yr')
+    set_group_column(galaxies, 'masses', np.array([10., 20.]), 'Msun', key='stellar')
+    galaxies[1].halo = 'a link'
+
+    for other in [copy.copy(galaxies[1]), copy.deepcopy(galaxies[1]), pickle.loads(pickle.dumps(galaxies[1]))]:
+        assert other._get_catalogue() is None
+        assert other.sfr == YTQuantity(2., 'Msun/yr')
+        assert dict(other.masses) == {'stellar': YTQuantity(20., 'Msun')}
+        assert other.halo == 'a link'
+        assert np.array_equal(other.glist, [3])
+        other.sfr = YTQuantity(5., 'Msun/yr')
+        other.masses['gas'] = YTQuantity(1., 'Msun')
+        assert galaxies[1].sfr == YTQuantity(2., 'Msun/yr') and 'gas' not in galaxies[1].masses
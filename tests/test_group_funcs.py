@@ -0,0 +1,171 @@
+import numpy as np
+import pytest
+
+from caesar.group_funcs import group_overall_kernel, potential_kernel, unbind_kernel
+
+LBOX = 100.
+
+
+def _groups(sizes=(40, 300, 1200, 2500, 5), seed=0):
+    """Groups of particles of three types around random centres, the
+    first of them straddling the box edge; returns hid_bins and the
+    particle data ordered by group."""
+    rng = np.random.default_rng(seed)
+    pos, vel = [], []
+    for ig, n in enumerate(sizes):
+        centre = np.array([0.2, 50., 50.]) if ig == 0 else rng.random(3)*LBOX
+        pos.append(centre + rng.normal(size=(n, 3)) * rng.random((n, 1))**2)
+        vel.append(rng.normal(size=3)*100. + rng.normal(size=(n, 3))*30.)
+    pos = (np.concatenate(pos) % LBOX).astype(np.float32)
+    vel = np.concatenate(vel).astype(np.float32)
+    npart = len(pos)
+    mass = (1. + rng.random(npart)).astype(np.float32)
+    ptype = rng.choice(np.array([0, 1, 4], dtype=np.int32), npart)
+    hid_bins = np.append(0, np.cumsum(sizes)).astype(np.int64)
+    return hid_bins, pos, vel, mass, ptype
+
+
+def _unwrap(pos):
+    """Positions relative to the first, across the periodic boundaries."""
+    dx = pos.astype(np.float64) - pos[0]
+    return dx - LBOX*np.round(dx/LBOX)
+
+
+def _direct_phi(x, m, eps):
+    """Potential (without G) at each of x from all the others."""
+    d2 = np.sum((x[:,None,:]-x[None,:,:])**2, axis=2) + eps*eps
+    np.fill_diagonal(d2, np.inf)
+    return -np.sum(m[None,:]/np.sqrt(d2), axis=1)
+
+
+def _unbind_reference(x, v, m, G, eps, n_iter):
+    """Bound flags after iteratively removing particles with positive energy."""
+    active = np.arange(len(m))
+    for it in range(n_iter):
+        if len(active) < 2:
+            break
+        vcm = np.sum(m[active,None]*v[active], axis=0) / np.sum(m[active])
+        ke = 0.5*np.sum((v[active]-vcm)**2, axis=1)
+        keep = G*_direct_phi(x[active], m[active], eps) + ke <= 0.
+        if np.all(keep):
+            break
+        active = active[keep]
+    bound = np.zeros(len(m), dtype=bool)
+    bound[active] = True
+    return bound
+
+
+def test_potential_reference():
+    hid_bins, pos, vel, mass, ptype = _groups()
+    pot = potential_kernel(hid_bins, pos, mass, LBOX, 2., 0.01, 1, direct_npart=100000)
+    for ig in range(len(hid_bins)-1):
+        sl = slice(hid_bins[ig], hid_bins[ig+1])
+        reference = 2.*_direct_phi(_unwrap(pos[sl]), mass[sl].astype(np.float64), 0.01)
+        assert np.allclose(pot[sl], reference, rtol=1.e-5, atol=0.)
+
+
+@pytest.mark.parametrize('direct_npart', [100000, 100])
+def test_potential_threads(direct_npart):
+    hid_bins, pos, vel, mass, ptype = _groups()
+    serial = potential_kernel(hid_bins, pos, mass, LBOX, 1., 0.01, 1, direct_npart=direct_npart)
+    for nproc, big_npart in [(2, 0), (4, 0), (4, 1000)]:  # big_npart=1000: threads share large groups
+        threaded = potential_kernel(hid_bins, pos, mass, LBOX, 1., 0.01, nproc, direct_npart=direct_npart, big_npart=big_npart)
+        assert np.array_equal(threaded, serial)
+
+
+def test_potential_tree_deep():
+    # a cluster refined 26 times makes a very deep octree; with theta=0 every cell is
+    # opened, so the tree walk must reach every particle
+    rng = np.random.default_rng(0)
+    pos = [rng.random((2000, 3))] + [0.5 + 2.**-k * rng.random((8, 3)) for k in range(1, 27)]
+    pos = np.concatenate(pos).astype(np.float32)
+    mass = rng.random(len(pos)).astype(np.float32)
+    hid_bins = np.array([0, len(pos)], dtype=np.int64)
+    direct = potential_kernel(hid_bins, pos, mass, 1.e6, 1., 1.e-4, 1, direct_npart=len(pos))
+    tree = potential_kernel(hid_bins, pos, mass, 1.e6, 1., 1.e-4, 1, direct_npart=0, theta=0.)
+    assert np.allclose(tree, direct, rtol=1.e-5, atol=0.)
+    approx = potential_kernel(hid_bins, pos, mass, 1.e6, 1., 1.e-4, 1, direct_npart=0, theta=0.5)
+    assert np.allclose(approx, direct, rtol=1.e-2, atol=0.)
+
+
+def test_unbind_reference():
+    hid_bins, pos, vel, mass, ptype = _groups()
+    G = 1.  # unbinds some particles of every group, over several iterations
+    bound, niter = unbind_kernel(hid_bins, pos, vel, mass, LBOX, G, 0.01, 10, 1, direct_npart=100000)
+    assert 0 < np.count_nonzero(bound == 0) < len(bound) // 2 and np.max(niter) > 1
+    for ig in range(len(hid_bins)-1):
+        sl = slice(hid_bins[ig], hid_bins[ig+1])
+        reference = _unbind_reference(_unwrap(pos[sl]), vel[sl].astype(np.float64), mass[sl].astype(np.float64), G, 0.01, 10)
+        assert np.array_equal(bound[sl].astype(bool), reference)
+
+
+def test_unbind_threads():
+    hid_bins, pos, vel, mass, ptype = _groups()
+    serial = unbind_kernel(hid_bins, pos, vel, mass, LBOX, 1., 0.01, 10, 1, direct_npart=500)
+    for nproc, big_npart in [(2, 0), (4, 0), (4, 1000)]:
+        threaded = unbind_kernel(hid_bins, pos, vel, mass, LBOX, 1., 0.01, 10, nproc, direct_npart=500, big_npart=big_npart)
+        assert np.array_equal(threaded[0], serial[0])
+        assert np.array_equal(threaded[1], serial[1])
+
+
+def test_unbind_tree_deep():
+    # a cluster refined 26 times makes a very deep octree; with theta=0 every cell is
+    # opened, so the tree walk must reach every particle
+    rng = np.random.default_rng(0)
+    pos = [rng.random((2000, 3))] + [0.5 + 2.**-k * rng.random((8, 3)) for k in range(1, 27)]
+    pos = np.concatenate(pos).astype(np.float32)
+    mass = rng.random(len(pos)).astype(np.float32)
+    vel = (30.*rng.normal(size=pos.shape)).astype(np.float32)
+    hid_bins = np.array([0, len(pos)], dtype=np.int64)
+    direct = unbind_kernel(hid_bins, pos, vel, mass, 1.e6, 1., 1.e-4, 10, 1, direct_npart=len(pos))
+    tree = unbind_kernel(hid_bins, pos, vel, mass, 1.e6, 1., 1.e-4, 10, 1, direct_npart=0, theta=0.)
+    assert 0 < np.count_nonzero(direct[0] == 0) < len(pos) // 2
+    assert np.array_equal(tree[0], direct[0])
+    assert np.array_equal(tree[1], direct[1])
+
+
+def _overall(nproc=1, **kwargs):
+    hid_bins, pos, vel, mass, ptype = _groups()
+    pot = potential_kernel(hid_bins, pos, mass, LBOX, 1., 0.01, 1)
+    Densities = np.array([200., 500., 2500.])
+    return group_overall_kernel(hid_bins, pos, vel, mass, pot, ptype, np.array([0, 1, 4], dtype=np.int32),
+                                Densities, LBOX, 1, True, nproc, **kwargs)
+
+
+def test_overall_reference():
+    hid_bins, pos, vel, mass, ptype = _groups()
+    grp_mtot, grp_mass, grp_count, grp_pos, grp_vel = _overall()[:5]
+    for ig in range(len(hid_bins)-1):
+        sl = slice(hid_bins[ig], hid_bins[ig+1])
+        m = mass[sl].astype(np.float64)
+        assert np.isclose(grp_mtot[ig], np.sum(m), rtol=1.e-5)
+        for ip, t in enumerate([0, 1, 4]):
+            assert grp_count[ig, ip] == np.count_nonzero(ptype[sl] == t)
+            assert np.isclose(grp_mass[ig, ip], np.sum(m[ptype[sl] == t]), rtol=1.e-5)
+        com = pos[sl][0] + np.sum(m[:,None]*_unwrap(pos[sl]), axis=0) / np.sum(m)
+        dx = grp_pos[ig] - com
+        assert np.allclose(dx - LBOX*np.round(dx/LBOX), 0., atol=1.e-3)
+        assert np.allclose(grp_vel[ig], np.sum(m[:,None]*vel[sl], axis=0) / np.sum(m), rtol=1.e-4, atol=1.e-3)
+
+
+def _assert_close(a, b):
+    for x, y in zip(a, b):
+        if x.dtype.kind in 'iu':
+            assert np.array_equal(x, y)
+        else:
+            assert np.allclose(x, y, rtol=1.e-4, atol=1.e-4)
+
+
+@pytest.mark.parametrize('radial_method', ['sort', 'select'])
+def test_overall_threads(radial_method):
+    serial = _overall(1, radial_method=radial_method)
+    for nproc, big_npart in [(2, 0), (4, 0), (4, 1000)]:  # big_npart=1000: threads share large groups
+        _assert_close(_overall(nproc, big_npart=big_npart, radial_method=radial_method), serial)
+
+
+def test_overall_select():
+    sort = _overall(radial_method='sort')
+    select = _overall(radial_method='select')
+    for i in [7, 8, 9, 12, 13]:  # R20, Rhalf, R80, mvir, rvir
+        assert np.array_equal(select[i], sort[i])
+    _assert_close(select, sort)
@@ -0,0 +1,107 @@
+import h5py
+import numpy as np
+import pytest
+from yt.units.yt_array import YTArray, YTQuantity
+
+from caesar.hdf5_reader import HDF5Reader
+from caesar.property_manager import DatasetType, get_particles_for_FOF
+
+NPART = np.array([700, 0, 0, 0, 300, 0])  # gas and stars, no DM
+
+
+class GizmoDataset(object):
+    """Stands in for the yt dataset of the snapshot files written by _snapshot."""
+    cosmological_simulation = True
+    _unit_base = None
+
+    def __init__(self, filename):
+        self.parameter_filename = filename
+
+    def arr(self, values, units):
+        return YTArray(values, units.replace('kpccm', 'kpc'))
+
+    def quan(self, value, units):
+        return YTQuantity(value, units)
+
+
+def _snapshot(tmp_path, nfiles=3):
+    """Multi-file snapshot with random fields; returns its first file and
+    the full fields of each ptype."""
+    rng = np.random.default_rng(5)
+    fields = {}
+    for itype in np.flatnonzero(NPART):
+        n = NPART[itype]
+        fields[itype] = dict(Coordinates=rng.random((n, 3)).astype(np.float32),
+                             Velocities=rng.normal(size=(n, 3)).astype(np.float32),
+                             Masses=rng.random(n).astype(np.float32),
+                             Potential=rng.normal(size=n).astype(np.float32),
+                             ParticleIDs=rng.permutation(n).astype(np.uint64))
+    bounds = [np.linspace(0, n, nfiles+1).astype(np.int64) for n in NPART]
+    for ifile in range(nfiles):
+        with h5py.File(tmp_path / ('snapshot_000.%d.hdf5' % ifile), 'w') as hd:
+            nthis = [b[ifile+1]-b[ifile] for b in bounds]
+            hd.create_group('Header').attrs.update(dict(
+                NumPart_Total=NPART, NumPart_ThisFile=nthis, MassTable=np.zeros(6),
+                NumFilesPerSnapshot=nfiles, Time=0.5, HubbleParam=0.7))
+            for itype in fields:
+                g = hd.create_group('PartType%d' % itype)
+                for name, data in fields[itype].items():
+                    g.create_dataset(name, data=data[bounds[itype][ifile]:bounds[itype][ifile+1]])
+    return str(tmp_path / 'snapshot_000.0.hdf5'), fields
+
+
+@pytest.mark.parametrize('nthreads', [1, 4])
+def test_read_field(tmp_path, nthreads):
+    filename, fields = _snapshot(tmp_path)
+    reader = HDF5Reader(GizmoDataset(filename), nthreads=nthreads)
+    mask = np.random.default_rng(6).random(NPART[0]) < 0.3
+    mask[:200] = False  # a block with nothing selected
+    for name, data in fields[0].items():
+        assert np.array_equal(reader.read_field(0, name), data)
+        for block_rows in [1 << 22, 50]:
+            selected = reader.read_field(0, name, selection=mask, block_rows=block_rows)
+            assert np.array_equal(selected, data[mask])
+    assert len(reader.read_field(0, 'Masses', selection=np.zeros(NPART[0], dtype=bool))) == 0
+
+
+def test_read_field_no_particles(tmp_path):
+    filename, fields = _snapshot(tmp_path)
+    reader = HDF5Reader(GizmoDataset(filename))
+    assert reader.read_field(1, 'Coordinates', dtype=np.float32).shape == (0, 3)
+    assert reader.read_field(1, 'Masses').shape == (0,)
+    assert len(reader.get_property('PartType1', 'pid')) == 0
+
+
+def test_potential_units(tmp_path):
+    # like yt, the potential is in code_velocity**2, with velocities carrying sqrt(a)
+    filename, fields = _snapshot(tmp_path)
+    reader = HDF5Reader(GizmoDataset(filename))
+    pot = reader.get_property('PartType0', 'pot')
+    assert str(pot.units) == 'km**2/s**2'
+    assert np.allclose(pot.d, 0.5*fields[0]['Potential'], rtol=1e-6)
+
+
+def test_get_particles_for_FOF(tmp_path):
+    filename, fields = _snapshot(tmp_path)
+    ds = GizmoDataset(filename)
+
+    class _CAESAR(object):
+        _ds_type = DatasetType(ds, reader='hdf5', io_threads=4, cache_size=1.)
+        load_haloid = False
+        yt_dataset = ds
+        units = dict(length='kpc', velocity='km/s', mass='Msun')
+
+    obj = _CAESAR()
+    rng = np.random.default_rng(7)
+    select = [np.where(rng.random(NPART[0]) < 0.4, 0, -1), np.where(rng.random(NPART[4]) < 0.6, 0, -1)]
+    parts = get_particles_for_FOF(obj, ['gas', 'star'], select)
+    flags = [s >= 0 for s in select]
+    h = 0.7
+    assert np.allclose(parts['pos'], np.concatenate([fields[i]['Coordinates'][f] for i, f in zip([0, 4], flags)])/h)
+    assert np.allclose(parts['mass'], np.concatenate([fields[i]['Masses'][f] for i, f in zip([0, 4], flags)])*1e10/h, rtol=1e-6)
+    assert np.array_equal(parts['indexes'], np.concatenate([np.flatnonzero(f) for f in flags]))
+
+    # the selected fields are cached under the selection, and read-only
+    pos = obj._ds_type.get_property('gas', 'pos', flags[0])
+    assert not pos.flags.writeable
+    assert obj._ds_type.cache.hits >= 1
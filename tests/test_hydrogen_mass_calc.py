@@ -0,0 +1,197 @@
+import numpy as np
+import pytest
+from yt.units.yt_array import YTArray, YTQuantity
+
+from caesar.group import Galaxy, Halo
+from caesar.hydrogen_mass_calc import get_aperture_masses, get_HIH2_masses, selfshield_constants, selfshield_kernel
+from caesar.spatial_index import SpatialIndex
+
+RHO_THRESH = 0.13
+
+
+def _gas(npart=50000, seed=0):
+    """Gas over and around the self-shielding regime."""
+    rng = np.random.default_rng(seed)
+    nh = (10**rng.uniform(-5, 1, npart)).astype(np.float32)
+    T = (10**rng.uniform(0.5, 6, npart)).astype(np.float32)
+    fHI_thin = (10**rng.uniform(-7, -2, npart)).astype(np.float32)
+    fHI_thin[::100] = 0.
+    return nh, T, fHI_thin
+
+
+def _selfshield_reference(gnh, gtemp, gfHI, gamma_HI, nHss_part, rho_th):
+    """The per-particle loop of compute_selfshield before it was compiled."""
+    nh = gnh.astype(np.float64)
+    T = gtemp.astype(np.float64)
+    fHI = gfHI.astype(np.float64)
+    fH2 = np.zeros(len(nh))
+    shield = (nh < rho_th) & (nh > 1.e-4) & (T < 1.e5)
+    nHss = nHss_part * (T * 1.0e-4)**0.17 * (gamma_HI * 1.0e12)**(2./3.)
+    with np.errstate(all='ignore'):
+        fgamma_HI = 0.98 * (1.0 + (nh / nHss)**1.64)**(-2.28) + 0.02 * (1.0 + nh / nHss)**(-0.84)
+        shield &= ~((1. - fgamma_HI < 1.e-2) & (gfHI > 0))
+        beta = 7.982e-11 / (np.sqrt(T/3.148) * (1.0 + np.sqrt(T/3.148))**(1.0-0.748) * (1.0 + np.sqrt(T/7.036e5))**(1.0+0.748))
+        C = nh * beta / (gamma_HI * fgamma_HI)
+        fHI = np.where(shield, (2.0*C + 1.0 - np.sqrt((2.0*C+1.0)**2 - 4.0*C*C)) / (2.0*C), fHI)
+    dense = nh >= rho_th
+    Rmol = (nh * T / 1.7e4)**0.8
+    fHI = np.where(dense, 0.99 * (1.0e8 - T) / 1.0e8 / (1.0 + Rmol), fHI)
+    fH2 = np.where(dense, 0.99 - fHI, fH2)
+    return fHI, fH2
+
+
+@pytest.mark.parametrize('uvb_model', ['FG11', 'HM12'])
+def test_selfshield_reference(uvb_model):
+    gas = _gas()
+    gamma_HI, nHss_part = selfshield_constants(1., 0.16, uvb_model)
+    fHI, fH2 = selfshield_kernel(*gas, gamma_HI, nHss_part, RHO_THRESH, 1, use_table=False)
+    fHI_ref, fH2_ref = _selfshield_reference(*gas, gamma_HI, nHss_part, RHO_THRESH)
+    assert np.allclose(fHI, fHI_ref, rtol=1.e-5, atol=0.)
+    assert np.allclose(fH2, fH2_ref, rtol=1.e-5, atol=1.e-7)
+
+    fHI_table, fH2_table = selfshield_kernel(*gas, gamma_HI, nHss_part, RHO_THRESH, 1, use_table=True)
+    assert np.allclose(fHI_table, fHI, rtol=1.e-3, atol=0.)
+    assert np.array_equal(fH2_table, fH2)
+
+
+@pytest.mark.parametrize('use_table', [False, True])
+def test_selfshield_threads(use_table):
+    gas = _gas()
+    gamma_HI, nHss_part = selfshield_constants(2., 0.16, 'FG11')
+    serial = selfshield_kernel(*gas, gamma_HI, nHss_part, RHO_THRESH, 1, use_table=use_table)
+    for nproc in [2, 4]:
+        threaded = selfshield_kernel(*gas, gamma_HI, nHss_part, RHO_THRESH, nproc, use_table=use_table)
+        assert np.array_equal(threaded[0], serial[0]) and np.array_equal(threaded[1], serial[1])
+
+
+class _Dataset(object):
+    def arr(self, values, units):
+        return YTArray(values, units)
+
+    def quan(self, value, units):
+        return YTQuantity(value, units)
+
+
+class _DatasetType(object):
+    def has_property(self, ptype, prop):
+        return True
+
+
+class _Simulation(object):
+    XH = 0.76
+    boxsize = YTQuantity(1000., 'kpc')
+
+
+class _DataManager(object):
+    pass
+
+
+class _CAESAR(object):
+    units = dict(mass='Msun', length='kpc')
+    yt_dataset = _Dataset()
+    _ds_type = _DatasetType()
+    _kwargs = {}
+
+
+class _Galaxies(object):
+    def __init__(self, obj, nproc):
+        self.obj = obj
+        self.nproc = nproc
+
+
+def _halos_with_gas(nproc, seed=0):
+    """Halos of gas with a few to many galaxies each, one straddling the box edge.
+    (For aperture masses, some of the "gas" particles are given other types.)"""
+    rng = np.random.default_rng(seed)
+    obj = _CAESAR()
+    obj.simulation = _Simulation()
+    obj.halo_list, obj.galaxy_list = [], []
+    pos, start = [], 0
+    for ih, ngal in enumerate([1, 3, 40, 0, 12]):
+        centre = np.array([5., 500., 500.]) if ih == 0 else rng.random(3)*1000.
+        npart = 3000
+        pos.append(centre + rng.normal(size=(npart, 3))*50.)
+        halo = Halo(obj)
+        halo.glist = halo.global_indexes = np.arange(start, start+npart)
+        halo.galaxy_index_list = np.arange(len(obj.galaxy_list), len(obj.galaxy_list)+ngal)
+        start += npart
+        for ig in range(ngal):
+            galaxy = Galaxy(obj)
+            galaxy.pos = YTArray((centre + rng.normal(size=3)*40.) % 1000., 'kpc')
+            galaxy.masses = {'total': YTQuantity(10**rng.uniform(8, 12), 'Msun')}
+            obj.galaxy_list.append(galaxy)
+        obj.halo_list.append(halo)
+    obj.simulation.ngas = obj.simulation.ntot = start
+    obj.spatial_index = SpatialIndex(1 << 30, nproc=nproc)
+    dm = obj.data_manager = _DataManager()
+    dm.pos = (np.concatenate(pos) % 1000.).astype(np.float32)
+    dm.mass = (1.e6*(1.+rng.random(start))).astype(np.float32)
+    dm.gnh = (10**rng.uniform(-4, 1, start)).astype(np.float32)
+    dm.gfHI = rng.random(start).astype(np.float32)
+    dm.gfH2 = (rng.random(start)*(dm.gnh > 0.13)).astype(np.float32)
+    dm.gfHI[::7] = 0.
+    dm.gfH2[::7] = 0.
+    dm.ptype = rng.choice(np.array([0, 1, 4], dtype=np.int32), start)
+    return _Galaxies(obj, nproc)
+
+
+def _hydrogen_masses_reference(obj, aperture=30., rho_thresh=0.13):
+    """Each halo's gas goes to its galaxy with the largest mass over distance
+    squared, as in assign_halo_gas_to_galaxies; aperture masses count all of
+    the halo's gas within aperture of each galaxy."""
+    dm = obj.data_manager
+    HI = dm.gfHI.astype(np.float64)
+    H2 = np.where(dm.gnh < rho_thresh, 0., dm.gfH2.astype(np.float64))
+    HI = np.where(HI + H2 > 1., 1. - H2, HI) * obj.simulation.XH * dm.mass
+    H2 = H2 * obj.simulation.XH * dm.mass
+    ngal = len(obj.galaxy_list)
+    result = np.zeros((4, ngal))
+    halo_HI = np.zeros(len(obj.halo_list))
+    for ih, halo in enumerate(obj.halo_list):
+        gas = halo.glist
+        halo_HI[ih] = np.sum(HI[gas])
+        galaxies = halo.galaxy_index_list
+        if len(galaxies) == 0:
+            continue
+        galpos = np.array([obj.galaxy_list[i].pos.d for i in galaxies])
+        galmass = np.array([obj.galaxy_list[i].masses['total'].d for i in galaxies])
+        dx = np.abs(dm.pos[gas][:,None,:].astype(np.float64) - galpos[None,:,:])
+        dx = np.where(dx > 500., 1000. - dx, dx)
+        d2 = np.sum(dx*dx, axis=2)
+        has_mass = (HI[gas] != 0.) | (H2[gas] != 0.)
+        nearest = galaxies[np.argmax(galmass[None,:]/d2, axis=1)]
+        np.add.at(result[0], nearest[has_mass], HI[gas][has_mass])
+        np.add.at(result[1], nearest[has_mass], H2[gas][has_mass])
+        within = (d2 < aperture**2) & has_mass[:,None]
+        result[2][galaxies] += within.T @ HI[gas]
+        result[3][galaxies] += within.T @ H2[gas]
+    return result, halo_HI
+
+
+@pytest.mark.parametrize('nproc', [1, 4])
+def test_HIH2_masses_reference(nproc):
+    galaxies = _halos_with_gas(nproc)
+    obj = galaxies.obj
+    reference, halo_HI = _hydrogen_masses_reference(obj)
+    get_HIH2_masses(galaxies)
+    for im, name in enumerate(['HI', 'H2', 'HI_30kpc', 'H2_30kpc']):
+        masses = np.array([g.masses[name].d for g in obj.galaxy_list])
+        assert np.allclose(masses, reference[im], rtol=1.e-6, atol=0.)
+    assert np.allclose([h.masses['HI'].d for h in obj.halo_list], halo_HI, rtol=1.e-6, atol=0.)
+
+
+@pytest.mark.parametrize('nproc', [1, 4])
+def test_aperture_masses_reference(nproc):
+    galaxies = _halos_with_gas(nproc)
+    obj = galaxies.obj
+    dm = obj.data_manager
+    get_aperture_masses(galaxies)
+    for halo in obj.halo_list:
+        for ig in halo.galaxy_index_list:
+            galaxy = obj.galaxy_list[ig]
+            dx = np.abs(dm.pos[halo.global_indexes].astype(np.float64) - galaxy.pos.d)
+            dx = np.where(dx > 500., 1000. - dx, dx)
+            within = np.sum(dx*dx, axis=1) < 30.**2
+            for name, t in [('gas', 0), ('stellar', 4), ('dm', 1)]:
+                sel = within & (dm.ptype[halo.global_indexes] == t)
+                assert np.isclose(galaxy.masses['%s_30kpc' % name].d, np.sum(dm.mass[halo.global_indexes][sel]), rtol=1.e-6)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from caesar.property_manager import FieldCache
+
+
+def test_field_cache_returns_read_only_views():
+    cache = FieldCache(1024**2)
+    key = ('gas', 'mass', 'all')
+    assert cache.get(key) is None
+    data = np.arange(10.)
+    cache.put(key, data)
+    assert not data.flags.writeable
+    assert cache.get(key) is data
+    with pytest.raises(ValueError):
+        cache.get(key)[0] = -1.
+    assert cache.info()['hits'] == 2 and cache.info()['misses'] == 1
+
+
+def test_field_cache_budget():
+    cache = FieldCache(100)
+    cache.put('a', np.zeros(10))
+    cache.put('b', np.zeros(5))  # evicts 'a'
+    cache.put('c', np.zeros(20))  # larger than the budget, never cached
+    assert cache.get('a') is None and cache.get('c') is None
+    assert cache.get('b') is not None
+    assert cache.nbytes == 40
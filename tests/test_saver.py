@@ -0,0 +1,34 @@
+import h5py
+import numpy as np
+import pytest
+
+from caesar.saver import ChunkedWriter
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'lzf', 'zstd', 'blosc'])
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('nproc', [1, 4])
+def test_chunked_writer_roundtrip(tmp_path, compression, shuffle, nproc):
+    if compression in ['zstd', 'blosc']:
+        pytest.importorskip('hdf5plugin')
+    rng = np.random.default_rng(0)
+    datasets = {'float': rng.random(100003).astype(np.float32),
+                'vector': rng.normal(size=(40001, 3)),
+                'int': rng.integers(0, 1 << 40, 70001),
+                'bool': rng.random(1001) < 0.5,
+                'empty': np.zeros(0, dtype=np.int64),
+                'noncontiguous': rng.random((1000, 3))[::2, 1],
+                'scalar': 2.5,
+                'numpy_scalar': np.int32(7),
+                'zero_d': np.array(3.)}
+    filename = str(tmp_path / 'chunked.hdf5')
+    writer = ChunkedWriter(compression, shuffle=shuffle, nproc=nproc, chunk_bytes=1 << 16)
+    with h5py.File(filename, 'w') as hd:
+        for key, data in datasets.items():
+            writer.write(hd, key, data, unit='kpc' if key == 'vector' else None)
+        writer.close()
+    with h5py.File(filename, 'r') as hd:
+        for key, data in datasets.items():
+            assert hd[key].shape == np.shape(data)
+            assert np.array_equal(hd[key][()], data)
+        assert hd['vector'].attrs['unit'] in ('kpc', b'kpc')  # str or bytes, by h5py version
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from caesar.spatial_index import SpatialIndex, ball_neighbors, periodic_tree, _tree_nbytes
+
+LBOX = 100.
+
+
+def _points(n=2000, nquery=300):
+    rng = np.random.default_rng(7)
+    pos = rng.random((n, 3)) * LBOX
+    # queries near the faces and outside the box, to cross the boundary
+    x = np.concatenate([rng.random((nquery, 3)) * LBOX,
+                        rng.choice([-2., 1., 99., 101.], (nquery, 3))])
+    return pos, rng.random(n), x
+
+
+def _distances(pos, x):
+    """Brute force periodic distances, queries by points."""
+    dx = pos[None, :, :] - x[:, None, :]
+    dx -= LBOX * np.round(dx / LBOX)
+    return np.sqrt(np.sum(dx*dx, axis=2))
+
+
+@pytest.mark.parametrize('r', [5., 'varying'])
+def test_ball_neighbors_reference(r):
+    pos, weights, x = _points()
+    if r == 'varying':
+        r = np.linspace(0.5, 12., len(x))
+    d = _distances(pos, x)
+    within = d <= np.broadcast_to(r, len(x))[:, None]
+
+    start, ind, dist = ball_neighbors(periodic_tree(pos, LBOX), x, r)
+    assert np.array_equal(np.diff(start), within.sum(axis=1))
+    for i in range(len(x)):
+        order = np.argsort(ind[start[i]:start[i+1]])
+        assert np.array_equal(ind[start[i]:start[i+1]][order], np.flatnonzero(within[i]))
+        assert np.allclose(dist[start[i]:start[i+1]][order], d[i, within[i]])
+
+
+def test_spatial_index_reference():
+    pos, weights, x = _points()
+    within = _distances(pos, x) <= 8.
+    builder = lambda: (pos, LBOX, weights)
+
+    for nproc in [1, 4]:
+        index = SpatialIndex(1 << 30, nproc=nproc)
+        assert np.array_equal(index.count('all', builder, x, 8.), within.sum(axis=1))
+        sums, counts = index.sum_within('all', builder, x, 8., return_count=True)
+        assert np.allclose(sums, within @ weights)
+        assert np.array_equal(counts, within.sum(axis=1))
+        start, ind, dist = index.neighbors('all', builder, x, 8.)
+        assert np.array_equal(np.diff(start), counts)
+        assert index.info()['misses'] == 1 and index.info()['hits'] == 2
+
+
+def test_spatial_index_threads():
+    pos, weights, x = _points()
+    builder = lambda: (pos, LBOX, weights)
+    serial = SpatialIndex(1 << 30, nproc=1)
+    for nproc in [2, 4]:
+        index = SpatialIndex(1 << 30, nproc=nproc)
+        assert np.array_equal(index.sum_within('all', builder, x, 6.),
+                              serial.sum_within('all', builder, x, 6.))
+        for a, b in zip(index.neighbors('all', builder, x, 6.), serial.neighbors('all', builder, x, 6.)):
+            assert np.array_equal(a, b)
+
+
+def test_spatial_index_budget():
+    pos, weights, x = _points()
+    nbytes = _tree_nbytes(periodic_tree(pos, LBOX)) + weights.nbytes
+    builder = lambda: (pos, LBOX, weights)
+
+    index = SpatialIndex(2*nbytes)
+    for key in ['a', 'b', 'a', 'c']:
+        index.get(key, builder)
+    # 'b' was the least recently used when 'c' needed room
+    assert index.info()['keys'] == ['a', 'c'] and index.nbytes == 2*nbytes
+    assert index.hits == 1 and index.misses == 3
+
+    index = SpatialIndex(nbytes - 1)
+    tree, w = index.get('a', builder)
+    assert tree.n == len(pos) and w is weights
+    assert index.info()['keys'] == [] and index.nbytes == 0
@@ -0,0 +1,74 @@
+import numpy as np
+import scipy.spatial
+from yt.units.yt_array import YTArray, YTQuantity
+
+import caesar.spherical_overdensity as so
+from caesar.group import Halo
+
+
+class _Dataset(object):
+    def arr(self, values, units):
+        return YTArray(values, units)
+
+    def quan(self, value, units):
+        return YTQuantity(value, units)
+
+
+class _Simulation(object):
+    boxsize = YTQuantity(100., 'kpc')
+    Densities = YTArray([200., 500., 2500.], 'Msun/kpc**3')
+
+
+class _SpatialIndex(object):
+    def __init__(self, pos, mass):
+        self.tree = scipy.spatial.cKDTree(pos, boxsize=100.)
+        self.mass = mass
+
+    def get(self, key, builder):
+        return self.tree, self.mass
+
+
+class _CAESAR(object):
+    units = dict(length='kpc', mass='Msun')
+    yt_dataset = _Dataset()
+    simulation = _Simulation()
+
+    def __init__(self, pos, mass, **kwargs):
+        self._kwargs = kwargs
+        self.spatial_index = _SpatialIndex(pos, mass)
+
+
+def _run(pos, mass, mfof, monkeypatch, **kwargs):
+    obj = _CAESAR(pos, mass, **kwargs)
+    halo = Halo(obj)
+    halo.pos = YTArray([50., 50., 50.], 'kpc')
+    halo.masses = {'total': YTQuantity(mfof, 'Msun')}
+    warnings = []
+    monkeypatch.setattr(so.mylog, 'warning', lambda msg, *args: warnings.append(msg % args if args else msg))
+    so.get_so_quantities(obj, [halo])
+    return halo, warnings
+
+
+def test_so_isolated_halo(monkeypatch):
+    # a uniform 1 kpc ball of 1e7 Msun in an empty box: every overdensity is reached
+    # at the edge of the ball
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(4000, 3))
+    pos = 50. + x / np.linalg.norm(x, axis=1)[:,None] * rng.random(4000)[:,None]**(1./3.)
+    mass = np.full(4000, 1.e7/4000)
+    halo, warnings = _run(pos, mass, 1.e7, monkeypatch)
+    assert len(warnings) == 0
+    for rtype in so.SO_NAMES:
+        assert 0.99 < halo.virial_quantities['r'+rtype].d <= 1.
+        assert np.isclose(halo.virial_quantities['m'+rtype].d, 1.e7, rtol=0.01)
+
+
+def test_so_max_iter_warns(monkeypatch):
+    # a uniform box far above every overdensity, so no search radius is large enough
+    rng = np.random.default_rng(1)
+    pos = 100. * rng.random((20000, 3))
+    mass = np.full(20000, 1.e6*1.e6/20000)
+    for max_iter in [0, 2]:
+        halo, warnings = _run(pos, mass, 1.e7, monkeypatch, so_max_iter=max_iter)
+        assert len(warnings) == 1
+        assert warnings[0].startswith('1 halos') and 'so_max_iter=%d' % max_iter in warnings[0]